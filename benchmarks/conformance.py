@@ -0,0 +1,115 @@
+"""Schema Fast Path Conformance
+
+Check that the generated fast path of each bundled schema accepts exactly the
+records jsonschema accepts, and time both.
+
+Records come from the synthetic corpus, plus copies of them with one field
+removed or replaced by a value of another type, a value outside an enum or a
+string that breaks a pattern. Every record is validated by the fast path
+(`fastschema.compile_schema`) and by jsonschema (`schema.schema_errors`); the
+script exits with an error if they disagree on any record, or if no fast path
+can be generated for a schema.
+
+    python benchmarks/conformance.py [--schemas geoblacklight-1-wisc] [--count 20] [--seed 0]
+"""
+
+
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+# Run against this checkout even if geodatautils is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus import make_record, SCHEMAS
+
+
+# Values swapped into fields, covering every JSON type and the edge cases of
+# the type checks (booleans are not numbers, 1.0 is an integer in later drafts)
+VALUES = [None, True, False, 0, 1, 1.0, 2.5, -7, "", "x", "Public", "Restricted", "Aardvark", "1.0", "Dataset", "Polygon",
+          "{}", "{\"a\": 1}", "ENVELOPE(1,2,3,4)", "ENVELOPE(1,2,3)", "abc-123", "abc 123", [], ["x"], [1], [1.0], [True], [None], ["x", 2], {}, {"a": 1}]
+
+
+def field_names(schema:dict) -> set[str]:
+    """Collect every property and required field named anywhere in a schema."""
+
+    names = set()
+    stack = [schema]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            names.update(node.get('properties', {}) if isinstance(node.get('properties'), dict) else ())
+            names.update(node.get('required', []) if isinstance(node.get('required'), list) else ())
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return names
+
+def records(schema_name:str, schema:dict, count:int, seed:int) -> list:
+    """Build valid records and mutated copies of them."""
+
+    rng = random.Random("{}-{}".format(schema_name, seed))
+    names = sorted(field_names(schema))
+
+    built = [[], {}, "x", None]  # Not objects at all
+    for i in range(count):
+        record = make_record(schema_name, i, rng)
+        built.append(record)
+        for name in names:
+            if name in record:
+                mutated = copy.deepcopy(record)
+                del mutated[name]
+                built.append(mutated)
+            for value in rng.sample(VALUES, 8):
+                mutated = copy.deepcopy(record)
+                mutated[name] = copy.deepcopy(value)
+                built.append(mutated)
+
+    return built
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check that the schema fast path agrees with jsonschema.")
+    parser.add_argument("--schemas", nargs="+", choices=SCHEMAS, default=list(SCHEMAS), help="Metadata schemas to check.")
+    parser.add_argument("--count", type=int, default=20, help="Number of corpus records to mutate per schema.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    from geodatautils import schema
+    from geodatautils.fastschema import compile_schema
+
+    failed = False
+
+    for schema_name in args.schemas:
+        loaded = schema.load_schema(schema_name)
+        validator = schema.get_validator(schema_name)
+        fast_path = compile_schema(loaded)
+        if fast_path is None:
+            print("{}: FAIL: no fast path could be generated".format(schema_name))
+            failed = True
+            continue
+
+        built = records(schema_name, loaded, args.count, args.seed)
+
+        # Compare both paths on every record
+        start = time.perf_counter()
+        fast_results = [fast_path(data) for data in built]
+        fast_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        full_results = [not schema.schema_errors(data, validator)[0] for data in built]
+        full_seconds = time.perf_counter() - start
+
+        disagree = [data for data, fast, full in zip(built, fast_results, full_results) if fast != full]
+        print("{}: {} records, {} valid; fast path {:.1f} ms, jsonschema {:.1f} ms ({:.0f}x){}".format(
+            schema_name, len(built), sum(full_results), fast_seconds*1000, full_seconds*1000, full_seconds/max(fast_seconds, 1e-9),
+            "  FAIL: {} disagree".format(len(disagree)) if disagree else ""))
+        for data in disagree[:5]:
+            print("  {!r:.200}".format(data))
+        failed = failed or bool(disagree)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Synthetic Corpus
+
+Generate synthetic, schema-valid GeoBlacklight records for benchmarks.
+
+Records are built from a seeded random generator, so the same arguments always
+give the same corpus. Files are written 1,000 to a folder, like a large harvest.
+Aardvark records also carry `dc_identifier_s` and `layer_slug_s` (the schema
+allows extra fields), since Geodata Utils keys records by them.
+
+    python benchmarks/corpus.py OUT_DIR [--schema geoblacklight-1-wisc] [--count 10000] [--seed 0] [--check]
+"""
+
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+
+# Run against this checkout even if geodatautils is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Schemas in the config and the record builder for each
+SCHEMAS = ("geoblacklight-1-wisc", "geoblacklight-1", "geoblacklight-aardvark")
+
+# Records per folder
+FOLDER_SIZE = 1000
+
+WORDS = ["county", "parcels", "roads", "hydrography", "wetlands", "zoning", "land", "cover", "elevation", "contours", "municipal", "boundaries", "orthoimagery", "soils", "trails", "bridges", "schools", "census", "tracts", "forest"]
+COUNTIES = ["Adams", "Ashland", "Barron", "Bayfield", "Brown", "Dane", "Door", "Douglas", "Iowa", "Iron", "Marathon", "Milwaukee", "Oneida", "Polk", "Vilas", "Waukesha"]
+
+
+def _common(i:int, rng:random.Random) -> dict:
+    """Values shared by the records of every schema."""
+
+    county = rng.choice(COUNTIES)
+    year = rng.randint(1990, 2024)
+    west = round(rng.uniform(-92.9, -87.5), 4)
+    south = round(rng.uniform(42.5, 46.5), 4)
+    return {
+        'uid': "bench-{:07d}".format(i),
+        'county': county,
+        'year': year,
+        'title': "{} County {} {}".format(county, " ".join(rng.sample(WORDS, 2)).title(), year),
+        'description': " ".join(rng.choices(WORDS, k=rng.randint(20, 80))).capitalize() + ".",
+        'keywords': rng.sample(WORDS, rng.randint(1, 5)),
+        'envelope': "ENVELOPE({},{},{},{})".format(west, round(west + rng.uniform(0.05, 1), 4), round(south + rng.uniform(0.05, 1), 4), south),
+        'references': json.dumps({
+            "http://schema.org/url": "https://example.org/{}".format(i),
+            "http://schema.org/downloadUrl": "https://example.org/data/{}_{}.zip".format(county.lower(), year),
+            "http://www.opengis.net/def/serviceType/ogc/wms": "https://example.org/wms"
+        }),
+        'modified': "{}-{:02d}-{:02d}T00:00:00Z".format(rng.randint(2015, 2024), rng.randint(1, 12), rng.randint(1, 28))
+    }
+
+def gbl1_record(i:int, rng:random.Random) -> dict:
+    """Build a record for the GeoBlacklight 1.0 schemas."""
+
+    common = _common(i, rng)
+    return {
+        "geoblacklight_version": "1.0",
+        "dc_identifier_s": common['uid'],
+        "layer_slug_s": common['uid'],
+        "dc_title_s": common['title'],
+        "dc_description_s": common['description'],
+        "dc_rights_s": rng.choice(["Public", "Restricted"]),
+        "dct_provenance_s": "{} County".format(common['county']),
+        "dc_creator_sm": ["{} County Land Information Office".format(common['county'])],
+        "dc_publisher_s": "{} County".format(common['county']),
+        "dc_format_s": rng.choice(["Shapefile", "GeoTIFF", "File Geodatabase"]),
+        "dc_language_s": "English",
+        "dc_type_s": "Dataset",
+        "dc_subject_sm": common['keywords'],
+        "dct_spatial_sm": ["{} County, Wisconsin".format(common['county'])],
+        "dct_temporal_sm": [str(common['year'])],
+        "dct_isPartOf_sm": [rng.choice(["Statewide", "County Data", "Historic"])],
+        "dct_references_s": common['references'],
+        "layer_geom_type_s": rng.choice(["Point", "Line", "Polygon", "Raster"]),
+        "layer_modified_dt": common['modified'],
+        "solr_geom": common['envelope'],
+        "solr_year_i": common['year']
+    }
+
+def aardvark_record(i:int, rng:random.Random) -> dict:
+    """Build a record for the Aardvark schema."""
+
+    common = _common(i, rng)
+    return {
+        "id": common['uid'],
+        "dc_identifier_s": common['uid'],
+        "layer_slug_s": common['uid'],
+        "gbl_mdVersion_s": "Aardvark",
+        "dct_title_s": common['title'],
+        "dct_description_sm": [common['description']],
+        "dct_accessRights_s": rng.choice(["Public", "Restricted"]),
+        "gbl_resourceClass_sm": [rng.choice(["Datasets", "Maps", "Imagery"])],
+        "gbl_resourceType_sm": [rng.choice(["Point data", "Line data", "Polygon data", "Raster data"])],
+        "schema_provider_s": "{} County".format(common['county']),
+        "dct_creator_sm": ["{} County Land Information Office".format(common['county'])],
+        "dct_publisher_sm": ["{} County".format(common['county'])],
+        "dct_language_sm": ["eng"],
+        "dct_subject_sm": common['keywords'],
+        "dct_spatial_sm": ["{} County, Wisconsin".format(common['county'])],
+        "dct_temporal_sm": [str(common['year'])],
+        "gbl_indexYear_im": [common['year']],
+        "dct_isPartOf_sm": [rng.choice(["Statewide", "County Data", "Historic"])],
+        "dct_format_s": rng.choice(["Shapefile", "GeoTIFF", "File geodatabase"]),
+        "dct_references_s": common['references'],
+        "locn_geometry": common['envelope'],
+        "dcat_bbox": common['envelope'],
+        "gbl_mdModified_dt": common['modified'],
+        "gbl_suppressed_b": False
+    }
+
+def make_record(schema_name:str, i:int, rng:random.Random) -> dict:
+    """Build record number i for a schema."""
+
+    if schema_name not in SCHEMAS:
+        raise ValueError("Unknown schema '{}'; choose from {}.".format(schema_name, ", ".join(SCHEMAS)))
+    return aardvark_record(i, rng) if schema_name == "geoblacklight-aardvark" else gbl1_record(i, rng)
+
+def write_corpus(out_dir:str, schema_name:str, count:int, seed:int = 0) -> list[str]:
+    """Write a corpus of JSON files, replacing out_dir, and return the file paths."""
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    rng = random.Random("{}-{}".format(schema_name, seed))
+
+    filepaths = []
+    for i in range(count):
+        folder = os.path.join(out_dir, "{:04d}".format(i // FOLDER_SIZE))
+        if i % FOLDER_SIZE == 0:
+            os.makedirs(folder)
+        filepath = os.path.join(folder, "bench-{:07d}.json".format(i))
+        with open(filepath, "w", encoding="utf8") as f:
+            json.dump(make_record(schema_name, i, rng), f, indent=2)
+        filepaths.append(filepath)
+
+    return filepaths
+
+def corpus(cache_dir:str, schema_name:str, count:int, seed:int = 0) -> str:
+    """Return a corpus folder inside cache_dir, writing it only if it does not exist yet."""
+
+    out_dir = os.path.join(cache_dir, "{}-{}-{}".format(schema_name, count, seed))
+    marker = os.path.join(out_dir, ".complete")
+    if not os.path.exists(marker):
+        write_corpus(out_dir, schema_name, count, seed)
+        open(marker, "w").close()
+    return out_dir
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate synthetic GeoBlacklight records.")
+    parser.add_argument("out_dir", help="Folder to write records to; replaced if it exists.")
+    parser.add_argument("--schema", choices=SCHEMAS, default=SCHEMAS[0], help="Metadata schema of the records.")
+    parser.add_argument("--count", type=int, default=10000, help="Number of records.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--check", action="store_true", help="Validate every record against its schema after writing.")
+    args = parser.parse_args()
+
+    filepaths = write_corpus(args.out_dir, args.schema, args.count, args.seed)
+    print("Wrote {} records to '{}'.".format(len(filepaths), args.out_dir))
+
+    if args.check:
+        from geodatautils import schema
+
+        validator = schema.get_validator(args.schema)
+        invalid = 0
+        for filepath in filepaths:
+            with open(filepath, encoding="utf8") as f:
+                if schema.schema_errors(json.load(f), validator)[0]:
+                    invalid += 1
+        print("{} invalid record{}.".format(invalid, ("" if invalid==1 else "s")))
+        sys.exit(1 if invalid else 0)
+
+if __name__ == "__main__":
+    main()
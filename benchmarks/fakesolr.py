@@ -0,0 +1,288 @@
+"""Fake Solr
+
+A small in-memory stand-in for a Solr core, for running benchmarks offline.
+
+Implements the parts of `/select` and `/update` that Geodata Utils uses:
+`q`/`fq` on `*:*`, `field:*`, `field:value`, `field:"value"`, `field:(a OR b ...)`,
+numeric `field:[a TO b]` ranges and `{!terms f=field}` queries, `rows`, `fl`,
+cursor paging (`cursorMark`) sorted by the unique key or `_version_`, JSON 
+document arrays, delete by query or ID,
+commits, chunked and gzipped request bodies. Every request can be delayed by a
+fixed latency plus random jitter to mimic a remote server.
+
+    python benchmarks/fakesolr.py [--port 8983] [--latency 0.02] [--jitter 0.005]
+"""
+
+
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeSolr:
+    """In-memory documents and the HTTP server that serves them."""
+
+    def __init__(self, port:int = 0, latency:float = 0.0, jitter:float = 0.0, unique_key:str = "layer_slug_s") -> None:
+        """Create the server; call `start` to serve requests in the background.
+
+        Arguments:
+        port (int) -- port to listen on; 0 picks a free port
+        latency (float) -- seconds added to every request
+        jitter (float) -- maximum random seconds added on top of latency
+        unique_key (str) -- unique key field of the fake schema
+        """
+
+        self.latency = latency
+        self.jitter = jitter
+        self.unique_key = unique_key
+        self.docs = {}
+        self.version = 0
+        self.requests = []  # (method, path, seconds) for every request
+        self.lock = threading.Lock()
+        self._sorted_keys = None  # Sorted unique keys, rebuilt after updates
+        self._uid_index = None  # UID to unique keys, rebuilt after updates
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        """Core URL to put in a Solr instance config."""
+        return "http://127.0.0.1:{}/solr/bench/".format(self.httpd.server_address[1])
+
+    def start(self) -> "FakeSolr":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self) -> None:
+        """Remove all documents and forget logged requests."""
+        with self.lock:
+            self.docs = {}
+            self._sorted_keys = None
+            self.requests = []
+
+    def select(self, parameters:dict) -> dict:
+        """Run a select request."""
+
+        queries = [q for q in parameters.get('q', ['*:*']) + parameters.get('fq', []) if q and q != '*:*']
+        rows = int(parameters.get('rows', ['10'])[0] or 10)
+        fields = parameters.get('fl', [None])[0]
+        sort = parameters.get('sort', [""])[0] or ""
+        cursor_mark = parameters.get('cursorMark', [None])[0]
+
+        with self.lock:
+            if self._sorted_keys is None:
+                self._sorted_keys = sorted(self.docs)
+                self._uid_index = {}
+                for key, doc in self.docs.items():
+                    self._uid_index.setdefault(doc.get('dc_identifier_s'), []).append(key)
+
+            # Look up keys or UIDs directly instead of scanning every document
+            lookup = _key_lookup(queries[0]) if queries else None
+            if lookup and lookup[0] in (self.unique_key, 'dc_identifier_s'):
+                field, values = lookup
+                if field == self.unique_key:
+                    keys = sorted(value for value in values if value in self.docs)
+                else:
+                    keys = sorted(key for value in values for key in self._uid_index.get(value, []))
+                queries = queries[1:]
+            else:
+                keys = self._sorted_keys
+            docs = [doc for doc in (self.docs[key] for key in keys) if all(_matches(doc, q) for q in queries)]
+
+        if sort.startswith("_version_ desc"):
+            docs.sort(key=lambda doc: -doc['_version_'])
+        elif sort.startswith("_version_ asc"):
+            docs.sort(key=lambda doc: doc['_version_'])
+
+        # Cursor marks are offsets into the sorted results
+        start = 0 if cursor_mark in (None, "*") else int(cursor_mark)
+        page = docs[start:start+rows]
+        if fields:
+            field_list = fields.split(",")
+            page = [{key: value for key, value in doc.items() if key in field_list} for doc in page]
+
+        response = {'responseHeader': {'status': 0}, 'response': {'numFound': len(docs), 'start': start, 'docs': page}}
+        if cursor_mark is not None:
+            response['nextCursorMark'] = str(start + len(page)) if page else cursor_mark
+        return response
+
+    def update(self, body:bytes) -> dict:
+        """Run an update request."""
+
+        command = json.loads(body) if body.strip() else []
+
+        with self.lock:
+            if isinstance(command, list):
+                for doc in command:
+                    self.version += 1
+                    self.docs[doc[self.unique_key]] = dict(doc, _version_=self.version)
+                self._sorted_keys = None
+            elif 'delete' in command:
+                deletes = command['delete'] if isinstance(command['delete'], list) else [command['delete']]
+                for delete in deletes:
+                    if isinstance(delete, str):
+                        self.docs.pop(delete, None)
+                    elif 'id' in delete:
+                        self.docs.pop(delete['id'], None)
+                    elif 'query' in delete:
+                        for key in [key for key, doc in self.docs.items() if _matches(doc, delete['query'])]:
+                            del self.docs[key]
+                self._sorted_keys = None
+
+        return {'responseHeader': {'status': 0}}
+
+def _handler(solr:FakeSolr) -> type:
+    """Build an HTTP request handler class bound to a fake Solr."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            self.handle_request(b"")
+
+        def do_POST(self) -> None:
+            self.handle_request(self.read_body())
+
+        def read_body(self) -> bytes:
+            if self.headers.get('Transfer-Encoding') == 'chunked':
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        break
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+                body = b"".join(chunks)
+            else:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return body
+
+        def handle_request(self, body:bytes) -> None:
+            start = time.perf_counter()
+            url = urlparse(self.path)
+
+            # Parameters from the URL and from form bodies
+            parameters = {}
+            pairs = parse_qsl(url.query)
+            if self.headers.get('Content-Type', "").startswith("application/x-www-form-urlencoded"):
+                pairs += parse_qsl(body.decode())
+            for key, value in pairs:
+                parameters.setdefault(key, []).append(value)
+
+            if solr.latency or solr.jitter:
+                time.sleep(solr.latency + random.uniform(0, solr.jitter))
+
+            path = url.path.rstrip("/")
+            if path.endswith("/select"):
+                self.reply(200, solr.select(parameters))
+            elif path.endswith("/update"):
+                self.reply(200, solr.update(body))
+            else:
+                self.reply(404, {'error': "Unknown path '{}'".format(url.path)})
+
+            with solr.lock:
+                solr.requests.append((self.command, path.rsplit("/", 1)[-1], time.perf_counter() - start))
+
+        def reply(self, status:int, body:dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format:str, *args) -> None:
+            pass
+
+    return Handler
+
+def _key_lookup(query:str):
+    """Return the field and values of a terms or OR'ed query, else None."""
+
+    match = re.match(r'\{!terms f=(\w+)(?: separator="(.)")?\}(.*)$', query, re.S)
+    if match:
+        return match.group(1), set(match.group(3).split(match.group(2) or ","))
+
+    match = re.match(r'(\w+):\((.*)\)$', query, re.S)
+    if match:
+        return match.group(1), {_unquote(value) for value in re.findall(r'"(?:[^"\\]|\\.)*"|[^\s()]+', match.group(2)) if value != "OR"}
+
+    return None
+
+def _matches(doc:dict, query:str) -> bool:
+    """Check a document against a simple field query."""
+
+    if query == "*:*":
+        return True
+
+    match = re.match(r'\{!terms f=(\w+)(?: separator="(.)")?\}(.*)$', query, re.S)
+    if match:
+        return str(doc.get(match.group(1))) in match.group(3).split(match.group(2) or ",")
+
+    match = re.match(r'(\w+):\((.*)\)$', query, re.S)
+    if match:
+        values = [_unquote(value) for value in re.findall(r'"(?:[^"\\]|\\.)*"|[^\s()]+', match.group(2)) if value != "OR"]
+        return any(str(value) in values for value in _values(doc, match.group(1)))
+
+    match = re.match(r'(\w+):([\[{])(\S+) TO (\S+)([\]}])$', query)
+    if match:
+        field, lower_bracket, lower, upper, upper_bracket = match.groups()
+        value = doc.get(field)
+        if value is None:
+            return False
+        above = lower == "*" or (value >= _number(lower) if lower_bracket == "[" else value > _number(lower))
+        below = upper == "*" or (value <= _number(upper) if upper_bracket == "]" else value < _number(upper))
+        return above and below
+
+    match = re.match(r'(\w+):\*$', query)
+    if match:
+        return any(value is not None for value in _values(doc, match.group(1)))
+
+    match = re.match(r'(\w+):(.*)$', query, re.S)
+    if match:
+        return _unquote(match.group(2)) in [str(value) for value in _values(doc, match.group(1))]
+
+    raise ValueError("Unsupported query: {}".format(query))
+
+def _values(doc:dict, field:str) -> list:
+    value = doc.get(field)
+    return value if isinstance(value, list) else [value]
+
+def _number(value:str):
+    return int(value) if value.lstrip("-").isdigit() else float(value)
+
+def _unquote(value:str) -> str:
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return value
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a fake Solr core for benchmarks.")
+    parser.add_argument("--port", type=int, default=8983, help="Port to listen on.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random seconds added on top of latency.")
+    args = parser.parse_args()
+
+    solr = FakeSolr(args.port, args.latency, args.jitter)
+    print("Serving fake Solr at {}".format(solr.url))
+    try:
+        solr.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
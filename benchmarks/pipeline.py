@@ -0,0 +1,281 @@
+"""Pipeline Benchmark
+
+Measure each stage of adding records to Solr against a local fake Solr.
+
+For every schema and corpus size, a synthetic corpus is generated (and kept in
+`benchmarks/.corpus` for later runs) and these stages are timed:
+
+    load          open and decode files (`loader.load_json_files`)
+    validate      schema validation (`schema.validate_records`)
+    error-check   configured error checks (`schema.check_records`)
+    query-chunks  split UIDs into URI sized queries (`Solr.build_query_chunks`)
+    upload        post documents to Solr (`manage.upload_records`)
+    uid-lookup    look up existing UIDs in Solr (`Solr.find_by_uid`)
+    add           the whole `manage.add`, as run by `update_solr -a`
+
+Each stage reports throughput in records per second, p50 and p99 latency and
+the peak resident memory of the process while it ran. Latency is per batch of
+records for local stages and per HTTP request for Solr stages. The validation
+cache is turned off so every run does the same work.
+
+    python benchmarks/pipeline.py [--schemas geoblacklight-1-wisc] [--sizes 1000 10000] [--latency 0.005] [--json results.json]
+"""
+
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Run against this checkout even if geodatautils is not installed
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from corpus import corpus, SCHEMAS
+from fakesolr import FakeSolr
+
+
+STAGES = ("load", "validate", "error-check", "query-chunks", "upload", "uid-lookup", "add")
+
+# Name of the Solr instance added to the config for the fake Solr
+INSTANCE = "benchmark"
+
+
+class MemorySampler:
+    """Track the peak resident memory of this process in a background thread."""
+
+    def __init__(self, interval:float = 0.005) -> None:
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def rss(self) -> int:
+        """Current resident memory in bytes."""
+
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:  # Not Linux; fall back to the lifetime peak
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    def sample(self) -> None:
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self) -> "MemorySampler":
+        self.peak = self.rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+
+class Stage:
+    """Timing results of one stage."""
+
+    def __init__(self, name:str, records:int) -> None:
+        self.name = name
+        self.records = records
+        self.latencies = []
+        self.seconds = 0.0
+        self.peak_rss = 0
+
+    @contextmanager
+    def timed(self):
+        """Time one unit of work (a batch or request) within the stage."""
+        start = time.perf_counter()
+        yield
+        self.latencies.append(time.perf_counter() - start)
+
+    def percentile(self, q:float) -> float:
+        if not self.latencies:
+            return 0.0
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        return statistics.quantiles(self.latencies, n=100, method="inclusive")[int(q) - 1]
+
+    def to_dict(self) -> dict:
+        return {
+            'stage': self.name,
+            'records': self.records,
+            'seconds': round(self.seconds, 4),
+            'records_per_second': round(self.records / self.seconds, 1) if self.seconds else None,
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+            'units': len(self.latencies),
+            'peak_rss_mb': round(self.peak_rss / 1024 / 1024, 1)
+        }
+
+@contextmanager
+def run_stage(name:str, records:int, results:list):
+    """Run a stage, measuring wall time and peak memory."""
+
+    stage = Stage(name, records)
+    with MemorySampler() as memory:
+        start = time.perf_counter()
+        yield stage
+        stage.seconds = time.perf_counter() - start
+    stage.peak_rss = memory.peak
+    results.append(stage)
+
+def time_requests(solr, stage:Stage) -> None:
+    """Record the latency of every request a Solr object sends."""
+
+    request = solr.request
+
+    def timed_request(*args, **kwargs):
+        with stage.timed():
+            return request(*args, **kwargs)
+
+    solr.request = timed_request
+
+def benchmark(schema_name:str, size:int, fake_solr:FakeSolr, stages:list[str], cache_dir:str) -> list[Stage]:
+    """Run the stages for one schema and corpus size."""
+
+    from geodatautils import get_config, manage, schema
+    config = get_config()
+    from geodatautils.helpers import chunked, create_file_list, RecordSet
+    from geodatautils.loader import load_json_files
+    from geodatautils.solr import Solr
+
+    in_dir = corpus(cache_dir, schema_name, size)
+    file_list = create_file_list(in_dir)
+    batch_size = config.get('upload', {}).get('batch-size', 1000)
+    workers = config.get('loading', {}).get('workers', 8)
+    results = []
+    fake_solr.reset()
+
+    # Load records; later stages use them
+    record_set = RecordSet()
+    with run_stage("load", size, results) as stage:
+        loaded = iter(load_json_files(file_list, workers=workers, ordered=True))
+        for _ in range(0, size, batch_size):
+            with stage.timed():
+                for filepath, data in [next(loaded) for _ in range(min(batch_size, size - len(record_set.records)))]:
+                    record_set.add_record(data, filepath)
+    records = list(record_set.records.values())
+    uids = list(record_set.records.keys())
+    if "load" not in stages:
+        results.pop()
+
+    if "validate" in stages:
+        with run_stage("validate", size, results) as stage:
+            for batch in chunked(records, batch_size):
+                with stage.timed():
+                    schema.validate_records(batch, schema_name)
+
+    if "error-check" in stages:
+        logging.disable(logging.DEBUG)  # check_records logs every file name at debug level
+        with run_stage("error-check", size, results) as stage:
+            for batch in chunked(records, batch_size):
+                with stage.timed():
+                    schema.check_records(batch)
+        logging.disable(logging.NOTSET)
+
+    solr = Solr(INSTANCE)
+
+    if "query-chunks" in stages:
+        quoted = ['"{}"'.format(uid) for uid in uids]
+        with run_stage("query-chunks", size, results) as stage:
+            for batch in chunked(quoted, batch_size):
+                with stage.timed():
+                    solr.build_query_chunks(batch, solr.max_uri_size)
+
+    if "upload" in stages or "uid-lookup" in stages:
+        for record in records:
+            record.release()
+        with run_stage("upload", size, results) as stage:
+            time_requests(solr, stage)
+            manage.upload_records(solr, records)
+        if "upload" not in stages:
+            results.pop()
+
+    if "uid-lookup" in stages:
+        solr = Solr(INSTANCE)
+        with run_stage("uid-lookup", size, results) as stage:
+            time_requests(solr, stage)
+            found = solr.find_by_uid(uids)
+        if len(found) != size:
+            raise RuntimeError("Found {} of {} uploaded records.".format(len(found), size))
+
+    if "add" in stages:
+        fake_solr.reset()
+        solr = Solr(INSTANCE)
+        with run_stage("add", size, results) as stage:
+            time_requests(solr, stage)
+            uploaded = manage.add(in_dir, INSTANCE, metadata_schema=schema_name, use_cache=False, solr=solr)
+        if not uploaded:
+            raise RuntimeError("manage.add did not upload the {} corpus; check geodatautils.log.".format(schema_name))
+
+    return results
+
+def configure(fake_solr:FakeSolr, schema_name:str) -> None:
+    """Point the config at the fake Solr and set checks that fit the schema."""
+
+    from geodatautils import get_config, schema
+    config = get_config()
+
+    config['solr instances'][INSTANCE] = {'url': fake_solr.url, 'username': "", 'password': "", 'retries': 0}
+    config.setdefault('cache', {})['enabled'] = False
+
+    # The default not-null check lists GeoBlacklight 1.0 fields
+    if schema_name == "geoblacklight-aardvark":
+        config['error-checks']['properties-not-null'] = schema.load_schema(schema_name)['required']
+
+def print_results(schema_name:str, size:int, results:list[Stage]) -> None:
+    print("\n{} x {:,}".format(schema_name, size))
+    print("  {:<14}{:>12}{:>14}{:>11}{:>11}{:>8}{:>11}".format("stage", "seconds", "records/s", "p50 ms", "p99 ms", "units", "peak MB"))
+    for stage in results:
+        result = stage.to_dict()
+        print("  {:<14}{:>12.3f}{:>14,.0f}{:>11.2f}{:>11.2f}{:>8}{:>11.1f}".format(result['stage'], result['seconds'], result['records_per_second'] or 0, result['p50_ms'], result['p99_ms'], result['units'], result['peak_rss_mb']))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the stages of adding records to Solr against a local fake Solr.")
+    parser.add_argument("--schemas", nargs="+", choices=SCHEMAS, default=[SCHEMAS[0]], help="Schemas of the synthetic corpora.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000], help="Corpus sizes, e.g. 1000 10000 100000.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Stages to run.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake Solr adds to every request.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random seconds added on top of latency.")
+    parser.add_argument("--cache-dir", default=os.path.join(ROOT, "benchmarks", ".corpus"), help="Folder generated corpora are kept in.")
+    parser.add_argument("--json", help="Also write results to this JSON file.")
+    args = parser.parse_args()
+
+    from geodatautils import get_config
+    config = get_config()
+
+    # Keep benchmark output readable
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fake_solr = FakeSolr(latency=args.latency, jitter=args.jitter).start()
+    error_checks = dict(config['error-checks'])
+    output = []
+
+    try:
+        for schema_name in args.schemas:
+            config['error-checks'] = dict(error_checks)
+            configure(fake_solr, schema_name)
+            for size in args.sizes:
+                results = benchmark(schema_name, size, fake_solr, args.stages, args.cache_dir)
+                print_results(schema_name, size, results)
+                output.append({'schema': schema_name, 'size': size, 'latency': args.latency, 'stages': [stage.to_dict() for stage in results]})
+    finally:
+        fake_solr.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+
+if __name__ == "__main__":
+    main()
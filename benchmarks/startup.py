@@ -0,0 +1,108 @@
+"""Startup Benchmark
+
+Time how long the command line tools take to start and guard against regressions.
+
+Runs `update_solr --help`, `gu_config --help` and `geodata_utils --help` in fresh
+interpreters and reports the median wall time of each. It also checks that
+importing `geodatautils.interfaces` does not load the config or import heavy
+modules, which is what keeps `--help` fast, and that importing the tool modules
+as a library does not load the config. Exits with status 1 if a check fails.
+
+    python benchmarks/startup.py [--runs 10] [--max-ms 200]
+"""
+
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Modules that must not be imported just to build the command line parsers
+HEAVY_MODULES = ["yaml", "requests", "jsonschema", "geodatautils.manage", "geodatautils.schema", "geodatautils.solr"]
+
+# Modules imported by library users, which must not load the config on import
+TOOL_MODULES = ["geodatautils.manage", "geodatautils.plan", "geodatautils.schema", "geodatautils.export", "geodatautils.serve", "geodatautils.journal", "geodatautils.uid_index"]
+
+# Entry points to time, as code run with `python -c`
+ENTRY_POINTS = {
+    "update_solr --help": "import sys; sys.argv = ['update_solr', '--help']; from geodatautils.interfaces import update_solr; update_solr()",
+    "gu_config --help": "import sys; sys.argv = ['gu_config', '--help']; from geodatautils.interfaces import gu_config; gu_config()",
+    "geodata_utils --help": "import sys; sys.argv = ['geodata_utils', '--help']; from geodatautils.interfaces import geodata_utils; geodata_utils()",
+}
+
+# Repository root, so the benchmark runs against this checkout
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code:str, *options:str) -> subprocess.CompletedProcess:
+    """Run code in a fresh interpreter from the repository root."""
+    return subprocess.run([sys.executable, *options, "-c", code], cwd=ROOT, capture_output=True, text=True)
+
+def time_entry_point(code:str, runs:int) -> float:
+    """Return the median wall time of an entry point in milliseconds."""
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = run(code)
+        times.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr)
+    return statistics.median(times)
+
+def import_time() -> float:
+    """Return the cumulative import time of `geodatautils.interfaces` in milliseconds, from `-X importtime`."""
+
+    result = run("import geodatautils.interfaces", "-X", "importtime")
+    for line in result.stderr.splitlines():
+        if line.rstrip().endswith("| geodatautils.interfaces"):
+            return int(line.split("|")[1]) / 1000
+    raise RuntimeError("geodatautils.interfaces not found in import time output:\n" + result.stderr)
+
+def heavy_imports() -> list[str]:
+    """Return heavy modules and attributes that are loaded by importing the interfaces."""
+
+    code = "import sys, geodatautils.interfaces, geodatautils; print(' '.join([m for m in {} if m in sys.modules] + (['config'] if geodatautils._config is not None else [])))".format(HEAVY_MODULES)
+    return run(code).stdout.split()
+
+def config_loaded_by_tools() -> bool:
+    """Return True if importing the tool modules loads the config."""
+
+    code = "import geodatautils, {}; print(geodatautils._config is not None)".format(", ".join(TOOL_MODULES))
+    result = run(code)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return result.stdout.strip() == "True"
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time the startup of the Geodata Utils command line tools.")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs per entry point.")
+    parser.add_argument("--max-ms", type=float, help="Fail if the median time of an entry point is above this many milliseconds.")
+    args = parser.parse_args()
+
+    failed = False
+
+    # Heavy modules and config must stay lazy
+    loaded = heavy_imports()
+    print("Import geodatautils.interfaces: {:.1f} ms".format(import_time()))
+    if loaded:
+        print("  FAIL: loaded at import: {}".format(", ".join(loaded)))
+        failed = True
+    if config_loaded_by_tools():
+        print("  FAIL: importing the tool modules loads the config")
+        failed = True
+
+    # Time each entry point
+    for name, code in ENTRY_POINTS.items():
+        median = time_entry_point(code, args.runs)
+        over = args.max_ms is not None and median > args.max_ms
+        print("{:<24} {:7.1f} ms{}".format(name, median, "  FAIL: over {:.0f} ms".format(args.max_ms) if over else ""))
+        failed = failed or over
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -10,25 +10,65 @@ __license__ = "GPL-3"
 
 
 import os
-import logging
-import logging.config
+import threading
+import warnings
 from importlib.resources import files
 
-import yaml
-
-from . import config_tools
-
 
 # Set config path
 config_path = files('geodatautils.config').joinpath('config.yml')
 
-# Confirm config exists, if not initiate config
-if not os.path.exists(config_path):
-    config_tools.init()
+# Importing the `config` subpackage above sets it as an attribute of this
+# package; remove it so the old `config` attribute is served by `__getattr__`
+del config
+
+# Loaded config, set by the first call to `get_config`
+_config = None
+
+# Guards loading the config from several threads at once
+_config_lock = threading.Lock()
+
+
+def get_config() -> dict:
+    """Return the config, reading it and configuring logging on first use.
+
+    Nothing is read when the package is imported, so importing it (e.g. to 
+    print `--help`) stays fast and has no side effects. If there is no config 
+    file yet, one is created from the template. Later calls return the same 
+    dict, so changes made to it apply to the rest of the run.
+    """
+
+    global _config
+
+    with _config_lock:
+        if _config is not None:
+            return _config
+
+        import logging.config
+        import yaml
+        from . import config_tools
+
+        # Confirm config exists, if not initiate config
+        created = not os.path.exists(config_path)
+        if created:
+            config_tools.init(edit=False)
+
+        # Read in Config
+        with open(config_path, 'r') as f:
+            loaded = yaml.safe_load(f.read())
+
+        # Config logging
+        logging.config.dictConfig(loaded['log'])
+        if created:
+            logging.warning("Created a config file from the template at '{}'; run `gu_config -e` to set up Solr instances.".format(config_path))
 
-# Read in Config
-with open(config_path, 'r') as f:
-    config = yaml.safe_load(f.read())
+        _config = loaded
+        return _config
 
-# Config logging
-logging.config.dictConfig(config['log'])
\ No newline at end of file
+def __getattr__(name:str):
+    # Keep `geodatautils.config` working for existing code, which read the
+    # config that way before `get_config`
+    if name == 'config':
+        warnings.warn("geodatautils.config is deprecated; use geodatautils.get_config() instead.", DeprecationWarning, stacklevel=2)
+        return get_config()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,136 @@
+"""Validation Cache
+
+Persist validation results on disk so unchanged files are not validated again.
+"""
+
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from importlib.metadata import version
+from typing import Union
+
+from .helpers import Record
+from .logging_config import LogFormat
+
+
+# Bump when schema validation or error check logic (`schema`, `validation`, 
+# `checks`) changes what is reported, so cached results are checked again
+RESULTS_VERSION = 1
+
+
+class ValidationCache:
+    """An on-disk cache of schema validation and error check results.
+
+    Entries are keyed by the content hash of a file combined with a context
+    hash of everything else that affects the result: the schema name and
+    contents, the error check config, `RESULTS_VERSION` and the jsonschema 
+    version. Changing any of them invalidates the cache. When the cache grows past `max_size` bytes the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, path:str, context:str, max_size:int = 100*1024*1024) -> None:
+        """Open (or create) the cache database at path.
+
+        Arguments:
+        path (str) -- path of the cache database file
+        context (str) -- hash of the settings results depend on; see `context_hash`
+        max_size (int) -- maximum size of cached results in bytes
+        """
+
+        self.path = os.path.expanduser(path)
+        self.context = context
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+        # Open database
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+
+    @staticmethod
+    def context_hash(schema_name:str, schema:dict, error_checks:dict) -> str:
+        """Hash the settings that validation results depend on."""
+
+        context = json.dumps([RESULTS_VERSION, version("jsonschema"), schema_name, schema, error_checks], sort_keys=True)
+        return hashlib.sha256(context.encode()).hexdigest()
+
+    def key(self, digest:str) -> str:
+        """Build the cache key for a file content hash."""
+
+        return hashlib.sha256((self.context + digest).encode()).hexdigest()
+
+    def restore(self, record:Record, digest:str) -> Union[bool, None]:
+        """Add cached errors and warnings to a record.
+
+        Returns:
+        invalid (bool|None) -- True if the cached result was invalid, False if
+            valid, or None if the file is not in the cache
+        """
+
+        key = self.key(digest)
+        row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        self.connection.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        value = json.loads(row[0])
+        for label, msg, debug in value['errors']:
+            record.add_error(label, msg, debug)
+        for label, msg, debug in value['warnings']:
+            record.add_warning(label, msg, debug)
+
+        return value['invalid']
+
+    def store(self, record:Record, digest:str, invalid:bool) -> None:
+        """Store the errors and warnings of a freshly checked record."""
+
+        value = json.dumps({
+            'invalid': invalid,
+            'errors': [(error.label, error.msg, error.debug) for error in record.errors],
+            'warnings': [(warning.label, warning.msg, warning.debug) for warning in record.warnings]
+        })
+
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (self.key(digest), value, len(value), time.time()))
+        self.stats['writes'] += 1
+
+    def commit(self) -> None:
+        """Write pending changes and evict old entries if over size."""
+
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+        # Evict least recently used entries down to 90% of max size
+        if total_size > self.max_size:
+            target = total_size - int(self.max_size * 0.9)
+            evicted = 0
+            removed = 0
+            for key, size in self.connection.execute("SELECT key, size FROM results ORDER BY accessed").fetchall():
+                if removed >= target:
+                    break
+                self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                removed += size
+                evicted += 1
+            self.stats['evictions'] += evicted
+
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Commit and close the cache."""
+
+        self.commit()
+        self.connection.close()
+
+    def log_stats(self, indent:int = 1) -> None:
+        """Log a summary of cache use."""
+
+        size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        logging.info("Validation cache: {} hit{}, {} miss{}".format(self.stats['hits'], ("" if self.stats['hits']==1 else "s"), self.stats['misses'], ("" if self.stats['misses']==1 else "es")), extra={'indent': LogFormat.indent(indent)})
+        logging.debug("{} written, {} evicted, {} entries ({:.1f} MB) in '{}'".format(self.stats['writes'], self.stats['evictions'], size[0], size[1]/1024/1024, self.path), extra={'indent': LogFormat.indent(indent+1)})
@@ -0,0 +1,206 @@
+"""Error Checks
+
+Rule-based error checks that run over a whole batch of records at once.
+
+Each rule looks at one or more columns of a `RecordBatch`, a columnar view of
+the records with one list of values per field, and reports the rows that fail.
+Rules are compiled from the `error-checks` section of the config once and
+reused for every batch.
+"""
+
+
+import json
+import re
+from functools import lru_cache
+from typing import Iterator, Union
+
+from .helpers import Record
+
+
+# Placeholder for a field that is not in a record
+MISSING = object()
+
+# Values that count as empty
+EMPTY_VALUES = ["", [], [""]]
+
+# Failure reported by a rule: row index, message and debug message. Messages
+# can be (format, *args) tuples that are formatted only when read; see `Error`.
+Failure = tuple[int, Union[str, tuple], Union[str, tuple, None]]
+
+
+class RecordBatch:
+    """Columnar view of a list of records.
+
+    Columns are built on first use, so each field is extracted once per batch no
+    matter how many rules use it.
+    """
+
+    def __init__(self, records:list[Record]) -> None:
+        self.records = records
+        self._columns = {}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def column(self, field:str) -> list:
+        """Return the values of a field for every record, `MISSING` if absent."""
+
+        if field not in self._columns:
+            self._columns[field] = [record.data.get(field, MISSING) for record in self.records]
+        return self._columns[field]
+
+    def present(self, *fields:str) -> list[int]:
+        """Return the rows where all fields are present and not empty."""
+
+        columns = [self.column(field) for field in fields]
+        return [i for i, values in enumerate(zip(*columns)) if all(value is not MISSING and value not in EMPTY_VALUES for value in values)]
+
+class Rule:
+    """Base class for an error check that runs over a batch of records."""
+
+    label = ""
+
+    def check(self, batch:RecordBatch) -> Iterator[Failure]:
+        """Yield a failure for every row of the batch that fails the check."""
+        raise NotImplementedError
+
+class NotNull(Rule):
+    """Fields must be present and not empty."""
+
+    label = 'properties-not-null'
+
+    def __init__(self, fields:list[str]) -> None:
+        self.fields = fields
+
+    def check(self, batch:RecordBatch) -> Iterator[Failure]:
+        for field in self.fields:
+            for i, value in enumerate(batch.column(field)):
+                if value is MISSING:
+                    yield i, ("Required field '{}' was not found.", field), None
+                elif value in EMPTY_VALUES:
+                    yield i, ("'{}' is empty", field), ("{}: {} (\"\", [], and [\"\"] are considered empty)", field, value)
+
+class FieldsMatch(Rule):
+    """Two fields must have the same value when both are present."""
+
+    def __init__(self, label:str, field:str, other_field:str) -> None:
+        self.label = label
+        self.field = field
+        self.other_field = other_field
+
+    def check(self, batch:RecordBatch) -> Iterator[Failure]:
+        values = batch.column(self.field)
+        other_values = batch.column(self.other_field)
+        for i in batch.present(self.field, self.other_field):
+            if values[i] != other_values[i]:
+                yield i, "'{}' and '{}' do not match".format(self.field, self.other_field), "'{}', '{}'".format(values[i], other_values[i])
+
+class ContainsYear(Rule):
+    """A text field (or any item of a list field) must contain `solr_year_i`."""
+
+    def __init__(self, label:str, field:str, year_field:str = 'solr_year_i') -> None:
+        self.label = label
+        self.field = field
+        self.year_field = year_field
+
+    def values(self, value) -> list[str]:
+        """Return the strings of a field value to search for the year."""
+        return [str(item) for item in value] if isinstance(value, list) else [str(value)]
+
+    def check(self, batch:RecordBatch) -> Iterator[Failure]:
+        values = batch.column(self.field)
+        years = batch.column(self.year_field)
+        for i in batch.present(self.field, self.year_field):
+            year = str(years[i])
+            searched = self.values(values[i])
+            if searched and not any(year in text for text in searched):
+                yield i, "'{}' does not contain {} '{}'".format(self.field, self.year_field, year), "{}: {}".format(self.field, values[i])
+
+class ReferencesContainYear(ContainsYear):
+    """The download URL in `dct_references_s` must contain `solr_year_i`."""
+
+    download_key = 'http://schema.org/downloadUrl'
+
+    def __init__(self, label:str) -> None:
+        super().__init__(label, 'dct_references_s')
+
+    def values(self, value) -> list[str]:
+        try:
+            references = json.loads(value)
+        except (TypeError, ValueError):
+            return []
+        url = references.get(self.download_key) if isinstance(references, dict) else None
+        return [str(url)] if url else []
+
+class EnvelopeValid(Rule):
+    """`solr_geom` must be an ENVELOPE(W,E,N,S) with coordinates in range."""
+
+    label = 'solr-geom-valid'
+    envelope = re.compile(r"^\s*ENVELOPE\(\s*([^,]+),\s*([^,]+),\s*([^,]+),\s*([^,)]+)\)\s*$")
+
+    def __init__(self, field:str = 'solr_geom') -> None:
+        self.field = field
+
+    def check(self, batch:RecordBatch) -> Iterator[Failure]:
+        values = batch.column(self.field)
+        for i in batch.present(self.field):
+            match = self.envelope.match(str(values[i]))
+            try:
+                west, east, north, south = map(float, match.groups()) if match else (None,)*4
+            except ValueError:
+                west = None
+            if west is None:
+                yield i, "'{}' is not a valid ENVELOPE(W,E,N,S)".format(self.field), "{}: {}".format(self.field, values[i])
+            elif not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+                yield i, "'{}' coordinates are out of range".format(self.field), "{}: {}".format(self.field, values[i])
+
+def compile_rules(error_checks:dict) -> list[Rule]:
+    """Build the rules that are turned on in an `error-checks` config section.
+
+    The order of the rules is the order errors are reported for each record.
+    """
+
+    rules = []
+
+    fields = error_checks.get('properties-not-null')
+    if type(fields) == list:
+        rules.append(NotNull(fields))
+    if error_checks.get('identifier-layer-slug-match'):
+        rules.append(FieldsMatch('identifier-layer-slug-match', 'dc_identifier_s', 'layer_slug_s'))
+    if error_checks.get('temporal-contains-solr-year'):
+        rules.append(ContainsYear('temporal-contains-solr-year', 'dct_temporal_sm'))
+    if error_checks.get('title-contains-solr-year'):
+        rules.append(ContainsYear('title-contains-solr-year', 'dc_title_s'))
+    if error_checks.get('references-contains-solr-year'):
+        rules.append(ReferencesContainYear('references-contains-solr-year'))
+    if error_checks.get('solr-geom-valid'):
+        rules.append(EnvelopeValid())
+
+    return rules
+
+@lru_cache(maxsize=8)
+def _compile_rules_cached(error_checks_json:str) -> tuple[Rule, ...]:
+    return tuple(compile_rules(json.loads(error_checks_json)))
+
+def get_rules(error_checks:dict) -> tuple[Rule, ...]:
+    """Return the compiled rules for a config section, compiling them only once."""
+
+    return _compile_rules_cached(json.dumps(error_checks, sort_keys=True))
+
+def run_checks(records:list[Record], rules:tuple[Rule, ...]) -> None:
+    """Run rules over a batch of records and add failures to the records.
+
+    Errors are added per record in rule order, the same order as checking the
+    records one at a time.
+    """
+
+    batch = RecordBatch(records)
+
+    # Collect failures from every rule, then add them record by record
+    failures = []
+    for rule_index, rule in enumerate(rules):
+        failures.extend((i, rule_index, msg, debug) for i, msg, debug in rule.check(batch))
+    failures.sort(key=lambda failure: (failure[0], failure[1]))
+
+    for i, rule_index, msg, debug in failures:
+        records[i].add_error(rules[rule_index].label, msg, debug)
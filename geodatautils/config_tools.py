@@ -12,11 +12,12 @@ def edit():
     config_path = os.path.join(os.path.dirname(geodatautils.__file__), "config", "config.yml")
     os.system(config_path)
 
-def init():
+def init(edit:bool=True):
     # Copy template
     template_path = os.path.join(os.path.dirname(geodatautils.__file__), "config", "config-template.yml")
     config_path = os.path.join(os.path.dirname(geodatautils.__file__), "config", "config.yml")
     shutil.copyfile(template_path, config_path)
 
     # Open config text editor
-    os.system(config_path)
\ No newline at end of file
+    if edit:
+        os.system(config_path)
\ No newline at end of file
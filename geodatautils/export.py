@@ -0,0 +1,229 @@
+"""Export
+
+Back up a Solr index to compressed, line-delimited JSON shards.
+
+Shards can be added again with `update_solr -a`, so an index can be restored
+from an export after a bad delete.
+"""
+
+
+import datetime
+import gzip
+import hashlib
+import logging
+import os
+from typing import Union
+
+import yaml
+
+from geodatautils import get_config
+from .helpers import SOLR_MANAGED_FIELDS
+from .logging_config import LogFormat
+from .metrics import metrics
+from .serialize import dumps
+from .solr import Solr
+
+
+# Name of the manifest written next to the shards; not a JSON file, so `update_solr -a` skips it
+MANIFEST_NAME = "manifest.yml"
+
+# File extension of shards for each compression
+SHARD_EXTENSIONS = {'gzip': ".jsonl.gz", 'zstd': ".jsonl.zst"}
+
+
+class _HashingFile:
+    """Binary file that hashes and counts the bytes written to it."""
+
+    def __init__(self, path:str) -> None:
+        self.file = open(path, "wb")
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data:bytes) -> int:
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+class ShardWriter:
+    """Write lines to compressed shards, starting a new shard once one reaches
+    a size limit.
+
+    Shards are written under a `.part` name and renamed once complete, so an
+    interrupted export never leaves a truncated shard that looks finished.
+    """
+
+    def __init__(self, out_dir:str, prefix:str, max_bytes:int, compression:str = "gzip") -> None:
+        """Arguments:
+        out_dir (str) -- folder to write shards to
+        prefix (str) -- start of every shard file name
+        max_bytes (int) -- compressed size at which a shard is closed
+        compression (str) -- 'gzip', or 'zstd' which requires zstandard
+        """
+
+        if compression not in SHARD_EXTENSIONS:
+            raise ValueError("Unknown compression '{}'; choose from {}.".format(compression, ", ".join(SHARD_EXTENSIONS)))
+
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.shards = []  # Manifest entry of every finished shard
+        self._file = None
+        self._stream = None
+        self._documents = 0
+
+        # Fail before fetching anything if zstandard is missing
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise SystemExit("zstd compression was selected but zstandard is not installed.")
+            self._compressor = zstandard.ZstdCompressor()
+
+    @property
+    def path(self) -> str:
+        """Path of the shard being written."""
+        return os.path.join(self.out_dir, "{}-{:05d}{}".format(self.prefix, len(self.shards), SHARD_EXTENSIONS[self.compression]))
+
+    def write(self, line:bytes) -> None:
+        """Write one line, which must end with a newline."""
+
+        if self._stream is None:
+            self._open()
+
+        self._stream.write(line)
+        self._documents += 1
+
+        # Sizes lag by what the compressor still buffers, which is small next to a shard
+        if self._file.size >= self.max_bytes:
+            self._close_shard()
+
+    def close(self) -> None:
+        """Finish the last shard."""
+
+        if self._stream is not None:
+            self._close_shard()
+
+    def _open(self) -> None:
+        self._file = _HashingFile(self.path + ".part")
+        if self.compression == "zstd":
+            self._stream = self._compressor.stream_writer(self._file, closefd=False)
+        else:
+            self._stream = gzip.GzipFile(filename="", mode="wb", fileobj=self._file, mtime=0)
+
+    def _close_shard(self) -> None:
+        path = self.path
+        self._stream.close()
+        self._file.close()
+        os.replace(path + ".part", path)
+
+        self.shards.append({
+            'file': os.path.basename(path),
+            'documents': self._documents,
+            'bytes': self._file.size,
+            'sha256': self._file.sha256.hexdigest()
+        })
+        logging.debug("Wrote {} ({} document{}, {:.1f} MB).".format(os.path.basename(path), self._documents, ("" if self._documents==1 else "s"), self._file.size/1024/1024), extra={'indent': LogFormat.indent(1)})
+
+        self._file = None
+        self._stream = None
+        self._documents = 0
+
+def export(solr_instance_name:str, out_dir:str, provenance:Union[str, None]=None, collection:Union[str, None]=None, compression:Union[str, None]=None, shard_size:Union[int, None]=None, solr:Union[Solr, None]=None) -> dict:
+    """Export records from a Solr instance to compressed JSONL shards.
+
+    Documents are paged through with a cursor, and the next page is requested
+    while the current one is written. Fields managed by Solr (`_version_`,
+    `score` and the content fingerprint) are left out so the shards can be
+    added again with `update_solr -a`. A manifest with the query, document
+    counts and a SHA-256 checksum of every shard is written once all shards
+    are complete.
+
+    Arguments:
+    solr_instance_name (str) -- name of a Solr instance in the config
+    out_dir (str) -- folder to write to; created if needed, must be empty
+    provenance (str|None) -- only export records of this provenance
+    collection (str|None) -- only export records in this collection
+    compression (str|None) -- 'gzip' or 'zstd'; defaults to config
+    shard_size (int|None) -- compressed bytes per shard; defaults to config
+    solr (Solr|None) -- an already connected Solr object to reuse
+
+    Returns:
+    manifest (dict) -- contents of the manifest
+    """
+
+    # Get export settings
+    config = get_config()
+    if compression is None:
+        compression = config.get('export', {}).get('compression', 'gzip')
+    if shard_size is None:
+        shard_size = config.get('export', {}).get('shard-size', 256*1024*1024)
+    page_size = config.get('export', {}).get('page-size', 1000)
+    backend = config.get('upload', {}).get('json-backend', 'auto')
+
+    # Refuse to mix shards of different exports
+    if os.path.isdir(out_dir) and os.listdir(out_dir):
+        logging.critical("Export folder '{}' is not empty.".format(out_dir))
+        raise SystemExit
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Initialize solr instance
+    if solr is None:
+        solr = Solr(solr_instance_name)
+
+    # Build scope of export
+    filter_queries = []
+    if provenance:
+        filter_queries.append('dct_provenance_s:"{}"'.format(provenance))
+    if collection:
+        filter_queries.append('dct_isPartOf_sm:"{}"'.format(collection))
+    filter_query = " AND ".join(filter_queries) or None
+
+    # Get number of records
+    with metrics.stage('count'):
+        raw_response = solr.select(fq=filter_query, rows=0)
+    raw_response.raise_for_status()
+    num_found = raw_response.json()['response']['numFound']
+
+    logging.info("Exporting {} record{} from {}{} to '{}'.".format(num_found, ("" if num_found==1 else "s"), solr_instance_name, (" where {}".format(filter_query) if filter_query else ""), out_dir))
+
+    # Stream documents to shards
+    writer = ShardWriter(out_dir, solr_instance_name, shard_size, compression)
+    exported = 0
+    for doc in metrics.timed_iter(solr.iter_docs(fq=filter_query, page_size=page_size, prefetch=True), 'fetch'):
+        for field in SOLR_MANAGED_FIELDS:
+            doc.pop(field, None)
+        with metrics.stage('write'):
+            writer.write(dumps(doc, backend) + b"\n")
+        exported += 1
+    with metrics.stage('write'):
+        writer.close()
+
+    metrics.count('documents_exported', exported)
+    metrics.count('bytes_written', sum(shard['bytes'] for shard in writer.shards))
+
+    # Records added or deleted during the export change the count
+    if exported != num_found:
+        logging.warning("Exported {} record{}, but {} matched when the export started; the index changed during the export.".format(exported, ("" if exported==1 else "s"), num_found))
+
+    # Write manifest last, so its presence means the export is complete
+    manifest = {
+        'instance': solr_instance_name,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'filter-query': filter_query,
+        'compression': compression,
+        'documents': exported,
+        'num-found': num_found,
+        'shards': writer.shards
+    }
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w", encoding="utf8") as f:
+        yaml.safe_dump(manifest, f, sort_keys=False)
+
+    logging.info("Exported {} record{} to {} shard{}.".format(exported, ("" if exported==1 else "s"), len(writer.shards), ("" if len(writer.shards)==1 else "s")))
+    return manifest
@@ -0,0 +1,290 @@
+"""Fast Schema
+
+Generate specialized Python code that checks records against a JSON schema.
+
+A general-purpose validator walks the schema tree for every record. For the
+keywords the bundled schemas use, this module instead writes a Python function
+with the checks of a schema unrolled into plain `isinstance`, `in` and regular
+expression tests, like fastjsonschema does. The generated function only tells
+whether a record is valid; records it rejects are validated again with
+jsonschema to get detailed error messages. Generated code is cached on disk,
+keyed by a hash of the schema, so each schema is only turned into code once.
+"""
+
+
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+from typing import Callable, Union
+
+from jsonschema import validators
+
+from .logging_config import LogFormat
+
+
+# Bump when the generated code changes, so cached code is generated again
+GENERATOR_VERSION = 1
+
+# Location of generated code if not set in the config
+DEFAULT_COMPILED_SCHEMA_PATH = "~/.geodatautils/compiled-schemas"
+
+# Keywords that do not change whether a record is valid; `format` is only an
+# annotation since the validators in `schema` have no format checker
+ANNOTATIONS = {"$schema", "$id", "id", "$comment", "title", "description", "example", "examples", "default", "definitions", "$defs", "format", "readOnly", "writeOnly", "deprecated"}
+
+# Keywords turned into code
+SUPPORTED = {"$ref", "type", "enum", "const", "pattern", "required", "properties", "items", "allOf", "anyOf", "oneOf", "not"}
+
+# Drafts code can be generated for: whether `$ref` overrides its sibling
+# keywords, and whether floats like 1.0 are rejected as integers
+DRAFTS = {
+    'Draft4Validator': (True, True),
+    'Draft6Validator': (True, False),
+    'Draft7Validator': (True, False),
+    'Draft201909Validator': (False, False),
+    'Draft202012Validator': (False, False)
+}
+
+# Python test for each JSON type, matching jsonschema's type checkers
+TYPE_CHECKS = {
+    'string': "isinstance({v}, str)",
+    'object': "isinstance({v}, dict)",
+    'array': "isinstance({v}, list)",
+    'boolean': "isinstance({v}, bool)",
+    'null': "{v} is None",
+    'number': "(isinstance({v}, (int, float)) and not isinstance({v}, bool))",
+    'integer': "(isinstance({v}, int) and not isinstance({v}, bool) or isinstance({v}, float) and {v}.is_integer())"
+}
+STRICT_INTEGER_CHECK = "(isinstance({v}, int) and not isinstance({v}, bool))"
+
+# Helpers included in every generated module; `_equal` compares like
+# jsonschema does for `enum` and `const`, where booleans never equal numbers
+HELPERS = '''
+import re
+
+def _equal(one, two):
+    if one is two:
+        return True
+    if isinstance(one, str) or isinstance(two, str):
+        return one == two
+    if isinstance(one, list) and isinstance(two, list):
+        return len(one) == len(two) and all(_equal(a, b) for a, b in zip(one, two))
+    if isinstance(one, dict) and isinstance(two, dict):
+        return one.keys() == two.keys() and all(_equal(one[key], two[key]) for key in one)
+    if isinstance(one, bool) or isinstance(two, bool):
+        return isinstance(one, bool) and isinstance(two, bool) and one == two
+    return one == two
+'''
+
+
+class UnsupportedSchema(Exception):
+    """The schema uses something no code can be generated for."""
+
+class _Generator:
+    """Turn a schema into the source of a module with a `validate` function."""
+
+    def __init__(self, schema:Union[dict, bool], ref_overrides:bool, strict_integer:bool) -> None:
+        self.root = schema
+        self.ref_overrides = ref_overrides
+        self.type_checks = dict(TYPE_CHECKS, integer=STRICT_INTEGER_CHECK) if strict_integer else TYPE_CHECKS
+        self.constants = []  # Source lines defining patterns and enum values
+        self.functions = []  # Source of every generated function
+        self.refs = {}  # Function name for each `$ref`
+        self.names = 0
+
+    def _name(self, prefix:str) -> str:
+        self.names += 1
+        return "{}{}".format(prefix, self.names)
+
+    def _constant(self, expression:str) -> str:
+        name = self._name("_C")
+        self.constants.append("{} = {}".format(name, expression))
+        return name
+
+    def source(self) -> str:
+        entry = self._function(self.root)
+        return "\n".join([HELPERS] + self.constants + [""] + self.functions + ["validate = {}".format(entry), ""])
+
+    def _function(self, schema:Union[dict, bool], name:Union[str, None] = None) -> str:
+        """Generate a function returning whether a value matches a schema."""
+
+        name = name or self._name("_s")
+        lines = []
+        self._checks(schema, "x", 1, lines)
+        self.functions.append("\n".join(["def {}(x):".format(name)] + lines + ["    return True", ""]))
+        return name
+
+    def _ref(self, ref:str) -> str:
+        """Get the function checking a `$ref`, generating it the first time."""
+
+        if ref not in self.refs:
+            if not ref.startswith("#"):
+                raise UnsupportedSchema("remote $ref '{}'".format(ref))
+
+            # Resolve the JSON pointer in this schema
+            target = self.root
+            for part in filter(None, ref[1:].split("/")):
+                part = part.replace("~1", "/").replace("~0", "~")
+                try:
+                    target = target[int(part)] if isinstance(target, list) else target[part]
+                except (KeyError, IndexError, ValueError, TypeError):
+                    raise UnsupportedSchema("unresolvable $ref '{}'".format(ref))
+
+            # Name the function first so recursive references find it
+            self.refs[ref] = self._name("_ref")
+            self._function(target, self.refs[ref])
+
+        return self.refs[ref]
+
+    def _checks(self, schema:Union[dict, bool], v:str, depth:int, lines:list) -> None:
+        """Add the lines checking that variable v matches a schema, returning
+        False from the function if it does not."""
+
+        pad = "    " * depth
+
+        if schema is True:
+            return
+        if schema is False:
+            lines.append(pad + "return False")
+            return
+        if not isinstance(schema, dict):
+            raise UnsupportedSchema("schema of type {}".format(type(schema).__name__))
+
+        unknown = set(schema) - ANNOTATIONS - SUPPORTED
+        if unknown:
+            raise UnsupportedSchema("keyword '{}'".format(sorted(unknown)[0]))
+        if schema is not self.root and ("$id" in schema or isinstance(schema.get("id"), str)):
+            raise UnsupportedSchema("nested schema id")
+
+        if "$ref" in schema:
+            lines.append("{}if not {}({}): return False".format(pad, self._ref(schema["$ref"]), v))
+            if self.ref_overrides:
+                return
+
+        if "type" in schema:
+            types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+            if any(t not in self.type_checks for t in types):
+                raise UnsupportedSchema("type {}".format(schema["type"]))
+            lines.append("{}if not ({}): return False".format(pad, " or ".join(self.type_checks[t].format(v=v) for t in types)))
+
+        if "enum" in schema:
+            values = schema["enum"]
+            if all(isinstance(value, str) for value in values):
+                lines.append("{}if not (isinstance({v}, str) and {v} in {}): return False".format(pad, self._constant("frozenset({!r})".format(sorted(values))), v=v))
+            else:
+                lines.append("{}if not any(_equal({}, value) for value in {}): return False".format(pad, v, self._constant(repr(tuple(values)))))
+
+        if "const" in schema:
+            lines.append("{}if not _equal({}, {}): return False".format(pad, v, self._constant(repr(schema["const"]))))
+
+        if "pattern" in schema:
+            pattern = self._constant("re.compile({!r})".format(schema["pattern"]))
+            lines.append("{}if isinstance({v}, str) and not {}.search({v}): return False".format(pad, pattern, v=v))
+
+        if schema.get("required"):
+            missing = " or ".join("{!r} not in {}".format(key, v) for key in schema["required"])
+            lines.append("{}if isinstance({}, dict) and ({}): return False".format(pad, v, missing))
+
+        if schema.get("properties"):
+            block = []
+            for key, subschema in schema["properties"].items():
+                value = self._name("v")
+                checks = []
+                self._checks(subschema, value, depth+2, checks)
+                if checks:
+                    block += ["{}    if {!r} in {}:".format(pad, key, v), "{}        {} = {}[{!r}]".format(pad, value, v, key)] + checks
+            if block:
+                lines += ["{}if isinstance({}, dict):".format(pad, v)] + block
+
+        if "items" in schema:
+            if isinstance(schema["items"], list):
+                raise UnsupportedSchema("items as a list of schemas")
+            item = self._name("v")
+            checks = []
+            self._checks(schema["items"], item, depth+2, checks)
+            if checks:
+                lines += ["{}if isinstance({}, list):".format(pad, v), "{}    for {} in {}:".format(pad, item, v)] + checks
+
+        for subschema in schema.get("allOf", []):
+            self._checks(subschema, v, depth, lines)
+
+        if "anyOf" in schema:
+            calls = ["{}({})".format(self._function(subschema), v) for subschema in schema["anyOf"]]
+            lines.append("{}if not ({}): return False".format(pad, " or ".join(calls)))
+
+        if "oneOf" in schema:
+            calls = ["{}({})".format(self._function(subschema), v) for subschema in schema["oneOf"]]
+            lines.append("{}if [{}].count(True) != 1: return False".format(pad, ", ".join(calls)))
+
+        if "not" in schema:
+            lines.append("{}if {}({}): return False".format(pad, self._function(schema["not"]), v))
+
+def generate(schema:Union[dict, bool]) -> str:
+    """Generate the source of a module whose `validate(data)` function returns
+    True if data matches the schema.
+
+    Raises:
+    UnsupportedSchema -- if the schema uses a keyword or draft that no code
+        can be generated for
+    """
+
+    draft = validators.validator_for(schema).__name__
+    if draft not in DRAFTS:
+        raise UnsupportedSchema("draft {}".format(draft))
+    ref_overrides, strict_integer = DRAFTS[draft]
+
+    generator = _Generator(schema, ref_overrides, strict_integer)
+    return "# Generated by geodatautils.fastschema; do not edit.\n" + generator.source()
+
+def schema_key(schema:Union[dict, bool]) -> str:
+    """Hash a schema and the generator version, naming its generated code."""
+
+    canonical = json.dumps([GENERATOR_VERSION, schema], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def compile_schema(schema:Union[dict, bool], path:str = DEFAULT_COMPILED_SCHEMA_PATH) -> Union[Callable[[dict], bool], None]:
+    """Get the generated validation function of a schema.
+
+    Generated code is written to a module in `path` the first time and imported
+    from there afterwards, so Python also caches its bytecode. If the folder
+    cannot be written, the code is generated and run in memory instead.
+
+    Arguments:
+    schema (dict|bool) -- JSON schema
+    path (str) -- folder to keep generated code in
+
+    Returns:
+    validate (Callable|None) -- function returning True if a record matches
+        the schema, or None if no code can be generated for the schema
+    """
+
+    key = schema_key(schema)
+    module_name = "geodatautils_schema_{}".format(key[:16])
+    module_path = os.path.join(os.path.expanduser(path), module_name + ".py")
+
+    if not os.path.exists(module_path):
+        try:
+            source = generate(schema)
+        except UnsupportedSchema as e:
+            logging.debug("No fast path for schema; unsupported {}.".format(e), extra={'indent': LogFormat.indent(2)})
+            return None
+
+        try:
+            os.makedirs(os.path.dirname(module_path), exist_ok=True)
+            temporary_path = "{}.{}.tmp".format(module_path, os.getpid())
+            with open(temporary_path, "w", encoding="utf8") as f:
+                f.write(source)
+            os.replace(temporary_path, module_path)
+        except OSError as e:
+            logging.debug("Could not cache generated schema code: {}".format(e), extra={'indent': LogFormat.indent(2)})
+            namespace = {}
+            exec(compile(source, "<{}>".format(module_name), "exec"), namespace)
+            return namespace['validate']
+
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    logging.debug("Using generated fast path '{}'".format(module_path), extra={'indent': LogFormat.indent(2)})
+    return module.validate
@@ -6,30 +6,89 @@ These are small bits of code that are common to many modules.
 
 import os
 import logging
-import glob
+import hashlib
 import json
-from typing import Union, ClassVar
+import sys
+import tempfile
+from itertools import islice
+from typing import Iterable, Iterator, Union
 
 from .logging_config import LogFormat
+from .serialize import dumps
+
+
+# Solr field used to store a fingerprint of each uploaded record's content
+FINGERPRINT_FIELD = "geodatautils_fingerprint_s"
+
+# Fields managed by Solr that are not part of a record's content
+SOLR_MANAGED_FIELDS = ("_version_", "score", FINGERPRINT_FIELD)
+
+# Extensions of input files with one JSON record per line; .zst needs zstandard
+LINE_FILE_EXTENSIONS = (".jsonl", ".ndjson", ".jsonl.gz", ".ndjson.gz", ".jsonl.zst", ".ndjson.zst")
+
+
+class LinePath(str):
+    """Location of a record on one line of a line-delimited JSON file.
+
+    Behaves as the string `path:line`, so it can be used wherever a file path 
+    identifies a record (logs, error messages, record keys), while keeping the 
+    file path, line number and byte offset needed to read the line again.
+    """
+
+    def __new__(cls, path:str, line:int, offset:int) -> "LinePath":
+        location = super().__new__(cls, "{}:{}".format(path, line))
+        location.path = path
+        location.line = line
+        location.offset = offset  # Byte offset of the line in the (uncompressed) file
+        return location
+
+    def __reduce__(self) -> tuple:
+        return (LinePath, (self.path, self.line, self.offset))
 
 
 class Error:
-    """An error contains an error message and a debug message."""
+    """An error contains an error message and a debug message.
+
+    Labels are interned since the same few labels are shared by every error. 
+    A message can be given as a tuple of a format string and its arguments, 
+    e.g. `("'{}' is empty", field)`, and is only formatted when it is read.
+    """
+
+    __slots__ = ('label', '_msg', '_debug')
+
+    def __init__(self, label:str, msg:Union[str, tuple], debug:Union[str, tuple, None]):
+        self.label = sys.intern(label)
+        self._msg = msg
+        self._debug = debug
 
-    def __init__(self, label:str, msg:str, debug:Union[str, None]):
-        self.label = label
-        self.msg = msg
-        self.debug = debug
+    @staticmethod
+    def _format(message:Union[str, tuple, None]) -> Union[str, None]:
+        if isinstance(message, tuple):
+            return message[0].format(*message[1:])
+        return message
+
+    @property
+    def msg(self) -> str:
+        return self._format(self._msg)
+
+    @property
+    def debug(self) -> Union[str, None]:
+        return self._format(self._debug)
 
 class Record:
     """Defines a record with a file path and data (JSON contents)."""
 
+    __slots__ = ('filepath', 'data', 'errors', 'warnings', 'set_counts', 'invalid', 'fingerprint', 'spill_path')
+
     def __init__(self, data: dict, filepath: Union[str, None] = None, set_counts: Union[dict, None] = None) -> None:
         self.filepath = filepath
         self.data = data
         self.errors = []
         self.warnings = []
         self.set_counts = set_counts
+        self.invalid = False  # Set when the record fails schema validation
+        self.fingerprint = None
+        self.spill_path = None  # Set when the record data is spilled to disk
 
     @property
     def has_errors(self) -> int:
@@ -41,22 +100,58 @@ class Record:
         """Returns warning count for record."""
         return len(self.warnings)
 
-    def add_error(self, label:str, msg:str, debug:Union[str, None]):
+    @property
+    def data_path(self) -> Union[str, None]:
+        """Path the record data can be read again from once released."""
+        return self.spill_path or self.filepath
+
+    def add_error(self, label:str, msg:Union[str, tuple], debug:Union[str, tuple, None]):
         """Add an error to the record."""
         self.errors.append(Error(label, msg, debug))
         self.set_counts['errors'] += 1
     
-    def add_warning(self, label:str, msg:str, debug:str):
+    def add_warning(self, label:str, msg:Union[str, tuple], debug:Union[str, tuple, None]):
         """Add an warning to the record."""
         self.warnings.append(Error(label, msg, debug))
         self.set_counts['warnings'] += 1
 
+    def release(self, spill_dir:Union[str, None] = None) -> None:
+        """Drop the record data from memory once it is no longer needed. 
+        
+        The data can be read again from `data_path`: the record's file path, 
+        or a copy written to `spill_dir` if one is given. Spilling is useful 
+        when the source files are slow to read again or may change.
+        """
+
+        if spill_dir is not None and self.data is not None:
+            name = hashlib.sha1((self.filepath or str(id(self))).encode()).hexdigest()
+            self.spill_path = os.path.join(spill_dir, name + ".json")
+            with open(self.spill_path, "wb") as f:
+                f.write(dumps(self.data))
+
+        self.data = None
+
+    def load_data(self) -> dict:
+        """Return the record data, reading it again from disk if released."""
+
+        if self.data is not None:
+            return self.data
+
+        # Records from line-delimited files are read from their line
+        if isinstance(self.data_path, LinePath):
+            from .loader import read_line
+            return read_line(self.data_path)
+
+        with open(self.data_path, encoding="utf8") as f:
+            return json.load(f)
+
     def log_record(self, level: str = "debug", indent: int = 1):
         """Log the file name of the record."""
         if level == "info":
             logging.info(self.filepath, extra={'indent': LogFormat.indent(indent)})
         elif level == "debug":
-            logging.debug(self.filepath, extra={'indent': LogFormat.indent(indent)})
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(self.filepath, extra={'indent': LogFormat.indent(indent)})
         else:
             print("Level '{}' is not recognized. Must be 'info' or 'debug'.")
 
@@ -64,22 +159,26 @@ class Record:
         """Write errors to log."""
 
         self.log_record(level="info", indent=indent)
-        
+
+        # Only format debug messages if they will be written
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
         for error in self.errors:
             if error.msg: 
                 logging.error(error.msg, extra={'indent': LogFormat.indent(indent+1, True), 'label': LogFormat.label(error.label)})
-            if error.debug:
+            if debug and error.debug:
                 logging.debug(error.debug, extra={'indent': LogFormat.indent(indent+3)})
     
     def log_warnings(self, indent: int = 2):
         """Write warnings to log."""
 
         self.log_record(level="info", indent=indent)
-        
+
+        # Only format debug messages if they will be written
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
         for warning in self.warnings:
             if warning.msg: 
                 logging.warning(warning.msg, extra={'indent': LogFormat.indent(indent+1, True), 'label': LogFormat.label(warning.label)})
-            if warning.debug:
+            if debug and warning.debug:
                 logging.debug(warning.debug, extra={'indent': LogFormat.indent(indent+3)})
 
 class RecordSet:
@@ -87,19 +186,69 @@ class RecordSet:
     
     Attributes:
     records (dict[str, Record]) -- A dictionary with UID as the key and a Record object as the value.
+    failed_files (list[Record]) -- Records for files that could not be opened.
     counts (dict[str, int]) -- A dictionary storing the counts for errors and warnings.
+    spill_dir (str|None) -- Directory released record data is spilled to, if any.
     """
 
-    records: dict[str, Record] = {}
+    def __init__(self, spill_dir:Union[str, None] = None) -> None:
+        """Create an empty record set.
+
+        Arguments:
+        spill_dir (str|None) -- if given, released record data is written to a 
+            temporary directory inside it, which is removed when the set is 
+            closed; use the set as a context manager to close it
+        """
 
-    def __init__(self) -> None:
+        self.records: dict[str, Record] = {}
         self.counts = {
             'errors': 0,
             'warnings': 0
         }
+        self.failed_files = []
+
+        # Temporary directory for spilled record data
+        self._spill = None
+        if spill_dir is not None:
+            spill_dir = os.path.expanduser(spill_dir)
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill = tempfile.TemporaryDirectory(prefix="records-", dir=spill_dir)
+
+    def __enter__(self) -> "RecordSet":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def spill_dir(self) -> Union[str, None]:
+        return self._spill.name if self._spill else None
+
+    def release(self, record:Record) -> None:
+        """Release a record's data, spilling it to disk if the set has a spill directory."""
+        record.release(self.spill_dir)
+
+    def close(self) -> None:
+        """Remove any spilled record data."""
+        if self._spill:
+            self._spill.cleanup()
+            self._spill = None
 
-    def add_record(self, data, filepath) -> None:
-        self.records[data['dc_identifier_s']] = Record(data, filepath=filepath, set_counts=self.counts)
+    def add_record(self, data, filepath) -> Record:
+        record = Record(data, filepath=filepath, set_counts=self.counts)
+        self.records[data['dc_identifier_s']] = record
+        return record
+
+    def add_failed_file(self, filepath:str, error:Error) -> Record:
+        """Track a file that could not be opened as a record with an error.
+        
+        Failed files are not added to `records` since their UID is unknown, 
+        but they are included in the error summary.
+        """
+        record = Record(None, filepath=filepath, set_counts=self.counts)
+        record.add_error(error.label, error.msg, error.debug)
+        self.failed_files.append(record)
+        return record
 
     def log_errors_and_warnings(self, indent: int = 0) -> None:
         """Log errors and warnings for each record in set."""
@@ -119,7 +268,10 @@ class RecordSet:
         logging.info("Error and Warning Summary:", extra={'indent': LogFormat.indent(indent)})
         
         # Log errors
-        logging.info("{} Error{}{}".format(len(records_with_errors), ("" if len(records_with_errors)==1 else "s"), ("" if len(records_with_errors)==0 else ":")), extra={'indent': LogFormat.indent(indent+1)})
+        error_count = len(records_with_errors) + len(self.failed_files)
+        logging.info("{} Error{}{}".format(error_count, ("" if error_count==1 else "s"), ("" if error_count==0 else ":")), extra={'indent': LogFormat.indent(indent+1)})
+        for record in self.failed_files:
+            record.log_errors(indent=indent+2)
         for uid in records_with_errors:
             self.records[uid].log_errors(indent=indent+2)
 
@@ -134,7 +286,8 @@ def create_file_list(in_path:str) -> list:
     
     If the in path is a JSON file, this is a list with a single item. If the 
     in path is a directory, the list is every JSON file within the directory 
-    including within subdirectories.
+    including within subdirectories. Line-delimited JSON files (`.jsonl`, 
+    `.ndjson`, optionally compressed) are included as well.
     """
 
     # Check if path exists; if not, exit
@@ -148,13 +301,33 @@ def create_file_list(in_path:str) -> list:
 
     # If path is a directory
     elif os.path.isdir(in_path):
-        return [file_name for file_name in glob.glob(in_path+"/**/*.json", recursive=True)]
+        return list(walk_json_files(in_path))
     
     # Other?
     else:
         logging.error("'{}' is not a file or directory", in_path)
         raise SystemExit
 
+def walk_json_files(directory:str) -> Iterator[str]:
+    """Yield the path of every JSON (or line-delimited JSON) file in a directory 
+    and its subdirectories.
+
+    Uses `os.scandir` so that file types come from the directory listing 
+    instead of a separate stat call per file, which matters on network shares. 
+    Like `glob`, hidden files and directories are skipped.
+    """
+
+    with os.scandir(directory) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            yield from walk_json_files(entry.path)
+        elif entry.name.endswith((".json",) + LINE_FILE_EXTENSIONS) and entry.is_file():
+            yield entry.path
+
 def open_json(file_path:str) -> dict:
     """Given a file path to a JSON file, return the JSON loaded into a dictionary."""
 
@@ -166,3 +339,23 @@ def open_json(file_path:str) -> dict:
             logging.debug(e)
             logging.info("Exiting; see log for debug.")
             raise SystemExit
+
+def fingerprint(data:dict) -> str:
+    """Hash the content of a record.
+
+    The hash is computed over canonical JSON (sorted keys, no whitespace) so 
+    it does not depend on key order or formatting. Fields managed by Solr are 
+    ignored, so a document fetched from Solr has the same fingerprint as the 
+    file it was uploaded from.
+    """
+
+    content = {key: value for key, value in data.items() if key not in SOLR_MANAGED_FIELDS}
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+def chunked(items:Iterable, size:int) -> Iterator[list]:
+    """Split an iterable into lists of at most `size` items."""
+
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -7,9 +7,7 @@ Command line interfaces for Geodata utilites.
 import argparse
 import logging
 
-from geodatautils import config, __version__
-from . import config_tools
-from . import manage
+from geodatautils import get_config, __version__
 
 
 def gu_config():
@@ -31,6 +29,8 @@ def gu_config():
     # Parse arguments
     args = parser.parse_args()
 
+    from . import config_tools
+
     # Run tools
     if args.edit:
         config_tools.edit()
@@ -48,18 +48,17 @@ def update_solr():
     parser = argparse.ArgumentParser()
 
     # Required arguments
-    instance_choices = list(config['solr instances'].keys())
     parser.add_argument(
         "-i", "--instance",
-        choices = instance_choices,
-        help="Identify which instance of Solr to use.",
+        nargs="+",
+        help="Identify which instance of Solr to use. With -a, several instances can be given; records are validated once and uploaded to all of them at the same time. With --resume, each instance's upload is resumed in turn.",
         required=True)
 
     # Required exclusive group (one and only one from group)
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
         "-a", "--add",
-        help="Indicate path to a single file or folder with GeoBlacklight JSON files that will be uploaded.")
+        help="Indicate path to a single file or folder with GeoBlacklight JSON files that will be uploaded. Line-delimited files (.jsonl, .ndjson, optionally compressed as .gz or .zst) hold one record per line.")
     group.add_argument(
         "-d", "--delete",
         help="Delete the provided unique record ID (layer_slug_s) from the Solr index.")
@@ -73,36 +72,282 @@ def update_solr():
         "-p", "--purge",
         action='store_true',
         help="Delete the entire Solr index.")
+    group.add_argument(
+        "--apply",
+        metavar="PLAN",
+        help="Carry out a plan written with --plan, without validating or querying again. Refused if the index or input files changed since.")
+    group.add_argument(
+        "--resume",
+        action='store_true',
+        help="Finish the last upload to the instance from its journal, after the last batch Solr accepted, without validating or sending earlier records again.")
 
     # Optional arguments
+    parser.add_argument(
+        "-s", "--sync",
+        action='store_true',
+        help="With -a, only upload records that are new or changed compared to the Solr index and delete indexed records that are not in the input.")
+    parser.add_argument(
+        "--sync-provenance",
+        help="With --sync, only delete indexed records of this provenance.")
+    parser.add_argument(
+        "--sync-collection",
+        help="With --sync, only delete indexed records in this collection.")
+    parser.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="With -a or a delete option, check what would happen and write it to a plan file instead of changing the index.")
     parser.add_argument(
         "-r", "--recursive",
         action='store_true',
         help="[Deprecated] Recurse into subfolders when adding JSON files.")
 
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        help="Number of files to open at the same time when adding. Defaults to the 'loading' setting in the config.")
+
+    parser.add_argument(
+        "--no-cache",
+        action='store_true',
+        help="Validate every file when adding, ignoring the validation cache.")
+
+    # Commit strategy
+    parser.add_argument(
+        "--commit",
+        choices=["hard", "soft", "within", "none"],
+        help="How changes are made visible: a hard or soft commit at the end, commitWithin on every write, or no commit (leave it to Solr's autoCommit). Defaults to the instance's 'commit' setting, or hard.")
+    parser.add_argument(
+        "--commit-within",
+        type=int,
+        metavar="MS",
+        help="Milliseconds Solr may wait before committing; implies --commit within. Defaults to the instance's 'commit-within' setting.")
+    parser.add_argument(
+        "--no-wait-searcher",
+        action='store_true',
+        help="Return after a hard or soft commit without waiting for the new searcher to open, so changes may not be visible yet when the command returns.")
+
+    # Logging, metrics and profiling
+    parser.add_argument(
+        "-v", "--verbose",
+        action='store_true',
+        help="Log the file of every record validated, checked and uploaded instead of a summary per batch.")
+    parser.add_argument(
+        "--metrics-json",
+        help="Write counts, stage timings and Solr request latency of the run to this JSON file.")
+    parser.add_argument(
+        "--metrics-prom",
+        help="Write the run metrics to this file in the Prometheus textfile collector format.")
+    parser.add_argument(
+        "--profile",
+        help="Profile the run and save the result to this file.")
+    parser.add_argument(
+        "--profiler",
+        choices=["cprofile", "pyinstrument"],
+        default="cprofile",
+        help="Profiler used by --profile. pyinstrument saves an HTML report and must be installed.")
+
     # Print version
     parser.add_argument("--version", action="version", version="Geodata Utils - Version {}".format(__version__))
 
     # Parse arguments
     args = parser.parse_args()
+    args.instance = list(dict.fromkeys(args.instance))
+    for instance in args.instance:
+        _check_instance(parser, instance)
 
-    # Set logger level
-    logging.getLogger().setLevel(logging.DEBUG)
+    # Set up logging
+    _start_logging(args.verbose)
 
     # Deprecation warning
     if args.recursive:
         logging.warning('The "-r" recursive option is deprecated and no longer used by script. Using -a will add either a file or a directory recursively.')
 
+    # Sync options only apply to adding
+    if (args.sync or args.sync_provenance or args.sync_collection) and not args.add:
+        parser.error("--sync options can only be used with -a/--add")
+    if (args.sync_provenance or args.sync_collection) and not args.sync:
+        parser.error("--sync-provenance and --sync-collection require --sync")
+    if args.plan and args.sync:
+        parser.error("--plan cannot be used with --sync")
+    if args.plan and args.resume:
+        parser.error("--plan cannot be used with --resume")
+    if args.commit_within is not None and args.commit not in (None, "within"):
+        parser.error("--commit-within can only be used with --commit within")
+    if len(args.instance) > 1 and not args.resume and (not args.add or args.sync or args.plan):
+        parser.error("several instances can only be given with -a or --resume, without --sync or --plan")
+    instance = args.instance[0]
+
+    # Import only once arguments are valid, since it loads requests and jsonschema
+    from . import manage, plan
+    from .metrics import metrics, profiled
+
+    # Commit options override the instance settings for this run
+    for instance_config in [get_config()['solr instances'][name] for name in args.instance]:
+        if args.commit:
+            instance_config['commit'] = args.commit
+        if args.commit_within is not None:
+            instance_config['commit'] = "within"
+            instance_config['commit-within'] = args.commit_within
+        if args.no_wait_searcher:
+            instance_config['wait-searcher'] = False
+
+    # Run tools, then report metrics even if the run stopped early
+    metrics.reset()
+    try:
+        with profiled(args.profile, args.profiler):
+            if args.apply:
+                plan.apply_plan(args.apply, solr_instance_name=instance, confirm_action=True, workers=args.workers)
+            elif args.resume:
+                for name in args.instance:
+                    manage.resume(name, confirm_action=True, workers=args.workers)
+            elif args.plan and args.add:
+                plan.plan_add(args.add, solr_instance_name=instance, plan_path=args.plan, workers=args.workers, use_cache=not args.no_cache)
+            elif args.plan:
+                plan.plan_delete(solr_instance_name=instance, query=_delete_query(args), plan_path=args.plan)
+            elif args.add and args.sync:
+                manage.sync(args.add, solr_instance_name=instance, confirm_action=True, workers=args.workers, use_cache=not args.no_cache, provenance=args.sync_provenance, collection=args.sync_collection)
+            elif args.add:
+                manage.add(args.add, solr_instance_name=args.instance, confirm_action=True, workers=args.workers, use_cache=not args.no_cache)
+            elif args.purge or args.delete or args.delete_collection or args.delete_provenance:
+                manage.delete(solr_instance_name=instance, query=_delete_query(args), confirm_action=True)
+            else:  # This shouldn't happen
+                print("No tool selected")
+    finally:
+        metrics.log_summary()
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+
+def export_solr():
+    """Export Solr
+    
+    Interface to back up a solr instance to compressed JSONL shards.
+    """
+
+    # Create argument parser
+    parser = argparse.ArgumentParser()
+
+    # Required arguments
+    parser.add_argument(
+        "-i", "--instance",
+        help="Identify which instance of Solr to export from.",
+        required=True)
+    parser.add_argument(
+        "-o", "--out",
+        help="Empty or new folder to write shards and the manifest to.",
+        required=True)
+
+    # Optional arguments
+    parser.add_argument(
+        "--provenance",
+        help="Only export records of this provenance.")
+    parser.add_argument(
+        "--collection",
+        help="Only export records in this collection.")
+    parser.add_argument(
+        "--compression",
+        choices=["gzip", "zstd"],
+        help="Compression of the shards. zstd requires zstandard. Defaults to the 'export' setting in the config.")
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        help="Compressed size of each shard in MB. Defaults to the 'export' setting in the config.")
+
+    # Print version
+    parser.add_argument("--version", action="version", version="Geodata Utils - Version {}".format(__version__))
+
+    # Parse arguments
+    args = parser.parse_args()
+    _check_instance(parser, args.instance)
+
+    # Set up logging
+    _start_logging()
+
+    from .export import export
+    from .metrics import metrics
+
+    # Run export, then report metrics even if it stopped early
+    metrics.reset()
+    try:
+        export(args.instance, args.out, provenance=args.provenance, collection=args.collection, compression=args.compression, shard_size=(args.shard_size*1024*1024 if args.shard_size else None))
+    finally:
+        metrics.log_summary()
+
+def geodata_utils():
+    """Geodata Utilities
+
+    Interface for long running Geodata Utilities tools.
+    """
+
+    # Create argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--version", action="version", version="Geodata Utils - Version {}".format(__version__))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Serve
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Watch drop folders and accept HTTP jobs, adding records to Solr as they arrive.")
+    serve_parser.add_argument(
+        "-i", "--instance",
+        help="Solr instance that jobs are uploaded to unless a job names another.",
+        required=True)
+    serve_parser.add_argument(
+        "--watch",
+        nargs="+",
+        help="Drop folders to watch for new JSON files. Defaults to the 'serve' setting in the config.")
+    serve_parser.add_argument(
+        "--host",
+        help="Address the HTTP API listens on. Defaults to the 'serve' setting in the config.")
+    serve_parser.add_argument(
+        "--port",
+        type=int,
+        help="Port the HTTP API listens on. Defaults to the 'serve' setting in the config.")
+    serve_parser.add_argument(
+        "-v", "--verbose",
+        action='store_true',
+        help="Log the file of every record of a job instead of a summary per batch.")
+
+    # Parse arguments
+    args = parser.parse_args()
+    _check_instance(parser, args.instance)
+
+    # Set up logging
+    _start_logging(args.verbose)
+
     # Run tools
-    if args.add:
-        manage.add(args.add, solr_instance_name=args.instance, confirm_action=True)
-    elif args.purge:
-        manage.delete(solr_instance_name=args.instance, query="*:*", confirm_action=True)
+    if args.command == "serve":
+        from .serve import IngestServer
+        IngestServer(args.instance, watch=args.watch, host=args.host, port=args.port).serve_forever()
+
+def _start_logging(verbose:bool = False) -> None:
+    """Set up logging with the `log-options` in the config."""
+
+    from .logging_config import start_logging
+
+    log_options = get_config().get('log-options', {})
+    start_logging(log_options.get('mode', 'queue'), verbose or log_options.get('verbose', False))
+
+def _delete_query(args:argparse.Namespace) -> str:
+    """Build the query of the delete option given to `update_solr`."""
+
+    if args.purge:
+        return "*:*"
     elif args.delete:
-        manage.delete(solr_instance_name=args.instance, query="layer_slug_s:{}".format(args.delete), confirm_action=True)
+        return "layer_slug_s:{}".format(args.delete)
     elif args.delete_collection:
-        manage.delete(solr_instance_name=args.instance, query='dct_isPartOf_sm:"{}"'.format(args.delete_collection), confirm_action=True)
-    elif args.delete_provenance:
-        manage.delete(solr_instance_name=args.instance, query='dct_provenance_s:"{}"'.format(args.delete_provenance), confirm_action=True)
-    else:  # This shouldn't happen
-        print("No tool selected")
\ No newline at end of file
+        return 'dct_isPartOf_sm:"{}"'.format(args.delete_collection)
+    else:
+        return 'dct_provenance_s:"{}"'.format(args.delete_provenance)
+
+def _check_instance(parser:argparse.ArgumentParser, instance:str) -> None:
+    """Exit with a usage error if instance is not a Solr instance in the config.
+    
+    Done after parsing instead of with `choices` so that `--help` does not 
+    have to load the config.
+    """
+
+    instance_choices = list(get_config()['solr instances'].keys())
+    if instance not in instance_choices:
+        parser.error("argument -i/--instance: invalid choice: '{}' (choose from {})".format(instance, ", ".join("'{}'".format(choice) for choice in instance_choices)))
@@ -0,0 +1,187 @@
+"""Journal
+
+Record the batches sent to each Solr instance, so an interrupted upload can be resumed.
+
+Each instance has one journal, a line-delimited JSON file describing its
+latest upload. The first line describes the run, followed by one line per
+record to upload (where to read it and its content fingerprint) in upload
+order. A line is appended for every batch Solr accepted or rejected, with the
+UIDs and fingerprints of its records and the response status, and a last line
+once the upload is committed. Lines are synced to disk as they are written,
+so the journal survives a crash or a dropped connection.
+"""
+
+
+import datetime
+import json
+import os
+from typing import Union
+
+from geodatautils import get_config
+from .helpers import LinePath, Record
+from .solr import Solr
+
+
+# Version of the journal file format
+JOURNAL_FORMAT = 1
+
+# Location of journals if not set in the config
+DEFAULT_JOURNAL_PATH = "~/.geodatautils/journals"
+
+
+class Journal:
+    """The journal of the latest upload to one Solr instance.
+
+    Use `create` to start a journal for a new upload, or `read` to load one to
+    resume. Batches accepted by Solr always form an unbroken run from the
+    first record, since an instance gets no further batches once one fails.
+    """
+
+    def __init__(self, path:str) -> None:
+        """Arguments:
+        path (str) -- path of the journal file
+        """
+
+        self.path = os.path.expanduser(path)
+        self.run = None  # Instance, URL, input paths and start time of the upload
+        self.records = []  # Location and fingerprint of every record, in upload order
+        self.sent = 0  # Number of records in batches Solr accepted
+        self.batches = 0  # Number of batches journaled, accepted or not
+        self.committed = False
+        self._file = None
+
+    def __enter__(self) -> "Journal":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def create(self, solr:Solr, in_paths:list[str], records:dict[str, Record]) -> None:
+        """Start the journal of a new upload, replacing the previous one.
+
+        Arguments:
+        solr (Solr) -- instance the records are uploaded to
+        in_paths (list[str]) -- input paths given to `add`
+        records (dict[str, Record]) -- validated records with fingerprints
+            keyed by UID, in upload order
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._file = open(self.path, "w", encoding="utf8")
+
+        self.run = {
+            'type': 'run',
+            'format': JOURNAL_FORMAT,
+            'instance': solr.name,
+            'url': solr.url,
+            'inputs': in_paths,
+            'records': len(records),
+            'started': _now()
+        }
+        self._write(self.run)
+
+        for uid, record in records.items():
+            entry = {'type': 'record', 'uid': uid, 'file': str(record.filepath), 'hash': record.fingerprint}
+            if isinstance(record.filepath, LinePath):
+                entry.update({'file': record.filepath.path, 'line': record.filepath.line, 'offset': record.filepath.offset})
+            self.records.append(entry)
+            self._write(entry)
+        self._sync()
+
+    def read(self) -> None:
+        """Load the journal to resume it; later entries are appended to it.
+
+        A last line cut short by a crash is dropped.
+
+        Raises:
+        OSError -- if the journal cannot be read
+        ValueError -- if the file is not a journal this version can resume
+        """
+
+        # Read whole lines only
+        end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                end += len(line)
+
+                if entry['type'] == 'run':
+                    self.run = entry
+                elif entry['type'] == 'record':
+                    self.records.append(entry)
+                elif entry['type'] == 'batch':
+                    self.batches += 1
+                    if entry.get('error') is None:
+                        self.sent += len(entry['uids'])
+                elif entry['type'] == 'commit':
+                    self.committed = True
+
+        if self.run is None or self.run.get('format') != JOURNAL_FORMAT:
+            raise ValueError("'{}' is not a journal this version can resume.".format(self.path))
+
+        # Append after the last whole line
+        with open(self.path, "r+b") as f:
+            f.truncate(end)
+        self._file = open(self.path, "a", encoding="utf8")
+
+    def remaining(self) -> list[dict]:
+        """Entries of the records not yet accepted by Solr."""
+        return self.records[self.sent:]
+
+    def batch(self, uids:list[str], hashes:list[str], status:Union[int, None], error:Union[str, None] = None) -> None:
+        """Record a batch sent to Solr.
+
+        Arguments:
+        uids (list[str]) -- UIDs of the records in the batch
+        hashes (list[str]) -- content fingerprints of the records
+        status (int|None) -- HTTP status of Solr's response, if there was one
+        error (str|None) -- why the batch failed; None if Solr accepted it
+        """
+
+        self.batches += 1
+        self._write({'type': 'batch', 'batch': self.batches, 'first': self.sent, 'uids': uids, 'hashes': hashes, 'status': status, 'error': error, 'time': _now()})
+        self._sync()
+        if error is None:
+            self.sent += len(uids)
+
+    def commit(self, status:Union[int, None]) -> None:
+        """Record that the upload is complete and committed.
+
+        Arguments:
+        status (int|None) -- HTTP status of the commit, or None if the commit
+            strategy leaves committing to Solr
+        """
+
+        self._write({'type': 'commit', 'status': status, 'time': _now()})
+        self._sync()
+        self.committed = True
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, entry:dict) -> None:
+        self._file.write(json.dumps(entry) + "\n")
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+def open_journal(instance:str) -> Union[Journal, None]:
+    """Get the journal of a Solr instance if journaling is enabled in the config."""
+
+    journal_config = get_config().get('journal', {})
+    if not journal_config.get('enabled', True):
+        return None
+
+    path = os.path.expanduser(journal_config.get('path', DEFAULT_JOURNAL_PATH))
+    return Journal(os.path.join(path, "{}.jsonl".format(instance)))
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
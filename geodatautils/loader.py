@@ -0,0 +1,352 @@
+"""Loader
+
+Open and decode many JSON files and line-delimited JSON files concurrently.
+"""
+
+
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import os
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import IO, Iterable, Iterator, Union
+
+from .helpers import Error, LINE_FILE_EXTENSIONS, LinePath
+from .metrics import metrics
+
+
+# Bytes of a line-delimited file decoded as one unit of work; chunks end on a line boundary
+LINE_CHUNK_SIZE = 1024*1024
+
+
+def is_line_file(filepath:str) -> bool:
+    """Check if a path is a line-delimited JSON file (`.jsonl`, `.ndjson`, optionally compressed)."""
+    return not isinstance(filepath, LinePath) and filepath.lower().endswith(LINE_FILE_EXTENSIONS)
+
+def _is_compressed(filepath:str) -> bool:
+    return filepath.lower().endswith((".gz", ".zst"))
+
+def _open_lines(filepath:str) -> IO[bytes]:
+    """Open a line-delimited JSON file for reading, decompressing it if needed."""
+
+    if filepath.lower().endswith(".gz"):
+        return gzip.open(filepath, 'rb')
+
+    if filepath.lower().endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise OSError("zstandard is not installed; install it to read .zst files.")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True))
+
+    return open(filepath, 'rb')
+
+def file_digest(filepath:str) -> str:
+    """Hash the contents of a file without holding it in memory.
+
+    Compressed line-delimited files are hashed after decompressing, like they
+    are hashed by `load_json_files`.
+    """
+
+    digest = hashlib.sha256()
+    with _open_lines(filepath) if is_line_file(filepath) else open(filepath, 'rb') as f:
+        while chunk := f.read(1024*1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _seek(f:IO[bytes], filepath:str, offset:int, position:int = 0) -> None:
+    """Move to an offset in a file opened with `_open_lines`.
+
+    Compressed streams cannot seek, so they are read forward from `position`,
+    the offset they are currently at.
+    """
+
+    if not _is_compressed(filepath):
+        f.seek(offset)
+        return
+
+    remaining = offset - position
+    while remaining > 0:
+        skipped = len(f.read(min(remaining, LINE_CHUNK_SIZE)))
+        if not skipped:
+            raise EOFError("File ended before offset {}.".format(offset))
+        remaining -= skipped
+
+
+def read_json(filepath:str, decoder:Union[Executor, None] = None) -> Union[dict, Error]:
+    """Read and decode a JSON file.
+
+    Arguments:
+    filepath (str) -- path to JSON file
+    decoder (Executor|None) -- optional process pool used to decode the file
+
+    Returns:
+    data (dict|Error) -- the decoded JSON, or an Error if the file could not be
+        read or decoded
+    """
+
+    return _read(filepath, decoder, False)[0]
+
+def _read(filepath:str, decoder:Union[Executor, None], with_digest:bool) -> tuple[Union[dict, Error], Union[str, None]]:
+    """Read and decode a JSON file, optionally hashing its contents."""
+
+    try:
+        with open(filepath, 'rb') as f:
+            raw = f.read()
+    except OSError as e:
+        return Error('json-read', "Could not read file.", str(e)), None
+
+    metrics.count('bytes_read', len(raw))
+    digest = hashlib.sha256(raw).hexdigest() if with_digest else None
+
+    try:
+        if decoder is None:
+            return json.loads(raw), digest
+        return decoder.submit(json.loads, raw).result(), digest
+    except (json.decoder.JSONDecodeError, UnicodeDecodeError) as e:
+        return Error('json-decode', "Could not decode JSON.", str(e)), digest
+
+def _line_chunks(filepath:str, chunk_size:int = LINE_CHUNK_SIZE) -> Iterator[tuple[int, int, bytes]]:
+    """Split a line-delimited JSON file into chunks of whole lines.
+
+    Plain files are memory-mapped, so only the chunks in flight are copied 
+    into memory; compressed files are decompressed as a stream.
+
+    Yields:
+    chunk (tuple[int, int, bytes]) -- number of the first line in the chunk, 
+        byte offset of the chunk in the (uncompressed) file and its lines
+    """
+
+    line = 1
+    offset = 0
+
+    if _is_compressed(filepath):
+        with _open_lines(filepath) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                # Finish the last line of the chunk
+                if not chunk.endswith(b"\n"):
+                    chunk += f.readline()
+                metrics.count('bytes_read', len(chunk))
+                yield line, offset, chunk
+                line += chunk.count(b"\n")
+                offset += len(chunk)
+
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:  # Empty files cannot be mapped
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            while offset < size:
+                # End the chunk after the first newline past the chunk size
+                end = mapped.find(b"\n", min(offset + chunk_size, size) - 1)
+                end = size if end == -1 else end + 1
+                chunk = mapped[offset:end]
+                metrics.count('bytes_read', len(chunk))
+                yield line, offset, chunk
+                line += chunk.count(b"\n")
+                offset = end
+
+def _decode_lines(filepath:str, first_line:int, offset:int, chunk:bytes, with_digest:bool) -> list[tuple[LinePath, Union[dict, Error], Union[str, None]]]:
+    """Decode each line of a chunk of a line-delimited JSON file.
+
+    Blank lines are skipped. A line that cannot be decoded, or that is not a 
+    JSON object, gets an `Error` naming its line number.
+    """
+
+    results = []
+    for line, raw in enumerate(chunk.split(b"\n"), first_line):
+        location_offset = offset
+        offset += len(raw) + 1
+        if not raw.strip():
+            continue
+
+        location = LinePath(filepath, line, location_offset)
+        digest = hashlib.sha256(raw).hexdigest() if with_digest else None
+        try:
+            data = json.loads(raw)
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError) as e:
+            data = Error('json-decode', ("Could not decode JSON on line {}.", line), str(e))
+        else:
+            if not isinstance(data, dict):
+                data = Error('json-decode', ("Line {} is not a JSON object.", line), type(data).__name__)
+        results.append((location, data, digest))
+
+    return results
+
+def load_json_files(file_list:Iterable[str], workers:int = 8, decode_processes:int = 0, ordered:bool = False, with_digest:bool = False, file_digests:Union[dict, None] = None) -> Iterator[tuple]:
+    """Open and decode JSON files concurrently.
+
+    Files are read in a thread pool. Decoding happens in the reading thread
+    unless `decode_processes` is set, in which case the raw bytes are handed to
+    a process pool; this only pays off for large files since the decoded data
+    has to be copied back to this process. At most a few files per worker are
+    in flight at once so memory stays bounded.
+
+    Line-delimited files (see `is_line_file`) are memory-mapped and split into 
+    chunks of whole lines, which are decoded like files: in the thread pool, or 
+    in the process pool if `decode_processes` is set. Each line is yielded as 
+    its own result with a `LinePath` (`path:line`) as its file path, so memory 
+    depends on the chunks in flight rather than on the size of the file.
+
+    Errors are reported per file, or per line of a line-delimited file: a file
+    or line that cannot be read or decoded is yielded with an `Error` in place 
+    of its data instead of stopping the run.
+
+    Arguments:
+    file_list (Iterable[str]) -- paths to JSON files
+    workers (int) -- number of threads reading files
+    decode_processes (int) -- number of processes decoding JSON; 0 decodes in
+        the reading threads
+    ordered (bool) -- yield results in the order of `file_list` instead of as
+        soon as they are ready
+    with_digest (bool) -- also yield the SHA-256 hash of each file's contents
+    file_digests (dict|None) -- if given, filled with the SHA-256 hash of each
+        whole file (see `file_digest`), keyed by path, from the same read that
+        is decoded; files that cannot be read are left out
+
+    Yields:
+    result (tuple[str, dict|Error]) -- file path and decoded JSON or Error, 
+        followed by the content hash if `with_digest` is set
+    """
+
+    workers = max(1, workers)
+    max_pending = workers * 4
+
+    decoder = ProcessPoolExecutor(decode_processes) if decode_processes else None
+
+    try:
+        with ThreadPoolExecutor(workers, thread_name_prefix='geodatautils-loader') as executor:
+            pending: deque[tuple[str, Future]] = deque()
+
+            for filepath in file_list:
+
+                # Decode line-delimited files in chunks of lines
+                if is_line_file(filepath):
+                    chunks = _line_chunks(filepath)
+                    file_hash = hashlib.sha256() if file_digests is not None else None
+                    while True:
+                        try:
+                            first_line, offset, chunk = next(chunks)
+                        except StopIteration:
+                            if file_hash is not None:
+                                file_digests[filepath] = file_hash.hexdigest()
+                            break
+                        except (OSError, EOFError, zlib.error) as e:
+                            pending.append((filepath, _finished((Error('json-read', "Could not read file.", str(e)), None))))
+                            break
+                        if file_hash is not None:
+                            file_hash.update(chunk)
+                        pool = decoder or executor
+                        pending.append((None, pool.submit(_decode_lines, filepath, first_line, offset, chunk, with_digest)))
+
+                        if len(pending) >= max_pending:
+                            yield from _collect(pending, ordered, with_digest, file_digests)
+                    continue
+
+                pending.append((filepath, executor.submit(_read, filepath, decoder, with_digest or file_digests is not None)))
+
+                # Wait for results once enough files are in flight
+                if len(pending) >= max_pending:
+                    yield from _collect(pending, ordered, with_digest, file_digests)
+
+            # Drain remaining files
+            while pending:
+                yield from _collect(pending, ordered, with_digest, file_digests)
+
+    finally:
+        if decoder is not None:
+            decoder.shutdown()
+
+def _collect(pending:deque, ordered:bool, with_digest:bool, file_digests:Union[dict, None]) -> Iterator[tuple]:
+    """Yield finished results from the pending queue."""
+
+    # Keep input order by waiting on the oldest file
+    if ordered:
+        filepath, future = pending.popleft()
+        yield from _results(filepath, future, with_digest, file_digests)
+        return
+
+    # Otherwise yield whatever is done
+    done, _ = wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+    finished = [(filepath, future) for filepath, future in pending if future in done]
+    for item in finished:
+        pending.remove(item)
+    for filepath, future in finished:
+        yield from _results(filepath, future, with_digest, file_digests)
+
+def _results(filepath:Union[str, None], future:Future, with_digest:bool, file_digests:Union[dict, None]) -> Iterator[tuple]:
+    """Build the result tuples for a finished file, or for every line of a 
+    finished chunk if there is no file path."""
+
+    if filepath is None:
+        results = future.result()
+    else:
+        results = [(filepath, *future.result())]
+        if file_digests is not None and results[0][2] is not None:
+            file_digests[filepath] = results[0][2]
+    for filepath, data, digest in results:
+        yield (filepath, data, digest) if with_digest else (filepath, data)
+
+def _finished(result:tuple) -> Future:
+    """Wrap a result that is already known in a future."""
+
+    future = Future()
+    future.set_result(result)
+    return future
+
+def read_line(location:LinePath) -> dict:
+    """Read and decode the record on one line of a line-delimited JSON file."""
+
+    with _open_lines(location.path) as f:
+        _seek(f, location.path, location.offset)
+        return json.loads(f.readline())
+
+def reload_json(filepaths:Iterable[str], workers:int = 8, decode_processes:int = 0) -> Iterator[tuple[str, Union[dict, Error]]]:
+    """Read already loaded records again, in order.
+
+    Files are loaded with `load_json_files`. Records from line-delimited files 
+    (`LinePath`s) are read from their byte offsets, keeping each file open 
+    while consecutive records come from it; compressed files are only 
+    decompressed once as long as their records are requested in file order.
+
+    Yields:
+    result (tuple[str, dict|Error]) -- file path and decoded JSON or Error
+    """
+
+    for is_line, group in itertools.groupby(filepaths, key=lambda filepath: isinstance(filepath, LinePath)):
+        if not is_line:
+            yield from load_json_files(group, workers=workers, decode_processes=decode_processes, ordered=True)
+            continue
+
+        f = None
+        current = None
+        position = 0
+        try:
+            for location in group:
+                try:
+                    # Reopen compressed files instead of seeking backwards through them
+                    if current != location.path or (location.offset < position and _is_compressed(location.path)):
+                        if f is not None:
+                            f.close()
+                        f = _open_lines(location.path)
+                        current = location.path
+                        position = 0
+                    _seek(f, location.path, location.offset, position)
+                    raw = f.readline()
+                    position = location.offset + len(raw)
+                    yield location, json.loads(raw)
+                except (OSError, EOFError, zlib.error) as e:
+                    yield location, Error('json-read', "Could not read file.", str(e))
+                except (json.decoder.JSONDecodeError, UnicodeDecodeError) as e:
+                    yield location, Error('json-decode', ("Could not decode JSON on line {}.", location.line), str(e))
+        finally:
+            if f is not None:
+                f.close()
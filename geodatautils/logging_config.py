@@ -3,7 +3,21 @@
 Filters and helpers to format logging as desired."""
 
 
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Union
+
+
+# Logging modes: write from a background thread or in the calling thread
+LOG_MODES = ("queue", "direct")
+
+# Writes queued messages to the root handlers while queue logging is on
+_listener = None
+
+# Log each record of a batch instead of one summary line
+_verbose = False
 
 
 class DefaultIndent(logging.Filter, ):
@@ -35,3 +49,89 @@ class LogFormat:
     def spaces(n):
         """Generate a specified number of spaces."""
         return " "*n
+
+
+def start_logging(mode:str = "queue", verbose:bool = False) -> None:
+    """Set up logging for a command line run.
+
+    The root logger is set to the lowest level of its handlers, so messages no
+    handler would write are dropped before any work is done on them. In
+    'queue' mode the root handlers are moved behind a `QueueHandler` and a
+    `QueueListener` writes to them from a background thread, so formatting
+    lines and writing to the console and log file is off the hot path. In
+    'direct' mode the handlers write in the calling thread.
+
+    Arguments:
+    mode (str) -- 'queue' or 'direct'
+    verbose (bool) -- log every record of a batch instead of a summary line
+    """
+
+    global _listener, _verbose
+
+    if mode not in LOG_MODES:
+        raise ValueError("Unknown log mode '{}'; choose from {}.".format(mode, ", ".join(LOG_MODES)))
+
+    _verbose = verbose
+
+    root = logging.getLogger()
+    handlers = [handler for handler in root.handlers if not isinstance(handler, QueueHandler)]
+    if handlers:
+        root.setLevel(min(handler.level for handler in handlers))
+
+    if mode != "queue" or _listener is not None:
+        return
+
+    # Hand records to a background thread; each handler keeps its own level
+    records = queue.SimpleQueue()
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+    _listener.start()
+    atexit.register(stop_logging)
+
+def flush_logs() -> None:
+    """Wait until queued messages are written, e.g. before prompting the user."""
+
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+def stop_logging() -> None:
+    """Write queued messages and give the root handlers back to the root logger."""
+
+    global _listener
+
+    if _listener is None:
+        return
+
+    _listener.stop()
+    root = logging.getLogger()
+    for handler in [handler for handler in root.handlers if isinstance(handler, QueueHandler)]:
+        root.removeHandler(handler)
+    for handler in _listener.handlers:
+        root.addHandler(handler)
+    _listener = None
+
+def is_verbose() -> bool:
+    """Check if every record of a batch should be logged."""
+    return _verbose
+
+def log_records(records:list, summary:Union[str, None] = None, indent:int = 2) -> None:
+    """Log the file of every record in verbose mode, otherwise a summary line.
+
+    Arguments:
+    records (list[Record]) -- records to log
+    summary (str|None) -- message with a `{}` for the number of records and
+        one for the plural 's'; nothing is logged outside verbose mode if None
+    indent (int) -- indent level of the lines
+    """
+
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+
+    if _verbose:
+        for record in records:
+            record.log_record(level='debug', indent=indent)
+    elif summary and records:
+        logging.debug(summary.format(len(records), ("" if len(records)==1 else "s")), extra={'indent': LogFormat.indent(indent)})
@@ -5,100 +5,745 @@ Manage Solr instance by updating the index.
 
 
 import logging
-
-from geodatautils import config
-from .helpers import create_file_list, open_json, RecordSet
-from .logging_config import LogFormat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Union
+
+import requests
+
+from geodatautils import get_config
+from .cache import ValidationCache
+from .helpers import chunked, create_file_list, Error, fingerprint, FINGERPRINT_FIELD, LinePath, Record, RecordSet
+from .journal import open_journal
+from .loader import load_json_files, reload_json
+from .logging_config import flush_logs, LogFormat, log_records
+from .metrics import metrics
+from .serialize import batch_documents, stream_batches
 from .solr import Solr
+from .uid_index import open_uid_index
 from . import schema
 
 
-def add(in_path:str, solr_instance_name:str, confirm_action:bool=False, metadata_schema:str=config['metadata-schema']['default']) -> None:
-    """Update a Solr instance with the given GeoBlacklight JSONs."""
+# Location of the validation cache if not set in the config
+DEFAULT_CACHE_PATH = "~/.geodatautils/validation-cache.sqlite"
+
+
+def add(in_path:Union[str, list[str]], solr_instance_name:Union[str, list[str]], confirm_action:bool=False, metadata_schema:Union[str, None]=None, workers:Union[int, None]=None, use_cache:bool=True, solr:Union[Solr, None]=None) -> bool:
+    """Update one or more Solr instances with the given GeoBlacklight JSONs.
+
+    Files are opened concurrently, then validated and checked in batches, after 
+    which their data is released from memory. If no errors are found the files 
+    are read again and streamed to Solr in batches limited by document count 
+    and size, with a single commit at the end. A record whose content no longer 
+    matches the fingerprint taken when it was validated stops the upload.
+
+    Given several instances, e.g. to promote a harvest from test to 
+    production, records are validated and serialized once and every batch is 
+    sent to all instances at the same time (see `publish_files`). Existing 
+    UIDs are checked in each instance. An instance that fails does not stop 
+    the upload to the others; the result is reported for each instance.
+
+    Schema validation and error check results are cached on disk by file 
+    content, so files that have not changed since a previous run are not 
+    checked again.
+
+    Every batch Solr accepts is recorded in a journal for each instance (see 
+    `geodatautils.journal`), so an upload that stops partway can be finished 
+    with `resume`.
+
+    Arguments:
+    in_path (str|list[str]) -- path to a JSON or line-delimited JSON file or 
+        a directory of such files, or a list of such paths
+    solr_instance_name (str|list[str]) -- name of a Solr instance in the 
+        config, or a list of names
+    confirm_action (bool) -- ask the user to confirm before uploading
+    metadata_schema (str|None) -- name of a metadata schema in the config; 
+        defaults to the config's default schema
+    workers (int|None) -- number of threads opening files; defaults to config
+    use_cache (bool) -- use the validation cache if it is enabled in the config
+    solr (Solr|None) -- an already connected Solr object to reuse, when adding 
+        to a single instance
+
+    Returns:
+    uploaded (bool) -- True if the records were uploaded to and committed in 
+        every instance
+    """
+
+    # Use the default metadata schema unless another is given
+    if metadata_schema is None:
+        metadata_schema = get_config()['metadata-schema']['default']
+
+    # Initialize solr instances
+    instance_names = [solr_instance_name] if isinstance(solr_instance_name, str) else solr_instance_name
+    solrs = [solr] if solr is not None else [Solr(name) for name in instance_names]
+    instances = ", ".join(target.name for target in solrs)
 
-    # Initialize error tracker, tracks if any errors have been found. If so, program will stop before pushing to solr
-    errors = False
+    # Get list of geoblacklight json files to process
+    in_paths = [in_path] if isinstance(in_path, str) else in_path
+    with metrics.stage('discover'):
+        file_list = [filepath for path in in_paths for filepath in create_file_list(path)]
+    metrics.count('files', len(file_list))
 
-    # Initialize records store
-    record_set = RecordSet()
+    # Check that file_list is not empty
+    if len(file_list) < 1:
+        logging.info("No documents found in '{}'; exiting.".format("', '".join(in_paths)))
+        return False
+
+    # Journal uploads if enabled
+    journals = {}
+    for target in solrs:
+        journal = open_journal(target.name)
+        if journal is not None:
+            journals[target.name] = journal
+
+    # Load, validate and check files
+    record_set, errors = load_records(file_list, metadata_schema, workers=workers, use_cache=use_cache, fingerprints=True)
+
+    # Remove any spilled record data once done
+    with record_set:
+
+        # Count records; a line-delimited file holds many
+        record_count = len(record_set.records)
+
+        # Check for records that already exist in each index
+        for target in solrs:
+            logging.info("Checking {} documents against {}.".format(record_count, target.name))
+            with metrics.stage('existing-uid'):
+                errors = schema.check_existing_uids(record_set, target) or errors
+
+        # Log errors and warnings
+        record_set.log_errors_and_warnings(indent=1)
+
+        # Upload records if no errors
+        if not errors:
+
+            # Confirm upload if desired
+            if confirm_action:
+                flush_logs()
+                confirm = input("Are you sure you want to upload {} record{} to instance{} {}? (y/N)".format(record_count, ("" if record_count==1 else "s"), ("" if len(solrs)==1 else "s"), instances))
+                if confirm.lower() != "y": 
+                    logging.info("Operation aborted by user.")
+                    return False
+
+                logging.debug("User confirmed upload. Uploading {} document{} to {}.".format(record_count, ("" if record_count==1 else "s"), instances))
+        
+            else:
+                logging.info("Uploading {} document{} to {}.".format(record_count, ("" if record_count==1 else "s"), instances))
+
+            # Log file names that will be uploaded
+            log_records(list(record_set.records.values()), "Uploading {} record{}.")
+
+            # Update solr indexes
+            """Note: there is a risk of a time-of-check time-of-use (TOCTOU) error with this code
+            structure because we check Solr for duplicates and later upload."""
+            try:
+                for target in solrs:
+                    if target.name in journals:
+                        journals[target.name].create(target, in_paths, record_set.records)
+                records = list(record_set.records.values())
+                failures = publish_files(solrs, [record.data_path for record in records], workers=workers, journals=journals, expected=[record.fingerprint for record in records])
+                sources = {uid: record.filepath for uid, record in record_set.records.items()}
+                return _finish_upload(solrs, failures, sources, record_count, journals)
+            finally:
+                for journal in journals.values():
+                    journal.close()
+
+        else: 
+            logging.warning("Exited with errors; check log.")
+            return False
+
+def resume(solr_instance_name:str, confirm_action:bool=False, workers:Union[int, None]=None) -> bool:
+    """Finish an upload to a Solr instance that stopped partway.
+
+    The journal of the instance's last upload lists every record and the 
+    batches Solr accepted. Only the records after the last accepted batch are 
+    read again and sent, without validating them again, and the upload is 
+    then committed. A record whose content changed since it was validated 
+    stops the upload; add it again instead.
+
+    Arguments:
+    solr_instance_name (str) -- name of a Solr instance in the config
+    confirm_action (bool) -- ask the user to confirm before uploading
+    workers (int|None) -- number of threads opening files; defaults to config
+
+    Returns:
+    uploaded (bool) -- True if the upload was finished and committed
+    """
+
+    solr = Solr(solr_instance_name)
+
+    # Load the journal of the last upload
+    journal = open_journal(solr_instance_name)
+    if journal is None:
+        logging.error("Journaling is turned off in the config; there is nothing to resume.")
+        return False
+    try:
+        journal.read()
+    except FileNotFoundError:
+        logging.error("No upload to {} to resume.".format(solr_instance_name))
+        return False
+    except ValueError as e:
+        logging.error(str(e))
+        return False
+
+    with journal:
+        started = journal.run['started']
+        if journal.committed:
+            logging.info("The last upload to {} (started {}) finished; nothing to resume.".format(solr_instance_name, started))
+            return True
+        if journal.run['url'] != solr.url:
+            logging.error("The last upload was to {}, but {} is now {}; add the records again instead.".format(journal.run['url'], solr_instance_name, solr.url))
+            return False
+
+        remaining = journal.remaining()
+        count = len(remaining)
+        logging.info("Resuming upload to {} started {}: {} of {} record{} sent, {} left.".format(
+            solr_instance_name, started, journal.sent, len(journal.records), ("" if len(journal.records)==1 else "s"), count))
+
+        # Confirm upload if desired
+        if confirm_action and remaining:
+            flush_logs()
+            confirm = input("Are you sure you want to upload the remaining {} record{} to instance {}? (y/N)".format(count, ("" if count==1 else "s"), solr_instance_name))
+            if confirm.lower() != "y":
+                logging.info("Operation aborted by user.")
+                return False
+
+        # Send the rest, checking that each record is still what was validated
+        filepaths = [LinePath(entry['file'], entry['line'], entry['offset']) if 'line' in entry else entry['file'] for entry in journal.records]
+        failures = publish_files([solr], filepaths[journal.sent:], workers=workers, journals={solr.name: journal}, expected=[entry['hash'] for entry in remaining])
+        sources = {entry['uid']: filepath for entry, filepath in zip(journal.records, filepaths)}
+        return _finish_upload([solr], failures, sources, count, {solr.name: journal})
+
+def _finish_upload(solrs:list[Solr], failures:dict[str, Exception], sources:dict[str, str], count:int, journals:dict) -> bool:
+    """Commit the instances an upload succeeded in and report each instance.
+
+    Arguments:
+    solrs (list[Solr]) -- instances the records were sent to
+    failures (dict[str, Exception]) -- error of each instance that failed
+    sources (dict[str, str]) -- file each uploaded record came from, keyed by UID
+    count (int) -- number of records sent
+    journals (dict[str, Journal]) -- journal of each instance, if journaled
+
+    Returns:
+    uploaded (bool) -- True if every instance took the records and committed
+    """
+
+    # Commit once all batches are sent, in every instance that took them
+    with metrics.stage('commit'):
+        commits = _on_instances([target for target in solrs if target.name not in failures], Solr.commit)
+    failures.update(_failed(commits))
+
+    # Report each instance
+    for target in solrs:
+        journal = journals.get(target.name)
+        if target.name in failures:
+            logging.error("Upload to {} failed: {}".format(target.name, failures[target.name]))
+            if journal is not None:
+                logging.info("Run `update_solr -i {} --resume` to send the remaining records.".format(target.name), extra={'indent': LogFormat.indent(1)})
+            continue
+
+        if journal is not None:
+            journal.commit(getattr(commits[target.name], 'status_code', None))
+
+        # Remember which files the records came from
+        uid_index = open_uid_index(target)
+        if uid_index is not None:
+            with uid_index:
+                uid_index.add_sources(sources)
+
+        logging.info("Successfully uploaded {} document{} to {}.".format(count, ("" if count==1 else "s"), target.name))
+
+    return not failures
+
+def sync(in_path:str, solr_instance_name:str, confirm_action:bool=False, metadata_schema:Union[str, None]=None, workers:Union[int, None]=None, use_cache:bool=True, provenance:Union[str, None]=None, collection:Union[str, None]=None) -> None:
+    """Make a Solr instance match the given GeoBlacklight JSONs.
+
+    Local records are validated like `add`, then compared with the UIDs and 
+    content fingerprints already in the index. Only records that are new or 
+    changed are uploaded, and indexed records that are not in the input are 
+    deleted. Use `provenance` or `collection` to limit the deletions to part 
+    of the index.
+
+    Arguments:
+    in_path (str) -- path to a JSON file or a directory of JSON files
+    solr_instance_name (str) -- name of a Solr instance in the config
+    confirm_action (bool) -- ask the user to confirm before changing the index
+    metadata_schema (str|None) -- name of a metadata schema in the config; 
+        defaults to the config's default schema
+    workers (int|None) -- number of threads opening files; defaults to config
+    use_cache (bool) -- use the validation cache if it is enabled in the config
+    provenance (str|None) -- only delete indexed records of this provenance
+    collection (str|None) -- only delete indexed records in this collection
+    """
+
+    # Use the default metadata schema unless another is given
+    if metadata_schema is None:
+        metadata_schema = get_config()['metadata-schema']['default']
 
     # Initialize solr instance
     solr = Solr(solr_instance_name)
 
     # Get list of geoblacklight json files to process
-    file_list = create_file_list(in_path)
+    with metrics.stage('discover'):
+        file_list = create_file_list(in_path)
+    metrics.count('files', len(file_list))
 
     # Check that file_list is not empty
     if len(file_list) < 1:
         logging.info("No documents found in '{}'; exiting.".format(in_path))
         return
 
-    # Load files into records
-    logging.info("Opening {} documents.".format(len(file_list)))
-    for filepath in file_list:
+    # Load, validate and check files
+    record_set, errors = load_records(file_list, metadata_schema, workers=workers, use_cache=use_cache, fingerprints=True)
 
-        # Open the file
-        data = open_json(filepath)
+    # Remove any spilled record data once done
+    with record_set:
 
-        # Check if record UID already exists in record set
-        if data['dc_identifier_s'] in record_set.records.keys():
+        # Log errors and warnings
+        record_set.log_errors_and_warnings(indent=1)
 
-            # Add error to record
-            msg = "Another input file has the same UID and could not be opened."
-            debug = "'{}'".format(filepath)
-            record_set.records[data['dc_identifier_s']].add_error('uid-collision', msg, debug)
+        if errors:
+            logging.warning("Exited with errors; check log.")
+            return
+
+        # Build scope of comparison
+        filter_queries = []
+        if provenance:
+            filter_queries.append('dct_provenance_s:"{}"'.format(provenance))
+        if collection:
+            filter_queries.append('dct_isPartOf_sm:"{}"'.format(collection))
+        filter_query = " AND ".join(filter_queries) or None
+
+        # Get fingerprints of indexed records
+        logging.info("Comparing {} documents with {}{}.".format(len(record_set.records), solr_instance_name, (" where {}".format(filter_query) if filter_query else "")))
+        with metrics.stage('fetch-index'):
+            indexed = fetch_fingerprints(solr, fq=filter_query)
+
+        # Indexed records outside the scope can be deleted
+        deletions = [doc for uid, doc in indexed.items() if uid not in record_set.records]
+
+        # Look up input records that are outside the scope
+        if filter_query:
+            with metrics.stage('fetch-index'):
+                indexed.update(fetch_fingerprints_by_uid(solr, [uid for uid in record_set.records.keys() if uid not in indexed]))
+
+        # Compute uploads
+        adds = [record for uid, record in record_set.records.items() if uid not in indexed]
+        changes = [record for uid, record in record_set.records.items() if uid in indexed and indexed[uid].get(FINGERPRINT_FIELD) != record.fingerprint]
+
+        # Log differences
+        for label, items in (("new", adds), ("changed", changes)):
+            logging.info("{} {} record{}".format(len(items), label, ("" if len(items)==1 else "s")), extra={'indent': LogFormat.indent(1)})
+            log_records(items)
+        logging.info("{} record{} to delete".format(len(deletions), ("" if len(deletions)==1 else "s")), extra={'indent': LogFormat.indent(1)})
+        for doc in deletions:
+            logging.debug(doc['dc_identifier_s'], extra={'indent': LogFormat.indent(2, tree=True)})
+
+        # Exit if nothing changed
+        if not (adds or changes or deletions):
+            logging.info("{} is already in sync; nothing to do.".format(solr_instance_name))
+            return
 
-            errors = True
+        # Confirm sync if desired
+        if confirm_action:
+            flush_logs()
+            confirm = input("Are you sure you want to upload {} and delete {} record{} in instance {}? (y/N)".format(len(adds)+len(changes), len(deletions), ("" if len(deletions)==1 else "s"), solr_instance_name))
+            if confirm.lower() != "y": 
+                logging.info("Operation aborted by user.")
+                return
 
-            # Skip adding record to set
-            continue
+        # Upload new and changed records
+        upload_records(solr, adds + changes, workers=workers)
 
-        # Add record to record set
-        record_set.add_record(data, filepath)
+        # Delete records missing from input
+        for chunk in chunked(deletions, get_config().get('upload', {}).get('batch-size', 1000)):
+            with metrics.stage('delete'):
+                raw_response = solr.delete(ids=[doc[solr.unique_key] for doc in chunk], commit=False)
+            raw_response.raise_for_status()
+            metrics.count('documents_deleted', len(chunk))
 
-    # Validate schema of records
-    logging.info("Validating schema of {} documents.".format(len(file_list)))
-    errors = schema.validate(record_set, metadata_schema) or errors
+        # Commit all changes at once
+        with metrics.stage('commit'):
+            solr.commit()
 
-    # Check for errors in records
-    logging.info("Checking {} documents for errors.".format(len(file_list)))
-    errors = schema.error_check(record_set, solr) or errors
+        logging.info("Successfully synced {}: {} uploaded, {} deleted.".format(solr_instance_name, len(adds)+len(changes), len(deletions)))
 
-    # Log errors and warnings
-    record_set.log_errors_and_warnings(indent=1)
+def load_records(file_list:list[str], metadata_schema:str, workers:Union[int, None]=None, use_cache:bool=True, fingerprints:bool=False, file_digests:Union[dict, None]=None) -> tuple[RecordSet, bool]:
+    """Open, validate and check files in batches.
 
-    # Upload records if no errors
-    if not errors:
+    Each batch is validated and checked, then its record data is released so 
+    only one batch of documents is held in memory at a time.
 
-        # Confirm upload if desired
-        if confirm_action:
-            confirm = input("Are you sure you want to upload {} record{} to instance {}? (y/N)".format(len(file_list), ("" if len(file_list)==1 else "s"), solr_instance_name))
-            if confirm.lower() != "y": 
-                logging.info("Operation aborted by user.")
-                return
+    Arguments:
+    file_list (list[str]) -- paths to JSON or line-delimited JSON files
+    metadata_schema (str) -- name of a metadata schema in the config
+    workers (int|None) -- number of threads opening files; defaults to config
+    use_cache (bool) -- use the validation cache if it is enabled in the config
+    fingerprints (bool) -- store a content fingerprint on each record
+    file_digests (dict|None) -- if given, filled with the SHA-256 hash of each
+        file as it was read and validated, keyed by path
 
-            logging.debug("User confirmed upload. Uploading {} document{} to {}.".format(len(file_list), ("" if len(file_list)==1 else "s"), solr_instance_name))
-        
-        else:
-            logging.info("Uploading {} document{} to {}.".format(len(file_list), ("" if len(file_list)==1 else "s"), solr_instance_name))
+    Returns:
+    record_set (RecordSet) -- the checked records, without their data; close 
+        it (or use it as a context manager) to remove any spilled data
+    errors (bool) -- True if there were errors; False if no errors occured
+    """
 
-        # Log file names that will be uploaded
-        for record in record_set.records.values():
-            record.log_record(level='debug', indent=2)
+    # Initialize error tracker, tracks if any errors have been found. If so, program will stop before pushing to solr
+    errors = False
 
-        # Update solr index
-        """Note: there is a risk of a time-of-check time-of-use (TOCTOU) error with this code
-        structure because we check Solr for duplicates and later upload."""
-        data = str(list(map(lambda record: record.data, record_set.records.values()))).encode()
-        raw_response = solr.update(data)
+    config = get_config()
+
+    # Initialize records store, spilling released data to disk if configured
+    record_set = RecordSet(spill_dir=config.get('loading', {}).get('spill-dir'))
+
+    # Get batch size
+    batch_size = config.get('upload', {}).get('batch-size', 1000)
+
+    # Get loader settings
+    if workers is None:
+        workers = config.get('loading', {}).get('workers', 8)
+    decode_processes = config.get('loading', {}).get('decode-processes', 0)
+
+    # Open validation cache
+    cache = open_validation_cache(metadata_schema) if use_cache else None
+
+    # Load, validate and check files one batch at a time
+    logging.info("Opening and validating {} file{}.".format(len(file_list), ("" if len(file_list)==1 else "s")))
+    loaded_files = load_json_files(file_list, workers=workers, decode_processes=decode_processes, ordered=True, with_digest=True, file_digests=file_digests)
+    for file_chunk in metrics.timed_iter(chunked(loaded_files, batch_size), 'load'):
+
+        # Load files into records
+        records = []
+        unchecked = []
+        collisions = []
+        for filepath, data, digest in file_chunk:
+
+            # Track files that could not be opened
+            if isinstance(data, Error):
+                record_set.add_failed_file(filepath, data)
+                errors = True
+                continue
+
+            # Records are JSON objects keyed by their UID; report others like unreadable files
+            if not isinstance(data, dict):
+                record_set.add_failed_file(filepath, Error('json-object', "File is not a JSON object.", "Top-level value is a {}.".format(type(data).__name__)))
+                errors = True
+                continue
+            if not isinstance(data.get('dc_identifier_s'), str):
+                record_set.add_failed_file(filepath, Error('missing-uid', "Record has no UID (dc_identifier_s).", None))
+                errors = True
+                continue
+
+            # Check if record UID already exists in record set
+            if data['dc_identifier_s'] in record_set.records.keys():
+
+                # Add error to record after checks so it is not cached
+                collisions.append((data['dc_identifier_s'], filepath))
+
+                errors = True
+
+                # Skip adding record to set
+                continue
+
+            # Add record to record set
+            record = record_set.add_record(data, filepath)
+            records.append(record)
+
+            if fingerprints:
+                record.fingerprint = fingerprint(data)
+
+            # Reuse cached results for unchanged files
+            with metrics.stage('cache'):
+                cached_invalid = cache.restore(record, digest) if cache else None
+            if cached_invalid is None:
+                unchecked.append((record, digest))
+            else:
+                record.invalid = cached_invalid
+                errors = cached_invalid or bool(record.has_errors) or errors
+
+        metrics.count('records', len(records))
+
+        # Validate schema of records
+        with metrics.stage('validate'):
+            errors = schema.validate_records([record for record, _ in unchecked], metadata_schema) or errors
+
+        # Check for errors in records
+        with metrics.stage('error-checks'):
+            errors = schema.check_records([record for record, _ in unchecked]) or errors
+
+        # Cache results
+        if cache:
+            with metrics.stage('cache'):
+                for record, digest in unchecked:
+                    cache.store(record, digest, record.invalid)
+                cache.commit()
+
+        # Add errors for UID collisions
+        for uid, filepath in collisions:
+            record = record_set.records[uid]
+            msg = "Another input file has the same UID and could not be opened."
+            debug = "'{}' and '{}'".format(record.filepath, filepath)
+            record.add_error('uid-collision', msg, debug)
+
+        # Release record data; it is read again from disk when uploading
+        for record in records:
+            record_set.release(record)
+
+    # Log cache use
+    if cache:
+        cache.log_stats(indent=1)
+        cache.close()
+
+    return record_set, errors
+
+def upload_records(solr:Solr, records:list[Record], workers:Union[int, None]=None) -> None:
+    """Read records from disk again and post them to Solr in batches.
+
+    See `upload_files`. Records loaded with fingerprints are checked against 
+    them, so a file that changed since it was validated is not sent.
+
+    Arguments:
+    solr (Solr) -- initilized solr object (geodatautils.solr.Solr)
+    records (list[Record]) -- validated records to upload
+    workers (int|None) -- number of threads opening files; defaults to config
+    """
+
+    expected = [record.fingerprint for record in records]
+    upload_files(solr, [record.data_path for record in records], workers=workers, expected=None if None in expected else expected)
+
+def upload_files(solr:Solr, filepaths:list[str], workers:Union[int, None]=None, expected:Union[list[str], None]=None) -> None:
+    """Read validated files (or lines of line-delimited files) and post them 
+    to Solr in batches.
+
+    See `publish_files`; raises the error of a failed request.
+
+    Arguments:
+    solr (Solr) -- initilized solr object (geodatautils.solr.Solr)
+    filepaths (list[str]) -- paths of validated files or `LinePath`s
+    workers (int|None) -- number of threads opening files; defaults to config
+    expected (list[str]|None) -- fingerprint each record must still have
+    """
+
+    failures = publish_files([solr], filepaths, workers=workers, expected=expected)
+    if failures:
+        raise failures[solr.name]
+
+def publish_files(solrs:list[Solr], filepaths:list[str], workers:Union[int, None]=None, journals:Union[dict, None]=None, expected:Union[list[str], None]=None) -> dict[str, Exception]:
+    """Read validated files (or lines of line-delimited files) and post them 
+    to one or more Solr instances in batches.
+
+    A content fingerprint is added to each document so later syncs can tell 
+    whether it changed. Changes are not committed.
+
+    Each batch is read and serialized once and posted to all instances at the 
+    same time, so adding to several instances takes about as long as adding 
+    to the slowest one. An instance whose request fails gets no further 
+    batches; the others carry on.
+
+    With `stream` set in the `upload` config, each batch is serialized while 
+    it is being sent instead of being built in memory first. Streamed batches 
+    are not retried if the connection fails. Batches are always built first 
+    when there are several instances, since a stream can only be sent once.
+
+    Arguments:
+    solrs (list[Solr]) -- initilized solr objects (geodatautils.solr.Solr)
+    filepaths (list[str]) -- paths of validated files or `LinePath`s
+    workers (int|None) -- number of threads opening files; defaults to config
+    journals (dict[str, Journal]|None) -- open journals, keyed by instance 
+        name, to record each batch in
+    expected (list[str]|None) -- fingerprint each record must still have; a 
+        record that changed stops the upload
+
+    Returns:
+    failures (dict[str, Exception]) -- error of each instance that failed, 
+        keyed by instance name
+    """
+
+    config = get_config()
+
+    # Get upload batch limits
+    batch_size = config.get('upload', {}).get('batch-size', 1000)
+    batch_bytes = config.get('upload', {}).get('batch-bytes', 10*1024*1024)
+
+    # Get serialization settings
+    stream = config.get('upload', {}).get('stream', False)
+    compress = config.get('upload', {}).get('gzip', False)
+    backend = config.get('upload', {}).get('json-backend', 'auto')
+
+    # Get loader settings
+    if workers is None:
+        workers = config.get('loading', {}).get('workers', 8)
+    decode_processes = config.get('loading', {}).get('decode-processes', 0)
+
+    documents = _reload_documents(filepaths, workers, decode_processes, expected)
+
+    # Keep the UID and fingerprint of documents read but not yet journaled
+    unjournaled = deque()
+    if journals:
+        documents = _remember(documents, unjournaled)
+
+    # Serialize batches while sending, or build each batch before sending
+    stream = stream and len(solrs) == 1
+    if stream:
+        batches = stream_batches(documents, batch_size, batch_bytes, backend)
+    else:
+        batches = batch_documents(documents, batch_size, batch_bytes, backend)
+
+    # Time spent waiting for the next batch is reading and serializing; 
+    # streamed batches are serialized while they are uploaded instead
+    failures = {}
+    uploaded = 0
+    for batch in metrics.timed_iter(batches, 'serialize'):
+        active = [solr for solr in solrs if solr.name not in failures]
+        if not active:
+            break
+
+        data = batch if stream else batch[1]
+        with metrics.stage('upload'):
+            results = _on_instances(active, _post_batch, data, compress)
+        failures.update(_failed(results))
+
+        # Streamed batches know their document count once sent; a failed
+        # request may not have read the whole body, so take the rest unsent
+        if stream and _failed(results):
+            batch.drain()
+        count = batch.count if stream else batch[0]
+        sent = len([solr for solr in active if solr.name not in failures])
+        if sent:
+            uploaded += count
+
+        # Journal the batch for each instance
+        if journals:
+            uids, hashes = zip(*[unjournaled.popleft() for _ in range(count)])
+            for solr in active:
+                if solr.name in journals:
+                    result = results[solr.name]
+                    if isinstance(result, Exception):
+                        journals[solr.name].batch(list(uids), list(hashes), _status(result), str(result))
+                    else:
+                        journals[solr.name].batch(list(uids), list(hashes), result)
+
+        metrics.count('documents_uploaded', count * sent)
+        metrics.count('bytes_uploaded', (batch.size if stream else len(batch[1])) * sent)
+        logging.debug("Uploaded batch of {} document{} ({} of {}).".format(count, ("" if count==1 else "s"), uploaded, len(filepaths)), extra={'indent': LogFormat.indent(1)})
+
+    return failures
+
+def _post_batch(solr:Solr, data:Union[bytes, Iterable[bytes]], compress:bool) -> int:
+    """Post a batch of documents without committing, raising any errors.
+
+    Returns:
+    status (int) -- HTTP status of Solr's response
+    """
+
+    raw_response = solr.update(data, commit=False, compress=compress)
+    raw_response.raise_for_status()
+    return raw_response.status_code
+
+def _on_instances(solrs:list[Solr], function:Callable, *args) -> dict:
+    """Call `function(solr, *args)` for every instance at the same time.
+
+    Returns:
+    results (dict) -- value returned for each instance, or the request error 
+        it raised, keyed by instance name
+    """
+
+    # Call directly when there is only one instance, so errors keep their traceback
+    if len(solrs) == 1:
+        try:
+            return {solrs[0].name: function(solrs[0], *args)}
+        except requests.RequestException as e:
+            return {solrs[0].name: e}
+
+    results = {}
+    with ThreadPoolExecutor(max(1, len(solrs)), thread_name_prefix='geodatautils-publish') as executor:
+        futures = {solr.name: executor.submit(function, solr, *args) for solr in solrs}
+    for name, future in futures.items():
+        error = future.exception()
+        if error is not None and not isinstance(error, requests.RequestException):
+            raise error
+        results[name] = error if error is not None else future.result()
+    return results
+
+def _failed(results:dict) -> dict[str, Exception]:
+    """Pick the errors out of `_on_instances` results."""
+    return {name: result for name, result in results.items() if isinstance(result, Exception)}
+
+def _status(error:Exception) -> Union[int, None]:
+    """HTTP status of a failed request, if Solr responded."""
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+def _remember(documents:Iterable[dict], unjournaled:deque) -> Iterator[dict]:
+    """Pass documents through, queueing their UID and fingerprint."""
+
+    for document in documents:
+        unjournaled.append((document.get('dc_identifier_s'), document[FINGERPRINT_FIELD]))
+        yield document
+
+def fetch_fingerprints(solr:Solr, fq:Union[str, None]=None, page_size:int=1000) -> dict[str, dict]:
+    """Get the UID and content fingerprint of every record in the index.
+
+    Pages through the results with a cursor so that large indexes are never 
+    requested in one response.
+
+    Arguments:
+    solr (Solr) -- initilized solr object (geodatautils.solr.Solr)
+    fq (str|None) -- filter query limiting which records are returned
+    page_size (int) -- number of records requested per page
+
+    Returns:
+    indexed (dict[str, dict]) -- documents with the UID, unique key and 
+        fingerprint fields keyed by UID
+    """
+
+    field_list = ",".join(dict.fromkeys(['dc_identifier_s', solr.unique_key, FINGERPRINT_FIELD]))
+    return {doc['dc_identifier_s']: doc for doc in solr.iter_docs(fq=fq, fl=field_list, page_size=page_size)}
+
+def fetch_fingerprints_by_uid(solr:Solr, uids:list[str]) -> dict[str, dict]:
+    """Get the content fingerprint of specific records in the index.
+
+    Arguments:
+    solr (Solr) -- initilized solr object (geodatautils.solr.Solr)
+    uids (list[str]) -- UIDs (`dc_identifier_s`) to look up
+
+    Returns:
+    indexed (dict[str, dict]) -- documents with the UID, unique key and 
+        fingerprint fields keyed by UID, for the UIDs that were found
+    """
 
-        # Raise any errors
-        raw_response.raise_for_status()
-        
-        logging.info("Successfully uploaded {} document{} to {}.".format(len(file_list), ("" if len(file_list)==1 else "s"), solr_instance_name))
+    field_list = ",".join(dict.fromkeys(['dc_identifier_s', solr.unique_key, FINGERPRINT_FIELD]))
+    return {doc['dc_identifier_s']: doc for doc in solr.find_by_uid(uids, fl=field_list)}
+
+def open_validation_cache(metadata_schema:str) -> Union[ValidationCache, None]:
+    """Open the validation cache for a schema if it is enabled in the config."""
+
+    config = get_config()
+    cache_config = config.get('cache', {})
+    if not cache_config.get('enabled', True):
+        return None
+
+    context = ValidationCache.context_hash(metadata_schema, schema.load_schema(metadata_schema), config['error-checks'])
+    return ValidationCache(cache_config.get('path', DEFAULT_CACHE_PATH), context, max_size=cache_config.get('max-size', 100*1024*1024))
 
-    else: 
-        logging.warning("Exited with errors; check log.")
+def _reload_documents(filepaths:list[str], workers:int, decode_processes:int, expected:Union[list[str], None]=None) -> Iterator[dict]:
+    """Read already validated files (or lines of line-delimited files) again 
+    for upload, optionally checking that their fingerprints are as expected."""
+
+    for i, (filepath, data) in enumerate(reload_json(filepaths, workers=workers, decode_processes=decode_processes)):
+
+        # A file that changed or disappeared since it was validated cannot be sent
+        if isinstance(data, Error):
+            logging.critical("Could not reopen '{}' for upload: {}".format(filepath, data.debug))
+            raise SystemExit
+
+        data[FINGERPRINT_FIELD] = fingerprint(data)
+
+        if expected is not None and data[FINGERPRINT_FIELD] != expected[i]:
+            logging.critical("'{}' changed since it was validated; add it again.".format(filepath))
+            raise SystemExit
+
+        yield data
 
 def delete(solr_instance_name:str, query:str, confirm_action:bool=False) -> None:
     """Delete records from Solr instance based on query."""
@@ -112,7 +757,8 @@ def delete(solr_instance_name:str, query:str, confirm_action:bool=False) -> None
     # Get number of records
     """Note: this is vulnerable to time-of-check time-of-use (TOCTOU) errors
     but there is no other way to report how many records will be deleted."""
-    raw_response = solr.select(q=query, rows=0)
+    with metrics.stage('count'):
+        raw_response = solr.select(q=query, rows=0)
     raw_response.raise_for_status()  # Raise any errors
     num_found = raw_response.json()['response']['numFound']
 
@@ -121,20 +767,22 @@ def delete(solr_instance_name:str, query:str, confirm_action:bool=False) -> None
         logging.info("No matching records found. Exiting.")
         return
 
-    # List matching records
+    # List matching records, streamed one page at a time
     logging.info("{} record{} will be deleted".format(num_found, ("" if num_found==1 else "s")))
-    raw_response = solr.select(q=query, rows=num_found, fl='dc_identifier_s')
-    raw_response.raise_for_status()  # Raise any errors
-    for doc in raw_response.json()['response']['docs']:
-        logging.debug(doc['dc_identifier_s'], extra={'indent': LogFormat.indent(1, tree=True)})
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for doc in solr.iter_docs(q=query, fl='dc_identifier_s'):
+            logging.debug(doc['dc_identifier_s'], extra={'indent': LogFormat.indent(1, tree=True)})
     
     # Confirm deletion if desired
     if confirm_action:
+        flush_logs()
         confirm = input("Are you sure you want to delete {} record{} from instance {}? (y/N)".format(num_found, ("" if num_found==1 else "s"), solr_instance_name))
         if confirm.lower() != "y": 
             logging.info("Operation aborted by user.")
             return
 
     # Delete records
-    solr.delete(q=query)
+    with metrics.stage('delete'):
+        solr.delete(q=query)
+    metrics.count('documents_deleted', num_found)
     logging.info("{} record{} successfully deleted.".format(num_found, ("" if num_found==1 else "s")))
\ No newline at end of file
@@ -0,0 +1,253 @@
+"""Metrics
+
+Count, time and summarize the stages of a run.
+
+A process-wide `metrics` registry collects counters (files, records, bytes),
+the time spent in each stage and histograms of Solr request latency. At the
+end of a run the interfaces log a summary and can write the metrics as JSON or
+in the Prometheus textfile format.
+"""
+
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Union
+
+from .logging_config import LogFormat
+
+
+# Upper bounds in seconds of the Solr request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Cumulative histogram of observed values, like a Prometheus histogram."""
+
+    def __init__(self, buckets:tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value:float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q:float) -> float:
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+        }
+
+class Metrics:
+    """Registry of counters, stage durations and histograms for one run.
+
+    Solr request latency histograms are named after the request handler, 
+    e.g. `select` or `update`.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Clear all metrics and start timing a new run."""
+
+        with self.lock:
+            self.started = time.perf_counter()
+            self.counters = {}
+            self.stages = {}  # Stage name to seconds; kept in the order stages first ran
+            self.histograms = {}
+
+    def count(self, name:str, value:Union[int, float] = 1) -> None:
+        """Add to a counter."""
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, stage:str, seconds:float) -> None:
+        """Add time spent in a stage."""
+
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def observe(self, name:str, value:float) -> None:
+        """Add a value to a histogram."""
+
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def stage(self, name:str) -> Iterator[None]:
+        """Time a block of code as part of a stage."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed_iter(self, iterable:Iterable, stage:str) -> Iterator:
+        """Yield from an iterable, timing the wait for each item as part of a stage.
+
+        Useful for lazy pipelines, where work happens when the next item is
+        requested rather than in one block.
+        """
+
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'seconds': time.perf_counter() - self.started,
+                'stages': dict(self.stages),
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+            }
+
+    def log_summary(self, indent:int = 0) -> None:
+        """Log the time spent in each stage, counters and Solr request latency."""
+
+        summary = self.to_dict()
+
+        logging.info("Run summary ({:.2f}s):".format(summary['seconds']), extra={'indent': LogFormat.indent(indent)})
+
+        if summary['stages']:
+            logging.info("Stages:", extra={'indent': LogFormat.indent(indent+1)})
+            for stage, seconds in summary['stages'].items():
+                logging.info("{:<20}{:>9.3f}s".format(stage, seconds), extra={'indent': LogFormat.indent(indent+2)})
+
+        if summary['counters']:
+            logging.info("Counts:", extra={'indent': LogFormat.indent(indent+1)})
+            for name, value in summary['counters'].items():
+                shown = "{:.1f} MB".format(value/1024/1024) if name.startswith("bytes") else "{:,}".format(value)
+                logging.info("{:<20}{:>10}".format(name, shown), extra={'indent': LogFormat.indent(indent+2)})
+
+        with self.lock:
+            histograms = dict(self.histograms)
+        if histograms:
+            logging.info("Solr requests:", extra={'indent': LogFormat.indent(indent+1)})
+            for name, histogram in histograms.items():
+                logging.info("{:<20}{:>6} request{}, mean {:.1f} ms, p50 <= {:.0f} ms, p99 <= {:.0f} ms, max {:.1f} ms".format(
+                    name, histogram.count, ("" if histogram.count==1 else "s"), histogram.sum/histogram.count*1000,
+                    histogram.quantile(0.5)*1000, histogram.quantile(0.99)*1000, histogram.max*1000), extra={'indent': LogFormat.indent(indent+2)})
+
+    def write_json(self, path:str) -> None:
+        """Write the metrics to a JSON file."""
+
+        _write_atomic(path, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, path:str, prefix:str = "geodatautils") -> None:
+        """Write the metrics in the Prometheus textfile collector format.
+
+        The file is replaced atomically, so node_exporter never reads a
+        partly written file.
+        """
+
+        summary = self.to_dict()
+        lines = [
+            "# HELP {}_run_seconds Duration of the last run.".format(prefix),
+            "# TYPE {}_run_seconds gauge".format(prefix),
+            "{}_run_seconds {}".format(prefix, summary['seconds']),
+            "# HELP {}_stage_seconds Time spent in each stage of the last run.".format(prefix),
+            "# TYPE {}_stage_seconds gauge".format(prefix)
+        ]
+        lines += ['{}_stage_seconds{{stage="{}"}} {}'.format(prefix, stage, seconds) for stage, seconds in summary['stages'].items()]
+
+        for name, value in summary['counters'].items():
+            metric = "{}_{}".format(prefix, name)
+            lines += ["# TYPE {} gauge".format(metric), "{} {}".format(metric, value)]
+
+        for name, histogram in summary['histograms'].items():
+            metric = "{}_solr_request_seconds".format(prefix)
+            endpoint = name
+            if "# TYPE {} histogram".format(metric) not in lines:
+                lines += ["# HELP {} Latency of Solr requests in the last run.".format(metric), "# TYPE {} histogram".format(metric)]
+            lines += ['{}_bucket{{endpoint="{}",le="{}"}} {}'.format(metric, endpoint, bound, count) for bound, count in histogram['buckets'].items()]
+            lines += [
+                '{}_bucket{{endpoint="{}",le="+Inf"}} {}'.format(metric, endpoint, histogram['count']),
+                '{}_sum{{endpoint="{}"}} {}'.format(metric, endpoint, histogram['sum']),
+                '{}_count{{endpoint="{}"}} {}'.format(metric, endpoint, histogram['count'])
+            ]
+
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+@contextmanager
+def profiled(path:Union[str, None], profiler:str = "cprofile") -> Iterator[None]:
+    """Profile a block of code and save the result, if a path is given.
+
+    Arguments:
+    path (str|None) -- file to save the profile to; nothing is profiled if None
+    profiler (str) -- 'cprofile' saves pstats data (view with `python -m pstats`
+        or snakeviz); 'pyinstrument' saves an HTML report and must be installed
+    """
+
+    if path is None:
+        yield
+        return
+
+    if profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise SystemExit("The pyinstrument profiler was selected but pyinstrument is not installed.")
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            _write_atomic(path, profile.output_html())
+    else:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+
+    logging.info("Saved profile to '{}'.".format(path))
+
+def _write_atomic(path:str, text:str) -> None:
+    """Write a text file by replacing it in one step."""
+
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, "w", encoding="utf8") as f:
+        f.write(text)
+    os.replace(temporary_path, path)
+
+# Metrics of the current run
+metrics = Metrics()
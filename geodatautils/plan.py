@@ -0,0 +1,258 @@
+"""Plan
+
+Plan adds and deletes ahead of time and apply them later without checking again.
+
+A plan is a JSON file listing what an operation would do: the records to add
+with their validation results, or the records to delete. Planning does all of
+the slow work (opening, validating and checking files, querying Solr), so
+applying a plan during a maintenance window only uploads or deletes. Drift is
+detected by comparing the number of documents and the newest `_version_` in
+the index, and the hashes of input files, with those recorded in the plan.
+"""
+
+
+import datetime
+import json
+import logging
+import os
+from typing import Union
+
+from geodatautils import get_config
+from .helpers import chunked, create_file_list, LinePath
+from .loader import file_digest
+from .logging_config import flush_logs, LogFormat
+from .manage import load_records, upload_files
+from .metrics import metrics
+from .solr import Solr
+from . import schema
+
+
+# Version of the plan file format
+PLAN_FORMAT = 2
+
+
+def index_state(solr:Solr) -> dict:
+    """Get the number of documents and the newest `_version_` in an index.
+
+    Any add, update or delete changes at least one of them, so together they
+    tell whether the index changed, in a single request.
+    """
+
+    raw_response = solr.select(rows=1, fl='_version_', sort='_version_ desc')
+    raw_response.raise_for_status()
+    response = raw_response.json()['response']
+    return {
+        'num-found': response['numFound'],
+        'max-version': response['docs'][0]['_version_'] if response['docs'] else None
+    }
+
+def plan_add(in_path:str, solr_instance_name:str, plan_path:str, metadata_schema:Union[str, None]=None, workers:Union[int, None]=None, use_cache:bool=True) -> bool:
+    """Validate and check records to add and write the result to a plan file.
+
+    Arguments:
+    in_path (str) -- path to a JSON or line-delimited JSON file or a
+        directory of such files
+    solr_instance_name (str) -- name of a Solr instance in the config
+    plan_path (str) -- path to write the plan to
+    metadata_schema (str|None) -- name of a metadata schema in the config; 
+        defaults to the config's default schema
+    workers (int|None) -- number of threads opening files; defaults to config
+    use_cache (bool) -- use the validation cache if it is enabled in the config
+
+    Returns:
+    valid (bool) -- True if the plan can be applied; False if it has errors
+    """
+
+    # Use the default metadata schema unless another is given
+    if metadata_schema is None:
+        metadata_schema = get_config()['metadata-schema']['default']
+
+    solr = Solr(solr_instance_name)
+
+    # Get list of geoblacklight json files to process
+    with metrics.stage('discover'):
+        file_list = create_file_list(in_path)
+    metrics.count('files', len(file_list))
+
+    # Record the index first, so changes made while checking count as drift
+    with metrics.stage('index-state'):
+        state = index_state(solr)
+
+    # Load, validate and check files, hashing them from the same read so
+    # files changed later are caught when applying
+    digests = {}
+    record_set, errors = load_records(file_list, metadata_schema, workers=workers, use_cache=use_cache, fingerprints=True, file_digests=digests)
+
+    # Remove any spilled record data once done
+    with record_set:
+        logging.info("Checking {} documents against {}.".format(len(record_set.records), solr_instance_name))
+        with metrics.stage('existing-uid'):
+            errors = schema.check_existing_uids(record_set, solr) or errors
+        record_set.log_errors_and_warnings(indent=1)
+
+        # List records with their validation results; files that could not be opened have no UID
+        records = [_record_entry(None, record) for record in record_set.failed_files]
+        records += [_record_entry(uid, record) for uid, record in record_set.records.items()]
+
+        plan = _plan('add', solr, state, not errors, {
+            'files': len(file_list),
+            'records': len(record_set.records),
+            'errors': record_set.counts['errors'],
+            'warnings': record_set.counts['warnings']
+        })
+        plan['metadata-schema'] = metadata_schema
+        plan['files'] = {filepath: digests.get(filepath) for filepath in file_list}
+        plan['records'] = records
+        _write_plan(plan_path, plan)
+
+        return not errors
+
+def plan_delete(solr_instance_name:str, query:str, plan_path:str) -> bool:
+    """List the records a delete would remove and write them to a plan file.
+
+    Arguments:
+    solr_instance_name (str) -- name of a Solr instance in the config
+    query (str) -- query matching the records to delete
+    plan_path (str) -- path to write the plan to
+
+    Returns:
+    valid (bool) -- True if the plan can be applied; False if nothing matched
+    """
+
+    logging.info("Plan delete from {} where {}".format(solr_instance_name, query))
+
+    solr = Solr(solr_instance_name)
+
+    # Record the index first, so changes made while listing count as drift
+    with metrics.stage('index-state'):
+        state = index_state(solr)
+
+    # List matching records in one pass
+    field_list = ",".join(dict.fromkeys(['dc_identifier_s', solr.unique_key]))
+    with metrics.stage('list'):
+        docs = [{'uid': doc.get('dc_identifier_s'), 'key': doc[solr.unique_key]} for doc in solr.iter_docs(q=query, fl=field_list, prefetch=True)]
+    for doc in docs:
+        logging.debug(doc['uid'], extra={'indent': LogFormat.indent(1, tree=True)})
+    logging.info("{} record{} would be deleted".format(len(docs), ("" if len(docs)==1 else "s")))
+
+    plan = _plan('delete', solr, state, bool(docs), {'records': len(docs)})
+    plan['query'] = query
+    plan['records'] = docs
+    _write_plan(plan_path, plan)
+
+    return bool(docs)
+
+def apply_plan(plan_path:str, solr_instance_name:str, confirm_action:bool=False, workers:Union[int, None]=None) -> bool:
+    """Carry out a plan written by `plan_add` or `plan_delete`.
+
+    Nothing is validated or queried again. The plan is refused if it has
+    errors, was made for another instance, or if the index or any input file
+    changed since it was made. A record that changes after that check stops
+    the upload when it is read.
+
+    Arguments:
+    plan_path (str) -- path of the plan file
+    solr_instance_name (str) -- name of a Solr instance in the config; must
+        match the plan
+    confirm_action (bool) -- ask the user to confirm before applying
+    workers (int|None) -- number of threads opening files; defaults to config
+
+    Returns:
+    applied (bool) -- True if the plan was applied
+    """
+
+    with open(plan_path, encoding="utf8") as f:
+        plan = json.load(f)
+
+    if plan.get('format') != PLAN_FORMAT:
+        logging.critical("'{}' is not a plan file this version can apply.".format(plan_path))
+        raise SystemExit
+
+    # Refuse plans that cannot or should not be applied
+    if plan['instance'] != solr_instance_name:
+        logging.error("Plan was made for {}, not {}.".format(plan['instance'], solr_instance_name))
+        return False
+    if not plan['valid']:
+        logging.error("Plan has errors or nothing to do; fix them and plan again.")
+        return False
+
+    solr = Solr(solr_instance_name)
+    count = plan['counts']['records']
+    logging.info("Applying plan to {} {} record{} in {}, made {}.".format(plan['operation'], count, ("" if count==1 else "s"), solr_instance_name, plan['created']))
+
+    # Detect drift
+    with metrics.stage('index-state'):
+        state = index_state(solr)
+    if state != plan['index']:
+        logging.error("{} changed since the plan was made ({} documents, newest version {}; planned with {} and {}). Plan again.".format(
+            solr_instance_name, state['num-found'], state['max-version'], plan['index']['num-found'], plan['index']['max-version']))
+        return False
+
+    if plan['operation'] == 'add':
+        with metrics.stage('hash'):
+            changed = [filepath for filepath, digest in plan['files'].items() if not os.path.exists(filepath) or file_digest(filepath) != digest]
+        if changed:
+            logging.error("{} input file{} changed since the plan was made. Plan again.".format(len(changed), ("" if len(changed)==1 else "s")))
+            for filepath in changed:
+                logging.debug(filepath, extra={'indent': LogFormat.indent(1, tree=True)})
+            return False
+
+    # Confirm if desired
+    if confirm_action:
+        action = "upload" if plan['operation'] == 'add' else "delete"
+        flush_logs()
+        confirm = input("Are you sure you want to {} {} record{} {} instance {}? (y/N)".format(action, count, ("" if count==1 else "s"), ("to" if action == "upload" else "from"), solr_instance_name))
+        if confirm.lower() != "y":
+            logging.info("Operation aborted by user.")
+            return False
+
+    if plan['operation'] == 'add':
+        # Upload the planned records, stopping if one changed since planning
+        entries = [entry for entry in plan['records'] if entry['uid'] is not None]
+        filepaths = [LinePath(entry['file'], entry['line'], entry['offset']) if 'line' in entry else entry['file'] for entry in entries]
+        upload_files(solr, filepaths, workers=workers, expected=[entry['fingerprint'] for entry in entries])
+        with metrics.stage('commit'):
+            solr.commit()
+        logging.info("Successfully uploaded {} document{} to {}.".format(count, ("" if count==1 else "s"), solr_instance_name))
+
+    else:
+        # Delete in batches, then commit all changes at once
+        for chunk in chunked(plan['records'], get_config().get('upload', {}).get('batch-size', 1000)):
+            with metrics.stage('delete'):
+                raw_response = solr.delete(ids=[doc['key'] for doc in chunk], commit=False)
+            raw_response.raise_for_status()
+            metrics.count('documents_deleted', len(chunk))
+        with metrics.stage('commit'):
+            solr.commit()
+        logging.info("{} record{} successfully deleted.".format(count, ("" if count==1 else "s")))
+
+    return True
+
+def _plan(operation:str, solr:Solr, state:dict, valid:bool, counts:dict) -> dict:
+    """Start a plan with the fields every operation has."""
+
+    return {
+        'format': PLAN_FORMAT,
+        'operation': operation,
+        'instance': solr.name,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'index': state,
+        'valid': valid,
+        'counts': counts
+    }
+
+def _record_entry(uid:Union[str, None], record) -> dict:
+    """Describe a record and its validation results for a plan."""
+
+    entry = {'uid': uid, 'file': str(record.filepath)}
+    if isinstance(record.filepath, LinePath):
+        entry.update({'file': record.filepath.path, 'line': record.filepath.line, 'offset': record.filepath.offset})
+    entry['fingerprint'] = record.fingerprint
+    entry['errors'] = [[error.label, error.msg, error.debug] for error in record.errors]
+    entry['warnings'] = [[warning.label, warning.msg, warning.debug] for warning in record.warnings]
+    return entry
+
+def _write_plan(plan_path:str, plan:dict) -> None:
+    with open(plan_path, "w", encoding="utf8") as f:
+        json.dump(plan, f, indent=2)
+    logging.info("Wrote plan to '{}'.".format(plan_path))
@@ -6,16 +6,27 @@ geoblacklight.
 
 
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from importlib.resources import files
-from typing import Union
+from itertools import chain
+from typing import Callable, Union
 
 from jsonschema import validators
 from jsonschema.exceptions import SchemaError
 
-from geodatautils import config
-from .helpers import open_json, RecordSet
-from .logging_config import LogFormat
+from geodatautils import get_config
+from .checks import get_rules, run_checks
+from .fastschema import compile_schema, DEFAULT_COMPILED_SCHEMA_PATH
+from .helpers import open_json, Record, RecordSet
+from .logging_config import LogFormat, log_records
 from .solr import Solr
+from .uid_index import open_uid_index
+from .validation import check_record, init_worker, schema_errors, validate_chunk
+
+
+# Smallest number of records worth sending to a validation process pool
+PARALLEL_VALIDATION_MIN_RECORDS = 500
 
 
 def empty_missing(data:dict, fields:Union[str, list]) -> Union[str, None]:
@@ -45,9 +56,35 @@ def empty_missing(data:dict, fields:Union[str, list]) -> Union[str, None]:
     # If no fields are empty or missing
     return None
 
-def error_check(record_set:RecordSet, solr:Solr) -> bool:
-    """Check for errors in a GeoBlacklight JSON file.
+def check_records(records:list[Record]) -> bool:
+    """Run the configured error checks on a list of records.
+
+    The checks are rules from `geodatautils.checks`, compiled once from the 
+    `error-checks` config and run over the records as one batch.
     
+    Arguments:
+    records (list[Record]) -- records to check
+
+    Returns:
+    errors (bool) -- True if there were errors; False if no errors occured
+    """
+
+    # Record record filenames to log for debug
+    log_records(records, "Checking {} record{}.")
+
+    # Run the configured rules over the whole batch
+    run_checks(records, get_rules(get_config()['error-checks']))
+
+    return any(record.has_errors for record in records)
+
+def check_existing_uids(record_set:RecordSet, solr:Solr) -> bool:
+    """Check for existing UIDs (`dc_identifier_s`) in the current Solr index.
+
+    Only the UIDs (the keys of the record set) are used, so this check also 
+    works on records whose data has been released. If the UID index is 
+    enabled in the config, it is refreshed and the UIDs are looked up in it 
+    instead of in Solr.
+
     Arguments:
     record_set (RecordSet) -- a set of Solr records
     solr (Solr) -- initilized solr object (geodatautils.solr.Solr)
@@ -55,53 +92,16 @@ def error_check(record_set:RecordSet, solr:Solr) -> bool:
     Returns:
     errors (bool) -- True if there were errors; False if no errors occured
     """
-    # TODO: much of this function can be replace by the schema validation in most recent validator versions
-    # For example: required and not empty
 
     # Initialize error tracker
     errors = False
 
-    # For each record run checks
-    for uid, record in record_set.records.items():
-
-        data = record.data
-
-        # Record record filename to log for debug
-        record.log_record(level='debug', indent=2)
-
-        # Fields are not null
-        if 'properties-not-null' in config['error-checks'] and type(config['error-checks']['properties-not-null']) == list:
-            fields = config['error-checks']['properties-not-null']
-            for field in fields:
-                error = empty_missing(data, field)
-                
-                if error:
-                    # Compose message
-                    if error == "empty":
-                        msg = "'{}' is empty".format(field)
-                        debug = "{}: {} (\"\", [], and [\"\"] are considered empty)".format(field, data[field])
-                    elif error == "missing":
-                        msg = "Required field '{}' was not found.".format(field)
-                        debug = None
-
-                    # Add error to record
-                    record.add_error('properties-not-null', msg, debug)        
-
-        # Check that dc_identifier_s and layer_slug_s match
-        error_check_name = 'identifier-layer-slug-match'
-        if config['error-checks'][error_check_name] and not empty_missing(data, ['dc_identifier_s', 'layer_slug_s']):
-            if data['dc_identifier_s'] != data['layer_slug_s']:
-                record.add_error(error_check_name, "'dc_identifier_s' and 'layer_slug_s' do not match", "'{}', '{}'".format(data['dc_identifier_s'], data['layer_slug_s']))
-        
-        if record.has_errors:
-            errors = True
-
     # Check for existing UID (`dc_identifier_s`) in current Solr index
     error_check_name = 'existing-uid'
-    if config['error-checks'][error_check_name]:
+    if get_config()['error-checks'][error_check_name]:
 
         # Check that no UIDs are empty or missing
-        if any(map(lambda record: empty_missing(record.data, ['dc_identifier_s']), record_set.records.values())):
+        if "" in record_set.records.keys():
             logging.error("Aborted UID check because at least one UID is empty or missing from an input record.", extra={'indent': LogFormat.indent(1), 'label': LogFormat.label(error_check_name)})
             errors = True
 
@@ -111,85 +111,171 @@ def error_check(record_set:RecordSet, solr:Solr) -> bool:
             # Build UID list
             uid_list = list(record_set.records.keys())
 
-            # Initialize records store
-            records_found = []
-
-            # Break filter query into chunks (neccessary when processing large numbers of JSONs all at once)
-            fq_chunks = solr.build_query_chunks(uid_list, solr.max_uri_size)
-
-            # Query each chunk
-            for fq_chunk in fq_chunks:
-
-                filter_query = "dc_identifier_s:({})".format(fq_chunk)
-
-                # Query 
-                raw_response = solr.select(fq=filter_query, fl='dc_identifier_s', rows=len(fq_chunk))
-
-                # Raise any errors
-                raw_response.raise_for_status()
-
-                # Store any matching records for logging later
-                if raw_response.json()['response']['numFound']:
-                    records_found.extend([doc['dc_identifier_s'] for doc in raw_response.json()['response']['docs']])
+            # Look up UIDs in the local UID index, or in Solr
+            uid_index = open_uid_index(solr)
+            if uid_index is not None:
+                with uid_index:
+                    uid_index.refresh(solr)
+                    records_found = {uid: source for uid, (source, _) in uid_index.lookup(uid_list).items()}
+                    uid_index.log_stats(indent=1)
+            else:
+                records_found = {doc['dc_identifier_s']: None for doc in solr.find_by_uid(uid_list)}
 
             # Add warnings to any matching records
             if records_found:
-                for record_uid in records_found:
+                for record_uid, source in records_found.items():
 
                     # Get record based on UID
                     record = record_set.records[record_uid]
 
-                    # Add warning to record
-                    record.add_warning(error_check_name, "UID {} already exists in the {} index.".format(record_uid, solr.name), "")
+                    # Add warning to record, naming the file it was added from if known
+                    debug = "Added from '{}'".format(source) if source and source != record.filepath else ""
+                    record.add_warning(error_check_name, "UID {} already exists in the {} index.".format(record_uid, solr.name), debug)
                       
 
     return errors
 
-def validate(record_set:RecordSet, schema_name:str) -> bool:
-    """Validate GeoBlacklight JSON schema.
+def error_check(record_set:RecordSet, solr:Solr) -> bool:
+    """Check for errors in a GeoBlacklight JSON file.
     
+    Arguments:
+    record_set (RecordSet) -- a set of Solr records
+    solr (Solr) -- initilized solr object (geodatautils.solr.Solr)
+
     Returns:
-    errors (bool) -- False if all schemas are valid, True if at least one of 
-        the schemas is invalid.
+    errors (bool) -- True if there were errors; False if no errors occured
     """
+    # TODO: much of this function can be replace by the schema validation in most recent validator versions
+    # For example: required and not empty
 
-    # Initialize error tracker
-    errors = False
+    errors = check_records(list(record_set.records.values()))
+    errors = check_existing_uids(record_set, solr) or errors
+
+    return errors
+
+def load_schema(schema_name:str) -> dict:
+    """Load a metadata schema by its name in the config."""
+
+    schema_path = str(files('geodatautils.config.schemas').joinpath(get_config()['metadata-schema']['options'][schema_name]))
+    return open_json(schema_path)
 
-    # Load schema from config
-    schema_path = str(files('geodatautils.config.schemas').joinpath(config['metadata-schema']['options'][schema_name]))
-    schema = open_json(schema_path)
+@lru_cache(maxsize=None)
+def get_validator(schema_name:str) -> "jsonschema.protocols.Validator":
+    """Return a validator for a metadata schema.
+
+    The schema is loaded and checked once per process; later calls return the 
+    same cached validator.
+    """
+
+    schema = load_schema(schema_name)
+    return _compile_validator(schema)
+
+def _compile_validator(schema:dict) -> "jsonschema.protocols.Validator":
+    """Check a schema and build its validator."""
 
     # Set validator
     validator = validators.validator_for(schema)
-    v = validator(schema)
+
+    # Validate schema
+    try:
+        validator.check_schema(schema)
+    except SchemaError as e:
+        logging.error("Schema Error: the input schema '{}' is not valid".format(schema), extra={'indent': LogFormat.indent(2, True)})
 
     # Log validator in debug
     logging.debug("Using '{}' validator".format(validator.__name__), extra={'indent': LogFormat.indent(2)})
 
-    # Validate each record
-    for uid, record in record_set.records.items():
+    return validator(schema)
 
-        # Log the file path for debug
-        record.log_record(level='debug', indent=2)
+@lru_cache(maxsize=None)
+def get_fast_path(schema_name:str) -> Union[Callable[[dict], bool], None]:
+    """Return the generated fast path of a metadata schema, or None if it is
+    turned off in the config or cannot be generated for the schema."""
 
-        data = record.data
+    return _compile_fast_path(load_schema(schema_name))
 
-        # Validate schema
-        try:
-            validator.check_schema(schema)
-        except SchemaError as e:
-            logging.error("Schema Error: the input schema '{}' is not valid".format(schema), extra={'indent': LogFormat.indent(2, True)})
+def _compile_fast_path(schema:dict) -> Union[Callable[[dict], bool], None]:
+    """Generate (or load the cached) fast path of a schema if enabled."""
 
-        # If schema of data is invlaid
-        if not v.is_valid(data):
-            
-            # Add errors to records
-            for error in v.iter_errors(data):
-                for suberror in sorted(error.context, key=lambda e: e.schema_path)[:-1]:
-                    msg = "{}: {}".format(":".join(map(str,list(suberror.schema_path))), suberror.message)
-                    record.add_error("schema-validation", msg, None)
+    compiled_path = _compiled_path()
+    if compiled_path is None:
+        return None
+    return compile_schema(schema, compiled_path)
+
+def _compiled_path() -> Union[str, None]:
+    """Folder of generated fast path code, or None if the fast path is off."""
+
+    schema_config = get_config()['metadata-schema']
+    if not schema_config.get('fast-path', True):
+        return None
+    return schema_config.get('compiled-path', DEFAULT_COMPILED_SCHEMA_PATH)
+
+def validate_records(records:list[Record], schema_name:str, processes:Union[int, None]=None) -> bool:
+    """Validate the GeoBlacklight JSON schema of a list of records.
+
+    Large lists are spread across a process pool when `processes` is set. 
+    Results are merged back in record order so the log output is the same as 
+    validating serially.
+
+    Arguments:
+    records (list[Record]) -- records to validate
+    schema_name (str) -- name of a metadata schema in the config
+    processes (int|None) -- number of validation processes; defaults to the 
+        `processes` setting of `metadata-schema` in the config, 0 validates in 
+        this process
+    
+    Returns:
+    errors (bool) -- False if all schemas are valid, True if at least one of 
+        the schemas is invalid.
+    """
+
+    # Initialize error tracker
+    errors = False
 
+    if processes is None:
+        processes = get_config()['metadata-schema'].get('processes', 0)
+
+    # Validate in a process pool if worth it, otherwise in this process
+    if processes and len(records) >= PARALLEL_VALIDATION_MIN_RECORDS:
+        pool = _get_validation_pool(schema_name, processes)
+        chunk_size = -(-len(records) // (processes * 4))
+        chunks = [[record.data for record in records[i:i+chunk_size]] for i in range(0, len(records), chunk_size)]
+        results = chain.from_iterable(pool.map(validate_chunk, chunks))
+    else:
+        v = get_validator(schema_name)
+        fast_path = get_fast_path(schema_name)
+        results = (check_record(record.data, v, fast_path) for record in records)
+
+    # Log the file paths for debug
+    log_records(records, "Validating {} record{}.")
+
+    # Add errors to records
+    for record, (invalid, messages) in zip(records, results):
+        for msg in messages:
+            record.add_error("schema-validation", msg, None)
+
+        if invalid:
+            record.invalid = True
             errors = True
   
-    return errors
\ No newline at end of file
+    return errors
+
+@lru_cache(maxsize=None)
+def _get_validation_pool(schema_name:str, processes:int) -> ProcessPoolExecutor:
+    """Start a process pool with a compiled validator in each worker.
+
+    Workers only import `geodatautils.validation`, and get the schema and fast 
+    path settings from here, so they never load the config.
+    """
+
+    return ProcessPoolExecutor(processes, initializer=init_worker, initargs=(load_schema(schema_name), _compiled_path()))
+
+def validate(record_set:RecordSet, schema_name:str) -> bool:
+    """Validate GeoBlacklight JSON schema.
+    
+    Returns:
+    errors (bool) -- False if all schemas are valid, True if at least one of 
+        the schemas is invalid.
+    """
+
+    return validate_records(list(record_set.records.values()), schema_name)
@@ -0,0 +1,202 @@
+"""Serialize
+
+Write Solr JSON update bodies from documents, buffered or as a stream.
+"""
+
+
+import json
+import zlib
+from typing import Iterable, Iterator, Union
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+
+def dumps(document:Union[dict, list], backend:str = 'auto') -> bytes:
+    """Serialize an object to JSON bytes.
+
+    Arguments:
+    document (dict|list) -- object to serialize
+    backend (str) -- 'orjson', 'json', or 'auto' to use orjson when installed
+
+    Returns:
+    serialized (bytes) -- UTF-8 encoded JSON
+    """
+
+    if backend != 'json' and orjson is not None:
+        try:
+            return orjson.dumps(document)
+        except TypeError:  # e.g. integers larger than 64 bits; fall back to json
+            pass
+    elif backend == 'orjson':
+        raise ImportError("The 'orjson' JSON backend was selected but orjson is not installed.")
+
+    return json.dumps(document).encode()
+
+def delete_body(q:Union[str, None] = None, ids:Union[Iterable[str], None] = None, backend:str = 'auto') -> Union[bytes, Iterator[bytes]]:
+    """Build the body of a Solr delete command.
+
+    A list of IDs is serialized in one piece; any other iterable of IDs is
+    streamed so the full list never has to be held in memory.
+
+    Arguments:
+    q (str|None) -- delete documents matching this query
+    ids (Iterable[str]|None) -- delete documents with these unique keys
+    backend (str) -- JSON backend; see `dumps`
+
+    Returns:
+    body (bytes|Iterator[bytes]) -- the delete command
+    """
+
+    if ids is None:
+        return dumps({'delete': {'query': q}}, backend)
+    if isinstance(ids, (list, tuple)):
+        return dumps({'delete': list(ids)}, backend)
+    return _stream_delete(ids, backend)
+
+def _stream_delete(ids:Iterable[str], backend:str) -> Iterator[bytes]:
+    """Stream a delete by ID command."""
+
+    yield b'{"delete":['
+    for i, uid in enumerate(ids):
+        yield (b',' if i else b'') + dumps(uid, backend)
+    yield b']}'
+
+def batch_documents(documents:Iterable[dict], max_docs:int, max_bytes:int, backend:str = 'auto') -> Iterator[tuple[int, bytes]]:
+    """Serialize documents into JSON arrays ready to post to Solr.
+
+    Documents are consumed lazily and a batch is closed as soon as it holds
+    `max_docs` documents or its body grows past `max_bytes`, so only one batch
+    is held in memory at a time. A single document larger than `max_bytes` is
+    sent in a batch of its own.
+
+    Arguments:
+    documents (Iterable[dict]) -- documents to serialize
+    max_docs (int) -- maximum number of documents per batch
+    max_bytes (int) -- maximum size of a batch body in bytes
+    backend (str) -- JSON backend; see `dumps`
+
+    Yields:
+    batch (tuple[int, bytes]) -- number of documents in the batch and the
+        serialized JSON array
+    """
+
+    batch = []
+    batch_bytes = 2  # Opening and closing brackets
+
+    for document in documents:
+        serialized = dumps(document, backend)
+
+        # Close current batch if this document would not fit
+        if batch and (len(batch) >= max_docs or batch_bytes + len(serialized) + 1 > max_bytes):
+            yield len(batch), b"[" + b",".join(batch) + b"]"
+            batch = []
+            batch_bytes = 2
+
+        batch.append(serialized)
+        batch_bytes += len(serialized) + 1
+
+    # Send remaining documents
+    if batch:
+        yield len(batch), b"[" + b",".join(batch) + b"]"
+
+class StreamedBatch:
+    """One Solr JSON update body streamed from a shared source of documents.
+
+    Iterating the batch serializes documents one at a time as the request body
+    is sent, until the batch limits are reached. The document count is known
+    once the body has been fully sent. A streamed batch can only be sent once;
+    if sending failed, `drain` takes the rest of its documents unsent.
+    """
+
+    def __init__(self, source:"_Peekable", max_docs:int, max_bytes:int) -> None:
+        self.source = source
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.count = 0
+        self.size = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield b"["
+        self.size = self.size or 2
+
+        while self.source.has_next() and self.count < self.max_docs:
+            serialized = self.source.peek()
+
+            # Leave document for the next batch if it would not fit
+            if self.count and self.size + len(serialized) + 1 > self.max_bytes:
+                break
+
+            yield (b"," if self.count else b"") + next(self.source)
+            self.count += 1
+            self.size += len(serialized) + 1
+
+        yield b"]"
+
+    def drain(self) -> None:
+        """Take the documents of the batch that were not sent, e.g. because
+        the request failed before its body was read, so `count` covers every
+        document in the batch."""
+
+        for _ in self:
+            pass
+
+def stream_batches(documents:Iterable[dict], max_docs:int, max_bytes:int, backend:str = 'auto') -> Iterator[StreamedBatch]:
+    """Split documents into streamed update bodies.
+
+    Like `batch_documents`, but no batch body is ever built in memory: each
+    document is serialized while the request is being sent. Each batch must be
+    sent (fully iterated) before the next one is requested.
+
+    Yields:
+    batch (StreamedBatch) -- iterable request body; see `StreamedBatch`
+    """
+
+    source = _Peekable(dumps(document, backend) for document in documents)
+
+    while source.has_next():
+        batch = StreamedBatch(source, max_docs, max_bytes)
+        yield batch
+
+        # Documents would otherwise be silently skipped or repeated
+        if batch.count == 0:
+            raise RuntimeError("A streamed batch must be sent before the next batch is requested.")
+
+def gzip_stream(chunks:Iterable[bytes], level:int = 6) -> Iterator[bytes]:
+    """Gzip a stream of byte chunks on the fly."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip header
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+class _Peekable:
+    """Iterator wrapper that can look at the next item without consuming it."""
+
+    _empty = object()
+
+    def __init__(self, iterable:Iterable) -> None:
+        self.iterator = iter(iterable)
+        self.next_item = self._empty
+
+    def has_next(self) -> bool:
+        return self.peek() is not self._empty
+
+    def peek(self):
+        if self.next_item is self._empty:
+            self.next_item = next(self.iterator, self._empty)
+        return self.next_item
+
+    def __iter__(self) -> "_Peekable":
+        return self
+
+    def __next__(self):
+        item = self.peek()
+        if item is self._empty:
+            raise StopIteration
+        self.next_item = self._empty
+        return item
@@ -0,0 +1,413 @@
+"""Ingest Server
+
+Keep Geodata Utils running to add records from watched folders and HTTP requests.
+
+Config, schema validators and Solr connections are loaded once and reused by
+every job. New JSON and line-delimited JSON files in the watched drop folders are collected into
+micro-batches, each of which becomes a job that is validated and uploaded like
+`update_solr -a`. Jobs can also be submitted and checked over a small local
+HTTP/JSON API:
+
+    POST /jobs          {"paths": ["path/to/file.json", ...], "instance": "test"}
+    GET  /jobs          list recent jobs
+    GET  /jobs/<id>     status of one job
+"""
+
+
+import ctypes
+import ctypes.util
+import itertools
+import json
+import logging
+import os
+import queue
+import select
+import shutil
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Union
+
+from geodatautils import get_config
+from .helpers import LINE_FILE_EXTENSIONS
+from .logging_config import LogFormat
+from .solr import Solr
+from . import manage
+
+
+# Subfolders of a drop folder that files are moved to once their job finishes
+DONE_FOLDER = "done"
+FAILED_FOLDER = "failed"
+
+# Files picked up from drop folders, the same inputs `update_solr -a` accepts
+DROP_EXTENSIONS = (".json",) + LINE_FILE_EXTENSIONS
+
+# Number of finished jobs kept for status requests
+JOB_HISTORY = 1000
+
+
+class Job:
+    """A set of input paths to validate and upload to one Solr instance."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, paths:list[str], instance:str, drop_folder:Union[str, None] = None) -> None:
+        self.id = next(self._ids)
+        self.paths = paths
+        self.instance = instance
+        self.drop_folder = drop_folder  # Set for jobs from a watched folder
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.message = None
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'instance': self.instance,
+            'paths': self.paths,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'message': self.message
+        }
+
+class IngestServer:
+    """Run add jobs one at a time from a queue fed by drop folders and HTTP."""
+
+    def __init__(self, instance:str, watch:Union[list[str], None] = None, host:Union[str, None] = None, port:Union[int, None] = None) -> None:
+        """Set up the server with settings from the `serve` section of the config.
+
+        Arguments:
+        instance (str) -- name of the Solr instance jobs are uploaded to by default
+        watch (list[str]|None) -- drop folders to watch; defaults to config
+        host (str|None) -- address the HTTP API listens on; defaults to config
+        port (int|None) -- port the HTTP API listens on; defaults to config
+        """
+
+        serve_config = get_config().get('serve', {})
+
+        self.instance = instance
+        self.watch = [os.path.abspath(os.path.expanduser(folder)) for folder in (watch if watch is not None else serve_config.get('watch', []))]
+        self.host = host or serve_config.get('host', '127.0.0.1')
+        self.port = port if port is not None else serve_config.get('port', 8765)
+        self.batch_window = serve_config.get('batch-window', 5)
+        self.max_batch_files = serve_config.get('max-batch-files', 1000)
+        self.poll_interval = serve_config.get('poll-interval', 2)
+
+        self.jobs = OrderedDict()
+        self.queue = queue.Queue()
+        self.solr_instances = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        # Files in drop folders that are waiting in a job
+        self.pending_files = set()
+
+    def submit(self, paths:list[str], instance:Union[str, None] = None, drop_folder:Union[str, None] = None) -> Job:
+        """Queue a job and return it."""
+
+        instance = instance or self.instance
+        if instance not in get_config()['solr instances']:
+            raise ValueError("'{}' is not a Solr instance in the config.".format(instance))
+
+        job = Job(paths, instance, drop_folder)
+        with self.lock:
+            self.jobs[job.id] = job
+
+            # Forget old finished jobs
+            while len(self.jobs) > JOB_HISTORY:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.finished is None:
+                    break
+                self.jobs.popitem(last=False)
+
+        logging.info("Queued job {} with {} path{}.".format(job.id, len(paths), ("" if len(paths)==1 else "s")))
+        self.queue.put(job)
+        return job
+
+    def run_jobs(self) -> None:
+        """Run queued jobs until the server stops."""
+
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            self.run_job(job)
+
+    def run_job(self, job:Job) -> None:
+        """Validate and upload the records of a job, then file away dropped files."""
+
+        job.status = 'running'
+        job.started = time.time()
+        logging.info("Running job {} on {}.".format(job.id, job.instance))
+
+        try:
+            # Reuse connections to each Solr instance
+            if job.instance not in self.solr_instances:
+                self.solr_instances[job.instance] = Solr(job.instance)
+
+            uploaded = manage.add(job.paths, job.instance, solr=self.solr_instances[job.instance])
+            job.status = 'succeeded' if uploaded else 'failed'
+            job.message = None if uploaded else "Records were not uploaded; check log for errors."
+
+        # Keep serving if a job fails unexpectedly
+        except (Exception, SystemExit) as e:
+            logging.exception("Job {} failed.".format(job.id))
+            job.status = 'failed'
+            job.message = "{}: {}".format(e.__class__.__name__, e)
+
+        job.finished = time.time()
+        logging.info("Job {} {} in {:.1f}s.".format(job.id, job.status, job.finished - job.started))
+
+        # Move dropped files out of the way so they are not picked up again
+        if job.drop_folder:
+            destination = os.path.join(job.drop_folder, DONE_FOLDER if job.status == 'succeeded' else FAILED_FOLDER)
+            os.makedirs(destination, exist_ok=True)
+            for filepath in job.paths:
+                try:
+                    shutil.move(filepath, _move_destination(destination, filepath, job))
+                except OSError as e:
+                    logging.warning("Could not move '{}': {}".format(filepath, e), extra={'indent': LogFormat.indent(1)})
+                with self.lock:
+                    self.pending_files.discard(filepath)
+
+    def watch_folders(self) -> None:
+        """Collect new files from the drop folders into jobs."""
+
+        for folder in self.watch:
+            os.makedirs(folder, exist_ok=True)
+
+        # Queue files that were dropped while the server was not running
+        batches = {folder: list(_json_files(folder)) for folder in self.watch}
+        first_seen = {folder: time.time() for folder in self.watch}
+
+        for folder, filepaths in _watch(self.watch, self.poll_interval, self.stopping):
+            if folder is not None:
+                with self.lock:
+                    new_files = [filepath for filepath in filepaths if filepath not in self.pending_files and filepath not in batches[folder]]
+                if new_files and not batches[folder]:
+                    first_seen[folder] = time.time()
+                batches[folder].extend(new_files)
+
+            # Submit a batch once it is full or the batch window has passed
+            for watched_folder, batch in batches.items():
+                if batch and (len(batch) >= self.max_batch_files or time.time() - first_seen[watched_folder] >= self.batch_window):
+                    with self.lock:
+                        self.pending_files.update(batch)
+                    self.submit(batch[:self.max_batch_files], drop_folder=watched_folder)
+                    batches[watched_folder] = batch[self.max_batch_files:]
+                    first_seen[watched_folder] = time.time()
+
+    def serve_forever(self) -> None:
+        """Start the watcher and job threads and serve the HTTP API until interrupted."""
+
+        threads = [threading.Thread(target=self.run_jobs, name="jobs", daemon=True)]
+        if self.watch:
+            threads.append(threading.Thread(target=self.watch_folders, name="watcher", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        httpd = ThreadingHTTPServer((self.host, self.port), _handler(self))
+        logging.info("Serving on http://{}:{}/ (default instance: {}).".format(self.host, self.port, self.instance))
+        for folder in self.watch:
+            logging.info("Watching '{}'.".format(folder), extra={'indent': LogFormat.indent(1)})
+
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Stopping; waiting for the current job to finish.")
+        finally:
+            httpd.server_close()
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+
+def _handler(server:IngestServer) -> type:
+    """Build an HTTP request handler class bound to a server."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self) -> None:
+            parts = self.path.strip("/").split("/")
+            with server.lock:
+                if parts == ['jobs']:
+                    return self.reply(200, {'jobs': [job.to_dict() for job in server.jobs.values()]})
+                if len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit() and int(parts[1]) in server.jobs:
+                    return self.reply(200, server.jobs[int(parts[1])].to_dict())
+            self.reply(404, {'error': "Not found."})
+
+        def do_POST(self) -> None:
+            if self.path.strip("/") != 'jobs':
+                return self.reply(404, {'error': "Not found."})
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+                paths = body['paths']
+                if isinstance(paths, str):
+                    paths = [paths]
+                missing = [path for path in paths if not os.path.exists(path)]
+                if not paths or missing:
+                    raise ValueError("Paths not found: {}".format(missing) if missing else "No paths given.")
+                job = server.submit(paths, body.get('instance'))
+            except (KeyError, TypeError, ValueError) as e:
+                return self.reply(400, {'error': str(e)})
+
+            self.reply(202, job.to_dict())
+
+        def reply(self, status:int, body:dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format:str, *args) -> None:
+            logging.debug("HTTP " + format % args)
+
+    return Handler
+
+def _move_destination(folder:str, filepath:str, job:Job) -> str:
+    """Path to move a dropped file to, never replacing an earlier file.
+
+    A file of the same name already in the folder gets the job's start time
+    and ID added before its extension.
+
+    Raises:
+    FileExistsError -- if that name is taken as well
+    """
+
+    name = os.path.basename(filepath)
+    destination = os.path.join(folder, name)
+    if not os.path.exists(destination):
+        return destination
+
+    extension = next((extension for extension in DROP_EXTENSIONS if name.endswith(extension)), "")
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.localtime(job.started))
+    destination = os.path.join(folder, "{}.{}-job{}{}".format(name[:len(name)-len(extension)], stamp, job.id, extension))
+    if os.path.exists(destination):
+        raise FileExistsError("'{}' already exists".format(destination))
+    return destination
+
+def _is_drop_file(name:str) -> bool:
+    """Whether a file name in a drop folder is an input to pick up."""
+    return name.endswith(DROP_EXTENSIONS) and not name.startswith(".")
+
+def _json_files(folder:str) -> Iterator[str]:
+    """Yield the JSON and line-delimited JSON files directly inside a drop folder."""
+
+    with os.scandir(folder) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if _is_drop_file(entry.name) and entry.is_file():
+                yield entry.path
+
+def _watch(folders:list[str], poll_interval:float, stopping:threading.Event) -> Iterator[tuple[Union[str, None], list[str]]]:
+    """Yield (folder, new files) as files finish arriving in the folders.
+
+    Uses inotify on Linux and falls back to polling elsewhere. `(None, [])` is
+    yielded at least every `poll_interval` seconds so the caller can flush
+    batches.
+    """
+
+    try:
+        watcher = _Inotify(folders)
+    except OSError as e:
+        logging.debug("inotify is not available ({}); polling drop folders.".format(e))
+        yield from _poll(folders, poll_interval, stopping)
+        return
+
+    with watcher:
+        while not stopping.is_set():
+            events = watcher.read(poll_interval)
+            if not events:
+                yield None, []
+            for folder, filepaths in events.items():
+                yield folder, filepaths
+
+def _poll(folders:list[str], poll_interval:float, stopping:threading.Event) -> Iterator[tuple[Union[str, None], list[str]]]:
+    """Poll folders for new files whose size and modification time have settled."""
+
+    # A file is ready once it looks the same on two polls in a row
+    seen = {}
+    ready = set()
+
+    while not stopping.wait(poll_interval):
+        yield None, []
+        for folder in folders:
+            current = set(_json_files(folder))
+            new_files = []
+            for filepath in sorted(current):
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if filepath not in ready and seen.get(filepath) == signature:
+                    ready.add(filepath)
+                    new_files.append(filepath)
+                seen[filepath] = signature
+
+            # Forget files that were moved away, so a new file with the same name is picked up
+            for filepath in [filepath for filepath in seen if os.path.dirname(filepath) == folder and filepath not in current]:
+                seen.pop(filepath)
+                ready.discard(filepath)
+
+            if new_files:
+                yield folder, new_files
+
+class _Inotify:
+    """Minimal inotify watcher for files written or moved into folders (Linux only)."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, folders:list[str]) -> None:
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.folders = {}
+        for folder in folders:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed for '{}'".format(folder))
+            self.folders[wd] = folder
+
+    def read(self, timeout:float) -> dict[str, list[str]]:
+        """Wait for events and return new input files by folder."""
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return {}
+
+        data = os.read(self.fd, 64*1024)
+        events = {}
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset+self.EVENT_HEADER.size:offset+self.EVENT_HEADER.size+length].rstrip(b"\0"))
+            offset += self.EVENT_HEADER.size + length
+
+            if wd in self.folders and _is_drop_file(name):
+                events.setdefault(self.folders[wd], []).append(os.path.join(self.folders[wd], name))
+
+        return events
+
+    def __enter__(self) -> "_Inotify":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        os.close(self.fd)
@@ -4,9 +4,27 @@ Connect to a Solr instance so that you can select or update documents.
 """
 
 
+import asyncio
+import gzip
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Union
+
 import requests  # I chose requests over urllib because although it adds another dependency, it greatly simplifies working with solr
-from requests.compat import urljoin
-from geodatautils import config
+from requests.adapters import HTTPAdapter
+from requests.compat import urljoin, urlparse
+from geodatautils import get_config
+from .helpers import chunked
+from .metrics import metrics
+from .serialize import delete_body, gzip_stream
+
+
+# How writes are made visible; see `Solr.commit`
+COMMIT_STRATEGIES = ("hard", "soft", "within", "none")
+
+# Response status codes that are worth retrying
+RETRY_STATUS_CODES = (429, 503)
 
 
 class Solr:
@@ -15,56 +33,194 @@ class Solr:
     def __init__(self, instance_name:str) -> None:
         """Initiate Solr object with settings from config."""
 
-        self.url = config['solr instances'][instance_name]['url']
-        self.username = config['solr instances'][instance_name]['username']
-        self.password = config['solr instances'][instance_name]['password']
+        config = get_config()
+        instance = config['solr instances'][instance_name]
+
+        self.url = instance['url']
+        self.username = instance['username']
+        self.password = instance['password']
         self.name = instance_name
+
+        # Unique key field of the Solr schema, used for cursor paging and deleting by ID
+        self.unique_key = instance.get('unique-key', 'layer_slug_s')
+
+        # Connection settings
+        self.timeout = (instance.get('connect-timeout', 10), instance.get('read-timeout', 300))
+        self.retries = instance.get('retries', 3)
+        self.backoff_factor = instance.get('backoff-factor', 0.5)
+        self.concurrency = instance.get('concurrency', 4)
+        self.json_backend = config.get('upload', {}).get('json-backend', 'auto')
+
+        # Commit settings
+        self.commit_strategy = instance.get('commit', 'hard')
+        if self.commit_strategy not in COMMIT_STRATEGIES:
+            raise ValueError("Unknown commit strategy '{}' for {}; choose from {}.".format(self.commit_strategy, instance_name, ", ".join(COMMIT_STRATEGIES)))
+        self.commit_within = instance.get('commit-within', 10000)
+        self.wait_searcher = instance.get('wait-searcher', True)
+
+        # Reuse connections and authentication across requests
+        self.session = requests.Session()
+        self.session.auth = (self.username, self.password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(instance.get('pool-size', 10), self.concurrency))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         
         """Max URI size in Kilobytes (KB)
         8 Kilobytes is max, but give 1KB wiggle room for headers
         TODO: I could not figure out the exact amount need for headers, adjust if you can figure it out -HE
         """
-        self.max_uri_size = 7*1024
+        self.max_uri_size = instance.get('max-uri-size', 7*1024)
+
+        # How UID lookups are sent: 'terms' (POSTed terms queries) or 'query' (URI length chunks)
+        self.uid_lookup = instance.get('uid-lookup', 'terms')
+        self.lookup_chunk_size = instance.get('lookup-chunk-size', 1000)
 
     def build_query_chunks(self, items:list[str], target_chunk_size:int) -> list[str]:
-        """For queries that exceed max URI size, chunk out query into smaller pieces."""
+        """For queries that exceed max URI size, chunk out query into smaller pieces.
+        
+        Items are joined with spaces into chunks no longer than the target size. 
+        The input list is not modified.
+        """
+
+        return [" ".join(chunk) for chunk in self._chunk_items(items, target_chunk_size)]
+
+    @staticmethod
+    def _chunk_items(items:list[str], target_chunk_size:int) -> list[list[str]]:
+        """Group items so that each group joined with spaces fits the target size.
+        
+        An item longer than the target size gets a group of its own.
+        """
 
         # Initialize chunks
         chunks = []
-        
-        # Loop until all items are chunked
-        while items:
+        chunk = []
+        chunk_size = 0
 
-            # Initialize chunk
-            chunk = items.pop(0)
+        for item in items:
 
-            # Build chunks
-            while items:
+            # Finish chunk if next item does not fit
+            if chunk and chunk_size + 1 + len(item) > target_chunk_size:
+                chunks.append(chunk)
+                chunk = []
+                chunk_size = 0
 
-                # If next item fits, add it
-                if len(chunk + items[0]) < target_chunk_size:
-                    chunk += " " + items.pop(0)
-                
-                # Oterwise finish chunk
-                else:
-                    break
-            
-            # Store chunk in list
+            # Add item to chunk
+            chunk_size += len(item) + (1 if chunk else 0)
+            chunk.append(item)
+
+        # Store last chunk
+        if chunk:
             chunks.append(chunk)
-            
+
         return chunks
-    
-    def delete(self, q:str="*:*") -> requests.models.Response:
-        """Delete records based on query."""
 
-        data = str({'delete': {'query': q}})
+    def find_by_uid(self, uids:list[str], fl:str='dc_identifier_s') -> list[dict]:
+        """Get the indexed documents matching a list of UIDs (`dc_identifier_s`).
+
+        By default UIDs are sent in chunks of `lookup_chunk_size` as POSTed 
+        `{!terms}` filter queries, which are not limited by URI length. With the 
+        `query` lookup, UIDs are OR'ed in a standard query and split into chunks 
+        that fit in a URI instead. Either way the chunks are queried concurrently.
+
+        Arguments:
+        uids (list[str]) -- UIDs to look up
+        fl (str) -- field list to return for each document
+
+        Several documents may share a UID, so a chunk can match more documents 
+        than it has UIDs; the rest are then requested before moving on.
+
+        Returns:
+        docs (list[dict]) -- documents that were found
+        """
+
+        queries = []
+
+        # POST terms queries
+        if self.uid_lookup == 'terms':
+            for chunk in chunked(uids, self.lookup_chunk_size):
+                separator = _terms_separator(chunk)
+                local_parameters = "f=dc_identifier_s" + ("" if separator == "," else ' separator="{}"'.format(separator))
+                queries.append({'fq': "{{!terms {}}}{}".format(local_parameters, separator.join(chunk)), 'fl': fl, 'rows': len(chunk), 'method': 'POST'})
+
+        # Break filter query into chunks that fit in a URI
+        else:
+            quoted = ['"{}"'.format(uid.replace('\\', '\\\\').replace('"', '\\"')) for uid in uids]
+            for chunk in self._chunk_items(quoted, self.max_uri_size):
+                queries.append({'fq': "dc_identifier_s:({})".format(" ".join(chunk)), 'fl': fl, 'rows': len(chunk)})
+
+        # Query chunks concurrently
+        docs = []
+        for parameters, raw_response in zip(queries, self.select_many(queries)):
+
+            # Raise any errors
+            raw_response.raise_for_status()
+            response = raw_response.json()['response']
+
+            # Request every match if UIDs are shared by several documents
+            if response['numFound'] > len(response['docs']):
+                raw_response = self.select(**dict(parameters, rows=response['numFound']))
+                raw_response.raise_for_status()
+                response = raw_response.json()['response']
+
+            docs.extend(response['docs'])
+
+        return docs
+
+    def commit(self) -> Union[requests.models.Response, None]:
+        """Make pending changes visible according to the commit strategy.
+
+        `hard` sends a hard commit and `soft` a soft commit, which wait for the
+        new searcher to open unless `wait-searcher` is off. `within` sends nothing,
+        since every write already asked Solr to commit within `commit-within` 
+        milliseconds, and `none` leaves commits to Solr's autoCommit settings.
+
+        Returns:
+        raw_response (Response|None) -- response to the commit, or None if no 
+            commit was sent
+        """
+
+        if self.commit_strategy in ("within", "none"):
+            logging.debug("Not committing; {} uses the '{}' commit strategy.".format(self.name, self.commit_strategy))
+            return None
+
+        raw_response = self.request('POST', urljoin(self.url, "update?{}".format("&".join(self._commit_parameters()))), data=b"", headers={"Content-Type": "application/json"})
+        raw_response.raise_for_status()
+        return raw_response
+
+    def _commit_parameters(self) -> list[str]:
+        """Update parameters that commit according to the commit strategy."""
+
+        # Solr waits for the new searcher by default
+        wait = [] if self.wait_searcher else ["waitSearcher=false"]
+        if self.commit_strategy == "hard":
+            return ["commit=true"] + wait
+        elif self.commit_strategy == "soft":
+            return ["softCommit=true"] + wait
+        elif self.commit_strategy == "within":
+            return ["commitWithin={}".format(int(self.commit_within))]
+        return []
+
+    def delete(self, q:str="*:*", ids:Union[Iterable[str], None]=None, commit:bool=True) -> requests.models.Response:
+        """Delete records based on query, or by unique key if IDs are given.
+        
+        IDs given as an iterator are streamed to Solr instead of being 
+        serialized in memory first.
+        """
+
+        data = delete_body(q=q, ids=ids, backend=self.json_backend)
 
-        raw_response = self.update(data)
+        raw_response = self.update(data, commit=commit)
 
         return raw_response
 
-    def select(self, q:str='*:*', fq:str=None, rows:int=None, fl:str=None) -> requests.models.Response:
-        """Select records based on query and field list."""
+    def select(self, q:str='*:*', fq:str=None, rows:int=None, fl:str=None, sort:str=None, cursor_mark:str=None, method:str='GET') -> requests.models.Response:
+        """Select records based on query and field list.
+        
+        Pass `cursor_mark` ("*" for the first page) with a `sort` that includes 
+        the unique key to page through large results with a cursor. Use 
+        `method='POST'` to send the parameters in the request body when they 
+        are too long for a URI.
+        """
 
         select_url = urljoin(self.url, 'select/')
 
@@ -72,24 +228,134 @@ class Solr:
             ('q', q),
             ('fq', fq),
             ('rows', rows),
-            ('fl', fl)
+            ('fl', fl),
+            ('sort', sort),
+            ('cursorMark', cursor_mark)
         ]
 
         # Query solr instance
-        raw_response = requests.get(select_url, params=parameters, auth=(self.username, self.password))
+        if method == 'POST':
+            raw_response = self.request('POST', select_url, data=parameters)
+        else:
+            raw_response = self.request('GET', select_url, params=parameters)
 
         return raw_response
     
-    def update(self, data:bytes, commit:bool=True) -> requests.models.Response:
-        """Use supplied list of records to update Solr instance."""
+    def iter_docs(self, q:str='*:*', fl:str=None, page_size:int=1000, fq:str=None, sort:str=None, prefetch:bool=False) -> Iterator[dict]:
+        """Yield every document matching a query, one page at a time.
+
+        Pages are requested with a cursor (`cursorMark`), so large result sets 
+        are never requested or held in memory all at once and deep pages are as 
+        fast as the first. The sort always ends with the unique key so paging 
+        is stable.
+
+        Arguments:
+        q (str) -- query
+        fl (str) -- field list to return for each document
+        page_size (int) -- number of documents requested per page
+        fq (str) -- filter query
+        sort (str) -- sort order; the unique key is added as a tie-breaker
+        prefetch (bool) -- request the next page in the background while the 
+            documents of the current page are being used
+
+        Yields:
+        doc (dict) -- matching documents
+        """
+
+        # Cursors require a sort on the unique key
+        if not sort:
+            sort = "{} asc".format(self.unique_key)
+        elif self.unique_key not in [clause.split()[0] for clause in sort.split(",")]:
+            sort += ",{} asc".format(self.unique_key)
+
+        def fetch_page(cursor_mark:str) -> dict:
+            raw_response = self.select(q=q, fq=fq, fl=fl, rows=page_size, sort=sort, cursor_mark=cursor_mark)
+            raw_response.raise_for_status()
+            return raw_response.json()
+
+        executor = ThreadPoolExecutor(1, thread_name_prefix='geodatautils-prefetch') if prefetch else None
+        try:
+            cursor_mark = "*"
+            response = fetch_page(cursor_mark)
+            while True:
+
+                # Cursor does not move once all results are returned
+                next_cursor_mark = response['nextCursorMark']
+                last_page = next_cursor_mark == cursor_mark
+
+                # Start on the next page before handing out this one
+                next_page = executor.submit(fetch_page, next_cursor_mark) if executor and not last_page else None
+
+                yield from response['response']['docs']
+
+                if last_page:
+                    break
+                cursor_mark = next_cursor_mark
+                response = next_page.result() if next_page else fetch_page(cursor_mark)
+
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    async def select_async(self, **parameters) -> requests.models.Response:
+        """Run `select` without blocking the event loop."""
+
+        return await asyncio.to_thread(self.select, **parameters)
+
+    async def select_many_async(self, queries:list[dict], concurrency:Union[int, None]=None) -> list[requests.models.Response]:
+        """Run several selects with a bounded number of requests in flight.
+
+        Arguments:
+        queries (list[dict]) -- keyword arguments for each `select` call
+        concurrency (int|None) -- maximum requests in flight; defaults to the 
+            instance's `concurrency` setting
+
+        Returns:
+        responses (list[Response]) -- responses in the same order as queries
+        """
+
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def bounded_select(parameters:dict) -> requests.models.Response:
+            async with semaphore:
+                return await self.select_async(**parameters)
+
+        return await asyncio.gather(*(bounded_select(parameters) for parameters in queries))
+
+    def select_many(self, queries:list[dict], concurrency:Union[int, None]=None) -> list[requests.models.Response]:
+        """Run several selects concurrently; see `select_many_async`."""
+
+        coroutine = self.select_many_async(queries, concurrency)
+
+        # Run in a new thread if called from inside an event loop (e.g. a notebook)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        with ThreadPoolExecutor(1) as executor:
+            return executor.submit(asyncio.run, coroutine).result()
+
+    def update(self, data:Union[bytes, Iterable[bytes]], commit:bool=True, compress:bool=False) -> requests.models.Response:
+        """Use supplied list of records to update Solr instance.
+        
+        With `commit`, the request also commits according to the commit 
+        strategy (see `commit`). With the `within` strategy every write asks 
+        Solr to commit within `commit-within` milliseconds.
+
+        `data` can be the serialized body or an iterable of byte chunks, such 
+        as a `serialize.StreamedBatch`, which is sent with chunked transfer 
+        encoding. Set `compress` to gzip the body; Solr (or a proxy in front of 
+        it) must be configured to accept gzipped requests.
+        """
 
         # Build parameters
         parameters = []
         
-        if commit:
-            parameters.append("commit={}".format(str(bool(commit)).lower()))
+        if commit or self.commit_strategy == "within":
+            parameters += self._commit_parameters()
 
         # Put parameters together with path
+        path = "update"
         if parameters:
             path = "update?{}".format("&".join(parameters))
 
@@ -98,8 +364,74 @@ class Solr:
       
         # Set headers
         headers = {"Content-Type":"application/json"}
+
+        # Compress body
+        if compress:
+            if isinstance(data, str):
+                data = data.encode()
+            data = gzip.compress(data) if isinstance(data, bytes) else gzip_stream(data)
+            headers["Content-Encoding"] = "gzip"
         
         # Post records to solr
-        raw_response = requests.post(update_url, data=data, headers=headers, auth=(self.username, self.password))
+        raw_response = self.request('POST', update_url, data=data, headers=headers)
         
-        return raw_response
\ No newline at end of file
+        return raw_response
+
+    def request(self, method:str, url:str, **kwargs) -> requests.models.Response:
+        """Send a request over the pooled session, retrying on failure.
+
+        Requests that fail with a dropped connection or a 429/503 response are 
+        retried up to `retries` times with exponential backoff. A `Retry-After` 
+        header from Solr is honored when present. Requests with a streamed body 
+        cannot be replayed and are sent only once.
+        """
+
+        # Streamed bodies are consumed by the first attempt
+        data = kwargs.get('data')
+        retries = self.retries if data is None or isinstance(data, (bytes, str, list, tuple, dict)) else 0
+
+        # Request handler for latency metrics, e.g. 'select' or 'update'
+        handler = urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+        for attempt in range(retries + 1):
+            last_attempt = attempt == retries
+            start = time.perf_counter()
+
+            try:
+                raw_response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if last_attempt:
+                    raise
+                metrics.count('solr_retries')
+                delay = self.backoff_factor * 2**attempt
+                logging.debug("{} {} failed ({}); retrying in {:.1f}s".format(method, url, e.__class__.__name__, delay))
+                time.sleep(delay)
+                continue
+
+            # Log latency
+            latency = time.perf_counter() - start
+            metrics.observe(handler, latency)
+            logging.debug("{} {} {} in {:.1f} ms".format(method, url, raw_response.status_code, latency * 1000))
+
+            # Retry if Solr is overloaded or unavailable
+            if raw_response.status_code in RETRY_STATUS_CODES and not last_attempt:
+                metrics.count('solr_retries')
+                delay = self.backoff_factor * 2**attempt
+                retry_after = raw_response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                logging.debug("{} {} returned {}; retrying in {:.1f}s".format(method, url, raw_response.status_code, delay))
+                time.sleep(delay)
+                continue
+
+            return raw_response
+
+
+def _terms_separator(values:list[str]) -> str:
+    """Pick a separator for a terms query that does not occur in any value."""
+
+    for separator in (",", "|", "\t", "\u001f"):
+        if not any(separator in value for value in values):
+            return separator
+
+    raise ValueError("Could not find a separator for terms query; all candidates occur in the values.")
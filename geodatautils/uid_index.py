@@ -0,0 +1,308 @@
+"""UID Index
+
+Keep a local index of the UIDs in a Solr instance, so existing records can be found without asking Solr about every UID.
+"""
+
+
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+from typing import Iterable, Union
+
+from geodatautils import get_config
+from .helpers import chunked, FINGERPRINT_FIELD
+from .logging_config import LogFormat
+from .metrics import metrics
+from .solr import Solr
+
+
+# Location of the UID index if not set in the config
+DEFAULT_UID_INDEX_PATH = "~/.geodatautils/uid-index.sqlite"
+
+# Solr `_version_` values are a millisecond timestamp shifted left 20 bits; refreshes
+# look back this far so updates committed out of order are not missed
+VERSION_OVERLAP = 60*1000 << 20
+
+# UIDs per SQL lookup, below SQLite's limit on query parameters
+LOOKUP_CHUNK_SIZE = 500
+
+# Version of the index database layout; older indexes are rebuilt from Solr
+INDEX_FORMAT = 2
+
+# Documents the index holds; others are neither stored nor counted
+INDEXED_QUERY = "dc_identifier_s:*"
+
+
+class BloomFilter:
+    """Set of strings that may report false positives but never false negatives.
+
+    Used in front of the UID index, so UIDs that were never indexed (most of
+    them, when adding new records) are ruled out without touching the database.
+    """
+
+    def __init__(self, capacity:int, error_rate:float = 0.001, bits:Union[bytes, None] = None) -> None:
+        """Arguments:
+        capacity (int) -- number of items the filter is sized for
+        error_rate (float) -- false positive rate at capacity
+        bits (bytes|None) -- bits of a saved filter with the same parameters
+        """
+
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(64, int(-self.capacity * math.log(error_rate) / math.log(2)**2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray(bits) if bits is not None else bytearray((self.size + 7) // 8)
+
+    def _positions(self, item:str) -> Iterable[int]:
+        # Derive every hash from two halves of one digest (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item:str) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item:str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+class UIDIndex:
+    """A local copy of the UIDs in a Solr instance and where they came from.
+
+    For each document with a UID (`dc_identifier_s`) the index keeps, keyed by
+    the Solr unique key, the UID, the content fingerprint and `_version_` as
+    last seen in Solr, and the source file the record was added from by
+    Geodata Utils, if it was. Several documents may share a UID. The index is
+    brought up to date with `refresh`, which only requests documents changed
+    since the last refresh; a full refresh only happens when the number of
+    documents with a UID no longer matches, e.g. after deletes.
+
+    Records just added by Geodata Utils are kept as rows without a unique key
+    (see `add_sources`) until a refresh brings in their documents.
+    """
+
+    def __init__(self, path:str, instance:str) -> None:
+        """Open (or create) the UID index database at path.
+
+        Arguments:
+        path (str) -- path of the index database file
+        instance (str) -- name of the Solr instance in the config
+        """
+
+        self.path = os.path.expanduser(path)
+        self.instance = instance
+        self.stats = {'updated': 0, 'lookups': 0, 'filtered': 0, 'found': 0}
+
+        # Open database, starting over if it was made by an older version
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_FORMAT:
+            self.connection.execute("DROP TABLE IF EXISTS uids")
+            self.connection.execute("DROP TABLE IF EXISTS state")
+            self.connection.execute("PRAGMA user_version = {}".format(INDEX_FORMAT))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS uids (instance TEXT NOT NULL, key TEXT, uid TEXT NOT NULL, source TEXT, hash TEXT, version INTEGER, UNIQUE (instance, key))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS uids_uid ON uids (instance, uid)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (instance TEXT PRIMARY KEY, url TEXT, version INTEGER NOT NULL, bloom BLOB, bloom_capacity INTEGER, bloom_count INTEGER)")
+        self.connection.commit()
+
+        self.bloom_changed = False
+        self.bloom = self._load_bloom()
+        self.newest_version = 0  # Newest `_version_` seen by the current refresh
+
+    def __enter__(self) -> "UIDIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def count(self) -> int:
+        """Number of rows in the index, including added records not yet refreshed."""
+        return self.connection.execute("SELECT COUNT(*) FROM uids WHERE instance = ?", (self.instance,)).fetchone()[0]
+
+    def indexed_count(self) -> int:
+        """Number of Solr documents in the index, to compare with Solr."""
+        return self.connection.execute("SELECT COUNT(*) FROM uids WHERE instance = ? AND key IS NOT NULL", (self.instance,)).fetchone()[0]
+
+    def _state(self) -> tuple:
+        row = self.connection.execute("SELECT url, version FROM state WHERE instance = ?", (self.instance,)).fetchone()
+        return row if row else (None, 0)
+
+    def _load_bloom(self) -> BloomFilter:
+        """Load the saved Bloom filter, or rebuild it if the index has changed or outgrown it."""
+
+        count = self.count()
+        row = self.connection.execute("SELECT bloom, bloom_capacity, bloom_count FROM state WHERE instance = ?", (self.instance,)).fetchone()
+        if row and row[0] is not None and row[2] == count and count <= row[1]:
+            return BloomFilter(row[1], bits=row[0])
+
+        # Leave room to grow before the next rebuild
+        bloom = BloomFilter(max(2 * count, 100000))
+        for (uid,) in self.connection.execute("SELECT uid FROM uids WHERE instance = ?", (self.instance,)):
+            bloom.add(uid)
+        self.bloom_changed = True
+        return bloom
+
+    def _upsert(self, docs:Iterable[dict], unique_key:str) -> int:
+        """Add or update documents from Solr by unique key, keeping known
+        source files."""
+
+        updated = 0
+        for batch in chunked(docs, 1000):
+            batch = [doc for doc in batch if doc.get('dc_identifier_s') and doc.get(unique_key) is not None]
+            rows = [(self.instance, str(doc[unique_key]), doc['dc_identifier_s'], doc.get(FINGERPRINT_FIELD), doc.get('_version_')) for doc in batch]
+            self.connection.executemany(
+                "INSERT INTO uids (instance, key, uid, hash, version) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (instance, key) DO UPDATE SET uid = excluded.uid, hash = excluded.hash, version = excluded.version",
+                rows)
+
+            # Move the source of records added before this refresh onto their documents
+            uids = [(self.instance, uid) for _, _, uid, _, _ in rows]
+            self.connection.executemany(
+                "UPDATE uids SET source = (SELECT added.source FROM uids AS added WHERE added.instance = uids.instance AND added.uid = uids.uid AND added.key IS NULL) "
+                "WHERE instance = ? AND uid = ? AND key IS NOT NULL AND EXISTS (SELECT 1 FROM uids AS added WHERE added.instance = uids.instance AND added.uid = uids.uid AND added.key IS NULL)",
+                uids)
+            self.connection.executemany("DELETE FROM uids WHERE instance = ? AND uid = ? AND key IS NULL", uids)
+
+            for doc in batch:
+                self.bloom.add(doc['dc_identifier_s'])
+            self.bloom_changed = True
+            updated += len(batch)
+        return updated
+
+    def refresh(self, solr:Solr, page_size:int = 1000) -> None:
+        """Bring the index up to date with a Solr instance.
+
+        Only documents with a `_version_` newer than the last refresh are
+        requested. If the index then holds a different number of documents
+        with a UID than Solr, e.g. because records were deleted, it is rebuilt
+        from scratch.
+        """
+
+        url, last_version = self._state()
+        self.newest_version = last_version
+
+        # Start over if the instance now points somewhere else
+        if url is not None and url != solr.url:
+            logging.info("Solr URL of {} changed; rebuilding UID index.".format(self.instance), extra={'indent': LogFormat.indent(1)})
+            self.clear()
+            last_version = 0
+
+        field_list = ",".join(dict.fromkeys(['dc_identifier_s', solr.unique_key, FINGERPRINT_FIELD, '_version_']))
+        fq = "_version_:{{{} TO *]".format(last_version - VERSION_OVERLAP) if last_version else None
+
+        # Fetch changed documents, oldest first
+        docs = self._track_version(solr.iter_docs(fq=fq, fl=field_list, sort="_version_ asc", page_size=page_size, prefetch=True))
+        updated = self._upsert(docs, solr.unique_key)
+
+        # Rebuild after deletes, which incremental refreshes cannot see; only
+        # documents with a UID are indexed, so only those are counted
+        raw_response = solr.select(rows=0, fq=INDEXED_QUERY)
+        raw_response.raise_for_status()
+        num_found = raw_response.json()['response']['numFound']
+        if num_found != self.indexed_count():
+            logging.debug("UID index has {} documents but {} has {}; rebuilding.".format(self.indexed_count(), self.instance, num_found), extra={'indent': LogFormat.indent(1)})
+            sources = dict(self.connection.execute("SELECT uid, source FROM uids WHERE instance = ? AND source IS NOT NULL", (self.instance,)))
+            self.clear()
+            updated = self._upsert(self._track_version(solr.iter_docs(fq=INDEXED_QUERY, fl=field_list, page_size=page_size, prefetch=True)), solr.unique_key)
+            self.add_sources(sources, only_existing=True)
+
+        self.connection.execute(
+            "INSERT INTO state (instance, url, version) VALUES (?, ?, ?) ON CONFLICT (instance) DO UPDATE SET url = excluded.url, version = excluded.version",
+            (self.instance, solr.url, self.newest_version))
+        self.connection.commit()
+
+        self.stats['updated'] += updated
+        metrics.count('uid_index_updates', updated)
+
+    def _track_version(self, docs:Iterable[dict]) -> Iterable[dict]:
+        """Pass documents through, remembering the newest `_version_`."""
+
+        for doc in docs:
+            self.newest_version = max(self.newest_version, doc.get('_version_') or 0)
+            yield doc
+
+    def clear(self) -> None:
+        """Remove every UID of the instance."""
+
+        self.connection.execute("DELETE FROM uids WHERE instance = ?", (self.instance,))
+        self.connection.execute("DELETE FROM state WHERE instance = ?", (self.instance,))
+        self.bloom = BloomFilter(self.bloom.capacity)
+        self.bloom_changed = True
+        self.newest_version = 0
+
+    def lookup(self, uids:Iterable[str]) -> dict[str, tuple[Union[str, None], Union[str, None]]]:
+        """Find which UIDs are in the index.
+
+        Returns:
+        found (dict[str, tuple]) -- source file (or None if the record was not
+            added by Geodata Utils) and content fingerprint, keyed by UID
+        """
+
+        # Rule out most UIDs without a query
+        candidates = []
+        for uid in uids:
+            self.stats['lookups'] += 1
+            if uid in self.bloom:
+                candidates.append(uid)
+            else:
+                self.stats['filtered'] += 1
+
+        found = {}
+        for chunk in chunked(candidates, LOOKUP_CHUNK_SIZE):
+            query = "SELECT uid, source, hash FROM uids WHERE instance = ? AND uid IN ({})".format(",".join("?" * len(chunk)))
+            for uid, source, digest in self.connection.execute(query, [self.instance] + chunk):
+                found[uid] = (source, digest)
+
+        self.stats['found'] += len(found)
+        return found
+
+    def add_sources(self, sources:dict[str, str], only_existing:bool = False) -> None:
+        """Record the files that UIDs were added from.
+
+        UIDs not yet in the index are added as rows without a unique key, so
+        they are known before the next refresh, which fills in their unique
+        key, fingerprint and version.
+
+        Arguments:
+        sources (dict[str, str]) -- source file path keyed by UID
+        only_existing (bool) -- only update UIDs already in the index
+        """
+
+        self.connection.executemany("UPDATE uids SET source = ? WHERE instance = ? AND uid = ?", [(source, self.instance, uid) for uid, source in sources.items()])
+        if not only_existing:
+            self.connection.executemany(
+                "INSERT INTO uids (instance, uid, source) SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM uids WHERE instance = ? AND uid = ?)",
+                [(self.instance, uid, source, self.instance, uid) for uid, source in sources.items()])
+            for uid in sources:
+                self.bloom.add(uid)
+            self.bloom_changed = True
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Save the Bloom filter, commit and close the index."""
+
+        if self.bloom_changed:
+            self.connection.execute(
+                "INSERT INTO state (instance, version, bloom, bloom_capacity, bloom_count) VALUES (?, 0, ?, ?, ?) "
+                "ON CONFLICT (instance) DO UPDATE SET bloom = excluded.bloom, bloom_capacity = excluded.bloom_capacity, bloom_count = excluded.bloom_count",
+                (self.instance, bytes(self.bloom.bits), self.bloom.capacity, self.count()))
+        self.connection.commit()
+        self.connection.close()
+
+    def log_stats(self, indent:int = 1) -> None:
+        """Log a summary of index use."""
+
+        logging.info("UID index: {} found of {} UID{} looked up".format(self.stats['found'], self.stats['lookups'], ("" if self.stats['lookups']==1 else "s")), extra={'indent': LogFormat.indent(indent)})
+        logging.debug("{} updated from Solr, {} ruled out by the Bloom filter, {} UIDs in '{}'".format(self.stats['updated'], self.stats['filtered'], self.count(), self.path), extra={'indent': LogFormat.indent(indent+1)})
+
+def open_uid_index(solr:Solr) -> Union[UIDIndex, None]:
+    """Open the UID index for a Solr instance if it is enabled in the config."""
+
+    index_config = get_config().get('uid-index', {})
+    if not index_config.get('enabled', False):
+        return None
+
+    return UIDIndex(index_config.get('path', DEFAULT_UID_INDEX_PATH), solr.name)
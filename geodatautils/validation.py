@@ -0,0 +1,78 @@
+"""Validation
+
+Check records against a JSON schema, in this process or in a worker process.
+
+This module does not import the config, so validation worker processes can
+import it without loading the config and configuring logging again, which
+would truncate the log file of the main process on platforms that start
+workers by spawning a new interpreter (Windows, macOS). Everything a worker
+needs is passed to `init_worker` instead.
+"""
+
+
+from typing import Callable, Union
+
+from jsonschema import validators
+
+from .fastschema import compile_schema
+
+
+# Validator and generated fast path compiled in each validation worker process
+_worker_validator = None
+_worker_fast_path = None
+
+
+def schema_errors(data:dict, v:"jsonschema.protocols.Validator") -> tuple[bool, list[str]]:
+    """Validate data against a schema in a single pass.
+
+    Arguments:
+    data (dict) -- contents of the geoblacklight JSON file
+    v (Validator) -- validator for the schema
+
+    Returns:
+    invalid (bool) -- True if the data does not match the schema
+    messages (list[str]) -- error messages to add to the record
+    """
+
+    invalid = False
+    messages = []
+
+    for error in v.iter_errors(data):
+        invalid = True
+        for suberror in sorted(error.context, key=lambda e: e.schema_path)[:-1]:
+            messages.append("{}: {}".format(":".join(map(str,list(suberror.schema_path))), suberror.message))
+
+    return invalid, messages
+
+def check_record(data:dict, v:"jsonschema.protocols.Validator", fast_path:Union[Callable[[dict], bool], None] = None) -> tuple[bool, list[str]]:
+    """Validate data, using the fast path first if there is one.
+
+    Only data the fast path rejects is validated again by `v`, which finds the
+    error messages.
+
+    Returns:
+    invalid (bool) -- True if the data does not match the schema
+    messages (list[str]) -- error messages to add to the record
+    """
+
+    if fast_path is not None and fast_path(data):
+        return False, []
+    return schema_errors(data, v)
+
+def init_worker(schema:dict, compiled_path:Union[str, None]) -> None:
+    """Compile the validator and fast path once per worker process.
+
+    Arguments:
+    schema (dict) -- JSON schema to validate against
+    compiled_path (str|None) -- folder of generated fast path code, or None
+        if the fast path is turned off
+    """
+
+    global _worker_validator, _worker_fast_path
+    _worker_validator = validators.validator_for(schema)(schema)
+    _worker_fast_path = compile_schema(schema, compiled_path) if compiled_path is not None else None
+
+def validate_chunk(data_list:list[dict]) -> list[tuple[bool, list[str]]]:
+    """Validate a chunk of records in a worker process."""
+
+    return [check_record(data, _worker_validator, _worker_fast_path) for data in data_list]